@@ -72,6 +72,7 @@ import os
 import base64
 import hashlib
 import ssl
+import urllib
 import urlparse
 import xmlrpclib
 
@@ -82,11 +83,16 @@ import kobo.xmlrpc
 from kobo.exceptions import AuthenticationError, ImproperlyConfigured
 
 
+# max size of a log chunk uploaded in one request
+LOG_CHUNK_SIZE = 1024 ** 2
+
+
 __all__ = (
     "CommandContainer",
     "CommandOptionParser",
     "ClientCommand",
     "ClientCommandContainer",
+    "HubBatch",
     "HubProxy",
     "Option",
 )
@@ -114,6 +120,93 @@ class ClientCommand(kobo.cli.Command):
     pass
 
 
+class BatchCall(object):
+    """Result of a call queued in a HubBatch."""
+
+    def __init__(self, method_name, params):
+        self.method_name = method_name
+        self.params = params
+        self.sent = False
+        self._result = None
+        self._fault = None
+
+    def _set(self, item):
+        self.sent = True
+        if isinstance(item, dict):
+            self._fault = xmlrpclib.Fault(item["faultCode"], item["faultString"])
+        else:
+            self._result = item[0]
+
+    @property
+    def result(self):
+        """Return the call result, raise xmlrpclib.Fault if the call failed."""
+        if not self.sent:
+            raise RuntimeError("The batch has not been sent yet.")
+        if self._fault is not None:
+            raise self._fault
+        return self._result
+
+
+class _BatchMethod(object):
+    def __init__(self, queue, name):
+        self._queue = queue
+        self._name = name
+
+    def __getattr__(self, name):
+        return _BatchMethod(self._queue, "%s.%s" % (self._name, name))
+
+    def __call__(self, *args):
+        return self._queue(self._name, args)
+
+
+class HubBatch(object):
+    """
+    Queue hub calls and send them in system.multicall requests.
+
+    USAGE:
+    >>> with hub.batch() as batch:
+            calls = [ batch.worker.get_task(i) for i in task_ids ]
+        tasks = [ i.result for i in calls ]
+
+    The hub runs the calls in the queued order. A failed call doesn't stop
+    the others, its Fault is raised when reading the result.
+    """
+
+    # max calls sent in one request
+    max_calls = 1000
+
+    def __init__(self, hub):
+        self._hub = hub
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _BatchMethod(self._queue, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.send()
+
+    def _queue(self, method_name, params):
+        call = BatchCall(method_name, params)
+        self._calls.append(call)
+        return call
+
+    def send(self):
+        """Send queued calls, return list of their BatchCall objects."""
+        calls, self._calls = self._calls, []
+        for i in xrange(0, len(calls), self.max_calls):
+            chunk = calls[i:i + self.max_calls]
+            results = self._hub.system.multicall([ {"methodName": call.method_name, "params": list(call.params)} for call in chunk ])
+            for call, item in zip(chunk, results):
+                call._set(item)
+        return calls
+
+
 class HubProxy(object):
     """A Hub client (thin ServerProxy wrapper)."""
 
@@ -139,6 +232,7 @@ class HubProxy(object):
         self._auto_logout = auto_logout
         self._logger = logger
         self._logged_in = False
+        self._http_log_upload = True
 
         if transport is not None:
             self._transport = transport
@@ -194,9 +288,12 @@ class HubProxy(object):
 
         # create new self._hub instance (only once, when calling constructor)
         if self._hub is None:
-            self._hub = xmlrpclib.ServerProxy("%s/%s/" % (self._hub_url, self._client_type), allow_none=True, transport=self._transport, verbose=verbose)
+            if self._conf.get("HUB_PROTOCOL", "xmlrpc") == "jsonrpc" and hasattr(self._transport, "content_type"):
+                self._hub = kobo.xmlrpc.JSONRPCServerProxy("%s/%s/" % (self._hub_url, self._client_type), transport=self._transport, verbose=verbose)
+            else:
+                self._hub = xmlrpclib.ServerProxy("%s/%s/" % (self._hub_url, self._client_type), allow_none=True, transport=self._transport, verbose=verbose)
 
-        if force or self._hub.auth.renew_session():
+        if force or self._renew_session(verbose):
             self._logger and self._logger.info("Creating new session...")
             try:
                 # logout to delete current session information
@@ -217,6 +314,22 @@ class HubProxy(object):
             else:
                 self._logger and self._logger.info("New session created.")
 
+    def _renew_session(self, verbose=False):
+        """Call auth.renew_session(), fall back to XML-RPC on hubs without JSON-RPC."""
+        try:
+            return self._hub.auth.renew_session()
+        except (xmlrpclib.ProtocolError, xmlrpclib.ResponseError):
+            if not isinstance(self._hub, kobo.xmlrpc.JSONRPCServerProxy):
+                raise
+        self._logger and self._logger.info("JSON-RPC is not supported by the hub, using XML-RPC.")
+        self._transport.content_type = "text/xml"
+        self._hub = xmlrpclib.ServerProxy("%s/%s/" % (self._hub_url, self._client_type), allow_none=True, transport=self._transport, verbose=verbose)
+        return self._hub.auth.renew_session()
+
+    def batch(self):
+        """Return a HubBatch sending queued calls as a single system.multicall."""
+        return HubBatch(self._hub)
+
     def _logout(self):
         """Logout from hub"""
         if hasattr(self, "_hub"):
@@ -333,6 +446,9 @@ class HubProxy(object):
         """
         Upload a task log to the hub.
 
+        Data is sent as raw bytes over HTTP, hubs without the task/log upload
+        view get base64 encoded chunks over XML-RPC.
+
         @param file_obj: file object (or StringIO, etc.) with the log
         @type  file_obj: file
         @param task_id: task ID
@@ -345,6 +461,9 @@ class HubProxy(object):
         @type  mode: int
         """
 
+        if self._upload_task_log_http(file_obj, task_id, remote_file_name, append, mode):
+            return
+
         for (chunk_start, chunk_len, chunk_checksum, encoded_chunk) in kobo.xmlrpc.encode_xmlrpc_chunks_iterator(file_obj):
             if append:
                 chunk_start = -1
@@ -353,6 +472,63 @@ class HubProxy(object):
                     break
             self._hub.worker.upload_task_log(task_id, remote_file_name, mode, chunk_start, chunk_len, chunk_checksum, encoded_chunk)
 
+    def _get_hub_web_url(self):
+        """Return HUB_WEB_URL or HUB_URL without the trailing /xmlrpc."""
+        url = self._conf.get("HUB_WEB_URL")
+        if url:
+            return url.rstrip("/")
+        url = self._hub_url.rstrip("/")
+        if url.endswith("/xmlrpc"):
+            url = url[:-len("/xmlrpc")]
+        return url
+
+    def _upload_task_log_http(self, file_obj, task_id, remote_file_name, append, mode):
+        """
+        Upload a task log as raw bytes to the hub task/log view.
+
+        Return False if the hub or the transport doesn't support it.
+        """
+        if not self._http_log_upload:
+            return False
+        if not hasattr(self._transport, "raw_request"):
+            self._logger and self._logger.info("Transport doesn't support raw requests, uploading logs over XML-RPC.")
+            self._http_log_upload = False
+            return False
+
+        scheme, netloc, path = urlparse.urlparse(self._get_hub_web_url())[:3]
+        handler = "%s/task/%s/log/%s" % (path.rstrip("/"), int(task_id), urllib.quote(remote_file_name))
+        offset = file_obj.tell()
+        first = True
+
+        while True:
+            chunk = file_obj.read(LOG_CHUNK_SIZE)
+            if not chunk and (append or not first):
+                # an empty file still has to truncate the log
+                break
+            first = False
+
+            query = {"mode": "%o" % mode}
+            if not append:
+                query["offset"] = offset
+            headers = {
+                "Content-Type": "application/octet-stream",
+                "X-Checksum": hashlib.sha256(chunk).hexdigest(),
+            }
+
+            status, reason, response_headers, body = self._transport.raw_request(netloc, "PUT", "%s?%s" % (handler, urllib.urlencode(query)), chunk, headers)
+            if status in (200, 404, 405) and response_headers.get("X-Log-Size") is None:
+                # hub without log uploads over HTTP (old hubs render the log page), use XML-RPC from now on;
+                # other errors (5xx from a proxy, errors of the upload view) are raised, callers retry them
+                self._logger and self._logger.warning("Log upload to %s%s failed (%s %s), uploading logs over XML-RPC." % (netloc, handler, status, reason))
+                self._http_log_upload = False
+                file_obj.seek(offset)
+                return False
+            if status != 200:
+                raise xmlrpclib.ProtocolError(netloc + handler, status, body or reason, response_headers)
+
+            offset += len(chunk)
+        return True
+
 
 from xmlrpclib import Fault
 
@@ -3,6 +3,7 @@
 
 import sys
 import time
+import xmlrpclib
 
 
 __all__ = (
@@ -67,6 +68,9 @@ class TaskWatcher(object):
         self.task_info = None
         self.indentation_level = int(indentation_level)
         self.subtask_dict = {}
+        # watch the whole tree with client.watch_tree(), fall back to task_info() on older hubs
+        self.watch_tree = True
+        self.seq = 0
 
     def __str__(self):
         result = "%s%s" % ("  " * self.indentation_level, self.task_id)
@@ -101,17 +105,19 @@ class TaskWatcher(object):
         if self.is_finished():
             return False
 
+        if self.watch_tree:
+            try:
+                return self._update_tree()
+            except xmlrpclib.Fault, ex:
+                if "is not supported" not in ex.faultString:
+                    raise
+                self.watch_tree = False
+        return self._update_task()
+
+    def _set_task_info(self, task_info):
+        """Store new task info and print state change. Returns True on state change."""
         last = self.task_info
-        self.task_info = self.hub.client.task_info(self.task_id, False)
-
-        if self.task_info is None:
-            print "No such task id: %s" % self.task_id
-            sys.exit(1)
-
-        # watch new tasks
-        for i in self.task_info.get("subtask_id_list", []):
-            if i not in self.subtask_dict:
-                self.subtask_dict[i] = TaskWatcher(self.hub, i, self.indentation_level + 1)
+        self.task_info = task_info
 
         changed = False
         state = self.task_info["state"]
@@ -125,9 +131,61 @@ class TaskWatcher(object):
             # first time we're seeing this task, so just show the current state
             print "%s: %s" % (self, self.display_state(self.task_info))
             changed = True
+        return changed
+
+    def _update_tree(self):
+        """Update the task and all subtasks with a single call returning only changed tasks."""
+        since_seq = self.seq
+        try:
+            result = self.hub.client.watch_tree(self.task_id, since_seq)
+        except xmlrpclib.Fault, ex:
+            if "DoesNotExist" not in ex.faultString:
+                raise
+            print "No such task id: %s" % self.task_id
+            sys.exit(1)
+        self.seq = result["seq"]
+
+        watchers = {}
+        todo = [self]
+        while todo:
+            watcher = todo.pop()
+            watchers[watcher.task_id] = watcher
+            todo.extend(watcher.subtask_dict.itervalues())
+
+        changed = False
+        # parents have lower ids than their subtasks
+        for task_info in sorted(result["tasks"], key=lambda i: i["id"]):
+            watcher = watchers.get(task_info["id"])
+            if watcher is None:
+                parent = watchers.get(task_info["parent"])
+                if parent is None:
+                    continue
+                # watch new tasks
+                watcher = TaskWatcher(self.hub, task_info["id"], parent.indentation_level + 1)
+                parent.subtask_dict[watcher.task_id] = watcher
+                watchers[watcher.task_id] = watcher
+            changed |= watcher._set_task_info(task_info)
+        return changed
+
+    def _update_task(self):
+        """Update the task with task_info() and then all subtasks one by one."""
+        self.watch_tree = False
+        task_info = self.hub.client.task_info(self.task_id, False)
+
+        if task_info is None:
+            print "No such task id: %s" % self.task_id
+            sys.exit(1)
+
+        # watch new tasks
+        for i in task_info.get("subtask_id_list", []):
+            if i not in self.subtask_dict:
+                self.subtask_dict[i] = TaskWatcher(self.hub, i, self.indentation_level + 1)
+
+        changed = self._set_task_info(task_info)
 
         # update all subtasks
         for key in sorted(self.subtask_dict.keys()):
+            self.subtask_dict[key].watch_tree = False
             changed |= self.subtask_dict[key].update()
         return changed
 
@@ -13,12 +13,31 @@ from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
 
 from django.conf import settings
 
+from kobo.django.xmlrpc.serializers import XMLRPCSerializer
+
 
 __all__ = (
     'DjangoXMLRPCDispatcher',
 )
 
 
+class _MulticallDispatcher(SimpleXMLRPCDispatcher):
+    """Dispatch calls of a system.multicall request to a DjangoXMLRPCDispatcher."""
+
+    def __init__(self, dispatcher, request):
+        self.dispatcher = dispatcher
+        self.request = request
+
+    def _dispatch(self, method, params):
+        try:
+            # insert request to each param list
+            return self.dispatcher._dispatch(method, [self.request] + list(params))
+        except xmlrpclib.Fault:
+            raise
+        except:
+            raise xmlrpclib.Fault(1, "%s: %s" % (sys.exc_type.__name__, sys.exc_value))
+
+
 class DjangoXMLRPCDispatcher(SimpleXMLRPCDispatcher):
     def __init__(self, allow_none=True, encoding=None):
         if sys.version_info[:2] == (2, 4):
@@ -33,11 +52,13 @@ class DjangoXMLRPCDispatcher(SimpleXMLRPCDispatcher):
 
 
     def system_multicall(self, request, call_list):
-        for call in call_list:
-            # insert request to each param list
-            call['params'] = [request] + call['params']
+        """SimpleXMLRPCDispatcher.system_multicall() passing request to each call.
 
-        return SimpleXMLRPCDispatcher.system_multicall(self, call_list)
+        Calls run one after another in the given order, a failed call doesn't
+        stop the others. Failures are formatted the same way as in
+        _marshaled_dispatch().
+        """
+        return _MulticallDispatcher(self, request).system_multicall(call_list)
 
 
     def register_module(self, module_name, function_prefix):
@@ -69,7 +90,7 @@ class DjangoXMLRPCDispatcher(SimpleXMLRPCDispatcher):
             self.register_function(function, name)
 
 
-    def _marshaled_dispatch(self, request, dispatch_method = None):
+    def _marshaled_dispatch(self, request, dispatch_method = None, data = None, serializer = None):
         """Dispatches an XML-RPC method from marshalled (XML) data.
 
         XML-RPC methods are dispatched from the marshalled (XML) data
@@ -79,10 +100,21 @@ class DjangoXMLRPCDispatcher(SimpleXMLRPCDispatcher):
         SimpleXMLRPCRequestHandler.do_POST) but overriding the
         existing method through subclassing is the prefered means
         of changing method dispatch behavior.
+
+        The request body is dispatched unless decoded data is passed.
+        Other protocols are handled by passing a serializer from
+        kobo.django.xmlrpc.serializers, XML-RPC is the default.
         """
 
-        data = request.body
-        params, method = xmlrpclib.loads(data)
+        if data is None:
+            data = request.body
+        if serializer is None:
+            serializer = XMLRPCSerializer(self.allow_none, self.encoding)
+
+        try:
+            params, method, call_id = serializer.loads(data)
+        except xmlrpclib.Fault, fault:
+            return serializer.dumps_fault(fault)
 
         # add request to params
         params = (request, ) + params
@@ -93,23 +125,17 @@ class DjangoXMLRPCDispatcher(SimpleXMLRPCDispatcher):
                 response = dispatch_method(method, params)
             else:
                 response = self._dispatch(method, params)
-            # wrap response in a singleton tuple
-            response = (response,)
-            response = xmlrpclib.dumps(response, methodresponse=1, allow_none=self.allow_none, encoding=self.encoding)
+            response = serializer.dumps_result(response, call_id)
 
         except xmlrpclib.Fault, fault:
-            response = xmlrpclib.dumps(fault, allow_none=self.allow_none, encoding=self.encoding)
+            response = serializer.dumps_fault(fault, call_id)
 
         except:
             # report exception back to server
             if settings.DEBUG:
                 from kobo.tback import Traceback
-                response = xmlrpclib.dumps(
-                    xmlrpclib.Fault(1, u"%s" % Traceback().get_traceback()),
-                    allow_none=self.allow_none, encoding=self.encoding)
+                response = serializer.dumps_fault(xmlrpclib.Fault(1, u"%s" % Traceback().get_traceback()), call_id)
             else:
-                response = xmlrpclib.dumps(
-                    xmlrpclib.Fault(1, "%s: %s" % (sys.exc_type.__name__, sys.exc_value)),
-                    allow_none=self.allow_none, encoding=self.encoding)
+                response = serializer.dumps_fault(xmlrpclib.Fault(1, "%s: %s" % (sys.exc_type.__name__, sys.exc_value)), call_id)
 
         return response
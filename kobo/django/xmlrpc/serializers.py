@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+Request/response serializers used by DjangoXMLRPCDispatcher.
+
+The serializer is chosen by the request content type, all of them dispatch
+the same methods registered in settings.XMLRPC_METHODS.
+"""
+
+
+import datetime
+import xmlrpclib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+__all__ = (
+    "XMLRPCSerializer",
+    "JSONRPCSerializer",
+    "get_serializer",
+)
+
+
+def _escape(value):
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    return value
+
+
+def _make_dumper(encoding, allow_none, marshaller):
+    """Return dump(value, write), names are bound locally for speed."""
+    MAXINT, MININT = xmlrpclib.MAXINT, xmlrpclib.MININT
+
+    def dump(value, write):
+        value_type = type(value)
+        if value_type is str:
+            write("<value><string>" + _escape(value) + "</string></value>\n")
+        elif value_type is dict:
+            write("<value><struct>\n")
+            for key, item in value.iteritems():
+                if type(key) is not str:
+                    if type(key) is not unicode:
+                        raise TypeError("dictionary key must be string")
+                    key = key.encode(encoding)
+                write("<member>\n<name>" + _escape(key) + "</name>\n")
+                dump(item, write)
+                write("</member>\n")
+            write("</struct></value>\n")
+        elif value_type is int or value_type is long:
+            if value > MAXINT or value < MININT:
+                raise OverflowError("int exceeds XML-RPC limits")
+            write("<value><int>%d</int></value>\n" % value)
+        elif value_type is list or value_type is tuple:
+            write("<value><array><data>\n")
+            for item in value:
+                dump(item, write)
+            write("</data></array></value>\n")
+        elif value_type is unicode:
+            write("<value><string>" + _escape(value.encode(encoding)) + "</string></value>\n")
+        elif value is None:
+            if not allow_none:
+                raise TypeError("cannot marshal None unless allow_none is enabled")
+            write("<value><nil/></value>")
+        elif value_type is bool:
+            write("<value><boolean>%d</boolean></value>\n" % value)
+        elif value_type is float:
+            write("<value><double>%r</double></value>\n" % value)
+        else:
+            marshaller._Marshaller__dump(value, write)
+
+    return dump
+
+
+class XMLRPCSerializer(object):
+    """XML-RPC with a fast path for the types returned by hub methods.
+
+    dict, list, tuple, str, unicode, int, long, bool, float and None are
+    marshalled directly, other types are passed to xmlrpclib.Marshaller.
+    The output is the same as from xmlrpclib.dumps().
+    """
+
+    content_type = "text/xml"
+
+    def __init__(self, allow_none=True, encoding=None):
+        self.allow_none = allow_none
+        self.encoding = encoding or "utf-8"
+        self._dump = _make_dumper(self.encoding, allow_none, xmlrpclib.Marshaller(self.encoding, allow_none))
+
+    def loads(self, data):
+        """Return (params, method name, call id)."""
+        params, method = xmlrpclib.loads(data)
+        return params, method, None
+
+    def dumps_result(self, result, call_id=None):
+        out = []
+        self._dump(result, out.append)
+        if self.encoding == "utf-8":
+            header = "<?xml version='1.0'?>\n"
+        else:
+            header = "<?xml version='1.0' encoding='%s'?>\n" % self.encoding
+        return "%s<methodResponse>\n<params>\n<param>\n%s</param>\n</params>\n</methodResponse>\n" % (header, "".join(out))
+
+    def dumps_fault(self, fault, call_id=None):
+        return xmlrpclib.dumps(fault, allow_none=self.allow_none, encoding=self.encoding)
+
+
+class JSONRPCSerializer(object):
+    """JSON-RPC 2.0 (single calls, no batches).
+
+    Dates are sent as XML-RPC ISO 8601 strings, binary data base64 encoded.
+    """
+
+    content_type = "application/json"
+
+    def __init__(self, allow_none=True, encoding=None):
+        self.encoding = encoding or "utf-8"
+
+    def _default(self, value):
+        if isinstance(value, (datetime.datetime, xmlrpclib.DateTime)):
+            return str(xmlrpclib.DateTime(value))
+        if isinstance(value, xmlrpclib.Binary):
+            return value.data.encode("base64")
+        raise TypeError("cannot serialize %r" % type(value))
+
+    def loads(self, data):
+        try:
+            call = json.loads(data, encoding=self.encoding)
+        except ValueError, ex:
+            raise xmlrpclib.Fault(-32700, "Parse error: %s" % ex)
+        if not isinstance(call, dict) or not isinstance(call.get("method"), basestring) or not isinstance(call.get("params", []), list):
+            raise xmlrpclib.Fault(-32600, "Invalid request")
+        return tuple(call.get("params", [])), str(call["method"]), call.get("id")
+
+    def dumps_result(self, result, call_id=None):
+        return json.dumps({"jsonrpc": "2.0", "result": result, "id": call_id}, encoding=self.encoding, default=self._default)
+
+    def dumps_fault(self, fault, call_id=None):
+        return json.dumps({"jsonrpc": "2.0", "error": {"code": fault.faultCode, "message": fault.faultString}, "id": call_id}, encoding=self.encoding, default=self._default)
+
+
+def get_serializer(content_type, allow_none=True, encoding=None):
+    """Return a serializer for a request content type, XML-RPC is the default."""
+    if content_type and content_type.split(";")[0].strip() == JSONRPCSerializer.content_type:
+        return JSONRPCSerializer(allow_none, encoding)
+    return XMLRPCSerializer(allow_none, encoding)
@@ -24,6 +24,14 @@ XMLRPC_METHODS = {
 <key>_handler method is created for each key in XMLRPC_METHODS
 (xmlrpc1_handler and xmlrpc2_handler in this case).
 
+Responses larger than XMLRPC_GZIP_THRESHOLD bytes (16 KiB by default, None
+disables compression) are gzip compressed for clients sending
+"Accept-Encoding: gzip". Gzip compressed requests are accepted as well,
+which is announced in the "Accept-Encoding" response header.
+
+Requests with "Content-Type: application/json" are handled as JSON-RPC 2.0
+calls of the same methods, see kobo.django.xmlrpc.serializers.
+
 It is encouraged to use __all__ when exporting whole module.
 
 All double underscores in method names will be replaced with dots:
@@ -35,11 +43,14 @@ import sys
 import django.db
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils.cache import patch_vary_headers
 from django.template import Template, RequestContext, loader
 from django.views.decorators.csrf import csrf_exempt
 
 from kobo.django.xmlrpc.dispatcher import DjangoXMLRPCDispatcher
+from kobo.xmlrpc import gzip_encode, gzip_decode
+from kobo.django.xmlrpc.serializers import get_serializer
 
 
 # this has to be list, since new handlers are appended when the module is loaded
@@ -136,6 +147,22 @@ class XMLRPCHandlerFactory(object):
         sys.modules[__name__].__all__.append(handler_name)
 
 
+    def _compress_response(self, request, response):
+        response["Accept-Encoding"] = "gzip"
+        threshold = getattr(settings, "XMLRPC_GZIP_THRESHOLD", 16 * 1024)
+        if threshold is None or len(response.content) <= threshold:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding", ))
+        if "gzip" not in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+            return response
+
+        response.content = gzip_encode(response.content)
+        response["Content-Encoding"] = "gzip"
+        response["Content-Length"] = str(len(response.content))
+        return response
+
+
     def xmlrpc_handler(self, request):
         if settings.DEBUG:
             # clear queries to stop django allocating more and more memory
@@ -143,7 +170,15 @@ class XMLRPCHandlerFactory(object):
             django.db.reset_queries()
 
         if request.method == "POST":
-            return HttpResponse(self.xmlrpc_dispatcher._marshaled_dispatch(request), content_type="text/xml")
+            data = None
+            if request.META.get("HTTP_CONTENT_ENCODING") == "gzip":
+                try:
+                    data = gzip_decode(request.body)
+                except ValueError, ex:
+                    return HttpResponseBadRequest(str(ex), content_type="text/plain")
+            serializer = get_serializer(request.META.get("CONTENT_TYPE"), self.xmlrpc_dispatcher.allow_none, self.xmlrpc_dispatcher.encoding)
+            response = HttpResponse(self.xmlrpc_dispatcher._marshaled_dispatch(request, data=data, serializer=serializer), content_type=serializer.content_type)
+            return self._compress_response(request, response)
         else:
             method_list = []
             for method in self.xmlrpc_dispatcher.system_listMethods():
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from kobo.hub.models import TaskArchive
+
+
+class Command(BaseCommand):
+    help = "Move old finished task trees and their logs from hub_task to hub_task_archive. Safe to interrupt and run again."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", default=90, help="Archive tasks finished more than DAYS days ago (default: 90)."),
+        make_option("--batch-size", type="int", default=500, help="Number of top-level tasks archived with their subtasks in one transaction."),
+        make_option("--max-batches", type="int", default=0, help="Stop after this number of batches (default: no limit)."),
+    )
+
+    def handle(self, *args, **options):
+        dt_before = datetime.datetime.now() - datetime.timedelta(days=options["days"])
+
+        total = 0
+        batches = 0
+        while not options["max_batches"] or batches < options["max_batches"]:
+            count = TaskArchive.objects.archive(dt_before, options["batch_size"])
+            if not count:
+                break
+            total += count
+            batches += 1
+            self.stdout.write("Archived %d task(s)." % total)
+
+        self.stdout.write("Archived %d task(s) in %d batch(es)." % (total, batches))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+
+import multiprocessing
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from kobo.hub.models import Task, LogCompression
+
+
+def _compress_task_logs(task_id):
+    """Compress logs of a task, runs in a pool process. Return (task_id, log count, uncompressed size)."""
+    count, size = Task(id=task_id).logs.gzip_logs()
+    return task_id, count, size
+
+
+class Command(BaseCommand):
+    help = "Compress logs of finished tasks queued by close_task(), fail_task() and other state transitions."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--processes", type="int", default=multiprocessing.cpu_count(), help="Number of compression processes (default: CPU count)."),
+        make_option("--batch-size", type="int", default=100, help="Number of queued tasks processed at once."),
+        make_option("--follow", action="store_true", default=False, help="Don't exit when the queue is empty, wait for new tasks."),
+        make_option("--interval", type="float", default=10, help="Time to wait for new tasks in --follow mode, in seconds."),
+    )
+
+    def handle(self, *args, **options):
+        # don't share database connection with pool processes
+        if not connection.in_atomic_block:
+            connection.close()
+        pool = multiprocessing.Pool(options["processes"])
+
+        total_tasks = 0
+        total_logs = 0
+        total_size = 0
+        total_time = 0.0
+        try:
+            while True:
+                queue = list(LogCompression.objects.order_by("id").values_list("id", "task")[:options["batch_size"]])
+                if not queue:
+                    if not options["follow"]:
+                        break
+                    time.sleep(options["interval"])
+                    continue
+
+                start = time.time()
+                task_ids = sorted(set(( task_id for queue_id, task_id in queue )))
+                for task_id, count, size in pool.imap_unordered(_compress_task_logs, task_ids):
+                    total_logs += count
+                    total_size += size
+                total_tasks += len(task_ids)
+                total_time += time.time() - start
+
+                # tasks enqueued again meanwhile stay in the queue
+                LogCompression.objects.filter(id__in=[ queue_id for queue_id, task_id in queue ]).delete()
+                if options["follow"]:
+                    self._report(total_tasks, total_logs, total_size, total_time)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._report(total_tasks, total_logs, total_size, total_time)
+
+    def _report(self, tasks, logs, size, seconds):
+        mb = size / 1024.0 / 1024.0
+        speed = seconds and mb / seconds or 0.0
+        self.stdout.write("Compressed %d log(s) of %d task(s): %.1f MB in %.2f s (%.1f MB/s)." % (logs, tasks, mb, seconds, speed))
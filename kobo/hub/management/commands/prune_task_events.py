@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from kobo.hub.models import TaskEvent
+
+
+class Command(BaseCommand):
+    help = "Delete old task state change events and compact older history to the last event of each task."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", default=90, help="Delete events older than DAYS days (default: 90)."),
+        make_option("--compact-days", type="int", default=7, help="Keep only the last event of each task for events older than this number of days (default: 7, 0 disables compaction)."),
+        make_option("--batch-size", type="int", default=500, help="Number of events deleted at once."),
+    )
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now()
+
+        purged = TaskEvent.objects.purge(now - datetime.timedelta(days=options["days"]), options["batch_size"])
+        self.stdout.write("Deleted %d event(s) older than %d day(s)." % (purged, options["days"]))
+
+        if options["compact_days"]:
+            compacted = TaskEvent.objects.compact(now - datetime.timedelta(days=options["compact_days"]), options["batch_size"])
+            self.stdout.write("Compacted %d event(s) older than %d day(s)." % (compacted, options["compact_days"]))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.core.management.base import BaseCommand
+
+from kobo.hub.models import Task, Worker
+
+
+class Command(BaseCommand):
+    help = "Recompute denormalized task and worker counters which drifted, e.g. after editing tasks in the database."
+
+    def handle(self, *args, **options):
+        fixed_tasks = Task.objects.reconcile_subtask_counts()
+        self.stdout.write("Fixed subtask counts of %d task(s)." % fixed_tasks)
+
+        fixed_workers = Worker.objects.reconcile()
+        for worker in fixed_workers:
+            self.stdout.write("Fixed counters of worker %s." % worker.name)
+        self.stdout.write("Fixed counters of %d worker(s)." % len(fixed_workers))
@@ -2,6 +2,7 @@
 
 
 from models import Worker
+import refcache
 
 
 def get_worker(request):
@@ -10,7 +11,7 @@ def get_worker(request):
             return None
 
         hostname = request.user.username.split("/")[1]
-        worker = Worker.objects.get(name=hostname)
+        worker = refcache.get(Worker, name=hostname)
         return worker
     except:
         return None
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0003_auto_20160202_0647'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogCompression',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dt_created', models.DateTimeField(auto_now_add=True)),
+                ('task', models.ForeignKey(to='hub.Task')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
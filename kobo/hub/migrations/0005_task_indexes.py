@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Indexes matching queries in hub.xmlrpc.worker._get_tasks_to_assign():
+# free tasks filtered by channel or awaited flag, ordered by -priority, id.
+# PostgreSQL gets partial indexes of free tasks only. Other planners (SQLite
+# in particular) can't match a partial index against a bound "state = %s"
+# parameter, state is the leading column there.
+SCHEDULER_INDEXES = (
+    ("hub_task_free_channel", "channel_id, awaited, priority DESC, id"),
+    ("hub_task_free_awaited", "awaited, priority DESC, id"),
+)
+
+# TASK_STATES["FREE"]
+FREE_STATE = 0
+
+
+def create_scheduler_indexes(apps, schema_editor):
+    for name, columns in SCHEDULER_INDEXES:
+        if schema_editor.connection.vendor == "postgresql":
+            schema_editor.execute("CREATE INDEX %s ON hub_task (%s) WHERE state = %s" % (name, columns, FREE_STATE))
+        else:
+            schema_editor.execute("CREATE INDEX %s ON hub_task (state, %s)" % (name, columns))
+
+
+def drop_scheduler_indexes(apps, schema_editor):
+    for name, columns in SCHEDULER_INDEXES:
+        if schema_editor.connection.vendor == "mysql":
+            schema_editor.execute("DROP INDEX %s ON hub_task" % name)
+        else:
+            schema_editor.execute("DROP INDEX %s" % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0004_logcompression'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='task',
+            index_together=set([('worker', 'state')]),
+        ),
+        migrations.RunPython(create_scheduler_indexes, drop_scheduler_indexes),
+    ]
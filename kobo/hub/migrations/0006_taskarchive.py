@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+import kobo.django.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('hub', '0005_task_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskArchive',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('worker_id', models.IntegerField(null=True, blank=True)),
+                ('parent_id', models.IntegerField(db_index=True, null=True, blank=True)),
+                ('state', models.PositiveIntegerField(choices=[(0, b'FREE'), (1, b'ASSIGNED'), (2, b'OPEN'), (3, b'CLOSED'), (4, b'CANCELED'), (5, b'FAILED'), (6, b'INTERRUPTED'), (7, b'TIMEOUT'), (8, b'CREATED')])),
+                ('label', models.CharField(max_length=255, blank=True)),
+                ('exclusive', models.BooleanField(default=False)),
+                ('method', models.CharField(max_length=255)),
+                ('args', kobo.django.fields.JSONField(default={}, blank=True)),
+                ('result', models.TextField(blank=True)),
+                ('comment', models.TextField(null=True, blank=True)),
+                ('timeout', models.PositiveIntegerField(null=True, blank=True)),
+                ('waiting', models.BooleanField(default=False)),
+                ('awaited', models.BooleanField(default=False)),
+                ('dt_created', models.DateTimeField()),
+                ('dt_started', models.DateTimeField(null=True, blank=True)),
+                ('dt_finished', models.DateTimeField(null=True, blank=True)),
+                ('priority', models.PositiveIntegerField(default=10)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('resubmitted_from_id', models.IntegerField(null=True, blank=True)),
+                ('subtask_count', models.PositiveIntegerField(default=0)),
+                ('dt_archived', models.DateTimeField(auto_now_add=True)),
+                ('arch', models.ForeignKey(related_name='+', to='hub.Arch')),
+                ('channel', models.ForeignKey(related_name='+', to='hub.Channel')),
+                ('owner', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('resubmitted_by', models.ForeignKey(related_name='+', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'ordering': ('-id',),
+                'db_table': 'hub_task_archive',
+            },
+        ),
+    ]
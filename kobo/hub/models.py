@@ -2,10 +2,15 @@
 
 import os
 import sys
+import bisect
 import datetime
+import fcntl
 import gzip
+import hashlib
 import shutil
+import tempfile
 import logging
+import warnings
 from collections import deque
 import io
 
@@ -20,14 +25,27 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.db import models, connection, transaction
+from django.db.models import F, Q, Count, Sum, Max, Min
+try:
+    from django.db.models import Case, When, Value
+except ImportError:
+    # Django < 1.8, see _add_to_counters()
+    Case = When = Value = None
 from django.utils.translation import ugettext_lazy as _
 from django.db.models.signals import post_delete
 
 import kobo.django.fields
 from kobo.client.constants import *
-from kobo.shortcuts import random_string, read_from_file, save_to_file, run
+from kobo.hub import refcache, wakeup
+from kobo.shortcuts import random_string, read_from_file, save_to_file
 
 LOG_BUFFER_SIZE = 2**20
+# compressed logs consist of independent gzip members of this (uncompressed) size
+LOG_GZIP_BLOCK_SIZE = 4 * 2**20
+# list of task logs with their sizes, stored in the task directory
+LOG_MANIFEST_NAME = ".manifest.json"
+# suffix of logs being written, they are renamed when complete
+LOG_TMP_SUFFIX = ".tmp"
 
 
 def dump_dict(**kwargs):
@@ -84,12 +102,47 @@ def _utf8_chunk(bytestr):
         return bytestr
 
 
+def _find_line_start(fh, pos, block_size=65536):
+    """Return offset of the line containing pos.
+
+    Search backwards at most LOG_BUFFER_SIZE bytes, return pos if no line
+    start was found.
+    """
+    end = pos
+    while end > 0 and pos - end < LOG_BUFFER_SIZE:
+        start = max(end - block_size, 0)
+        fh.seek(start)
+        index = fh.read(end - start).rfind(b"\n")
+        if index != -1:
+            return start + index + 1
+        end = start
+    if end == 0:
+        return 0
+    return pos
+
+
 def _tail(fh, max_size, max_line_size):
     """See TaskLogs.tail"""
     buffer = deque()
     current_size = 0
     offset = 0
 
+    try:
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+    except (AttributeError, IOError, ValueError):
+        # not seekable (plain gzip), read from the beginning
+        size = None
+
+    if size is not None:
+        start = 0
+        if size > max_size + max_line_size:
+            # lines before this point don't fit to max_size, a longer line
+            # would be split; start reading at the beginning of the line
+            start = _find_line_start(fh, size - max_size - max_line_size)
+        fh.seek(start)
+        offset = start
+
     while True:
         this_line = fh.readline(max_line_size)
         if not this_line:
@@ -163,6 +216,186 @@ class Channel(models.Model):
         return Worker.objects.filter(channels__id=self.id).count()
 
 
+# max number of IDs passed to a single query
+QUERY_CHUNK_SIZE = 500
+
+
+def _chunks(items, size=QUERY_CHUNK_SIZE):
+    """Split a list into chunks which fit into query parameters."""
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def compress_task_logs(task_ids):
+    """Enqueue logs of finished tasks for compression, see the compress_logs management command."""
+    LogCompression.objects.bulk_create([ LogCompression(task_id=i) for i in task_ids ])
+
+
+def _gzip_file(path):
+    """gzip a file in-process like the gzip command does. Return size of the uncompressed file.
+
+    The file is written as independent gzip members of LOG_GZIP_BLOCK_SIZE
+    bytes, their offsets are stored in a <path>.gz.idx file for seeking.
+    """
+    stat = os.stat(path)
+    gz_path = path + ".gz"
+    index_path = gz_path + ".idx"
+    # hide incomplete files from readers
+    tmp_path = os.path.join(os.path.dirname(path), ".%s.tmp" % os.path.basename(gz_path))
+    tmp_index_path = os.path.join(os.path.dirname(path), ".%s.tmp" % os.path.basename(index_path))
+
+    src = open(path, "rb")
+    try:
+        dst = open(tmp_path, "wb")
+        try:
+            index = []
+            while True:
+                index.append((src.tell(), dst.tell()))
+                if sys.version_info[:2] < (2, 7):
+                    # no mtime argument, headers get the current time
+                    gz = gzip.GzipFile(os.path.basename(path), "wb", 6, dst)
+                else:
+                    gz = gzip.GzipFile(os.path.basename(path), "wb", 6, dst, stat.st_mtime)
+                block_size = 0
+                while block_size < LOG_GZIP_BLOCK_SIZE:
+                    data = src.read(min(LOG_BUFFER_SIZE, LOG_GZIP_BLOCK_SIZE - block_size))
+                    if not data:
+                        break
+                    gz.write(data)
+                    block_size += len(data)
+                gz.close()
+                if block_size < LOG_GZIP_BLOCK_SIZE:
+                    break
+            index.append((src.tell(), dst.tell()))
+        finally:
+            dst.close()
+
+        save_to_file(tmp_index_path, "".join("%s %s\n" % i for i in index), mode=0644)
+        os.chmod(tmp_path, stat.st_mode & 07777)
+        os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+        os.rename(tmp_index_path, index_path)
+        os.rename(tmp_path, gz_path)
+    except:
+        for i in (tmp_path, tmp_index_path):
+            if os.path.exists(i):
+                os.unlink(i)
+        raise
+    finally:
+        src.close()
+
+    os.unlink(path)
+    return stat.st_size
+
+
+def _read_gzip_index(gz_path):
+    """Return [(uncompressed offset, compressed offset)] of gzip members
+    written by _gzip_file() or None if the log has no valid index.
+
+    The last item holds the uncompressed and compressed file size.
+    """
+    try:
+        index = [ tuple(int(j) for j in i.split()) for i in read_from_file(gz_path + ".idx") if i ]
+        gz_size = os.path.getsize(gz_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(index) < 2 or any(len(i) != 2 for i in index) or index[-1][1] != gz_size:
+        # plain gzip or the index doesn't belong to the file
+        return None
+    return index
+
+
+class _IndexedGzipReader(object):
+    """Read-only file object over a gzip log with an offset index.
+
+    Seeking opens the gzip member containing the offset, so only data
+    from the start of that member has to be decompressed.
+    """
+
+    def __init__(self, gz_path, index):
+        self._path = gz_path
+        self._file = open(gz_path, "rb")
+        self._index = index
+        self._offsets = [ i[0] for i in index ]
+        self.size = index[-1][0]
+        self.seek(0)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._offset
+        elif whence == os.SEEK_END:
+            offset += self.size
+        offset = max(0, min(offset, self.size))
+
+        block = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        block_offset, file_offset = self._index[block]
+        self._file.seek(file_offset)
+        self._gz = gzip.GzipFile(fileobj=self._file, mode="rb")
+        skip = offset - block_offset
+        while skip > 0:
+            data = self._gz.read(min(skip, LOG_BUFFER_SIZE))
+            if not data:
+                raise IOError("Gzip log is shorter than its index: %s" % self._path)
+            skip -= len(data)
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def read(self, size=-1):
+        data = self._gz.read(size)
+        self._offset += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._gz.readline(size)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _get_task_dir(base_dir, task_id, create=False):
+    """Return base_dir/millions/tens_of_thousands/task_id."""
+    task_id = int(task_id)
+    third = task_id
+    second = task_id // 10000 * 10000
+    first = task_id // 1000000 * 1000000
+
+    base_dir = os.path.abspath(base_dir)
+    path = os.path.join(base_dir, str(first), str(second), str(third))
+    path = os.path.abspath(path)
+    if not path.startswith(base_dir):
+        raise Exception('Possible hack, trying to read path "%s"' % path)
+
+    if create and not os.path.isdir(path):
+        os.makedirs(path, mode=0755)
+
+    return path
+
+
+def _add_to_counter(field, delta):
+    """Return an expression adding delta to a counter field, the result never drops below zero."""
+    if delta >= 0:
+        return F(field) + delta
+    return Case(When(then=F(field) + delta, **{"%s__gte" % field: -delta}), default=Value(0))
+
+
+def _add_to_counters(queryset, **deltas):
+    """Add deltas to counter fields of rows in queryset, counters never drop below zero."""
+    if Case is not None:
+        queryset.update(**dict((field, _add_to_counter(field, delta)) for field, delta in deltas.items()))
+        return
+
+    # Django < 1.8 has no conditional expressions, counters which would drop below zero are zeroed first
+    for field, delta in deltas.items():
+        if delta < 0:
+            queryset.filter(**{"%s__lt" % field: -delta}).update(**{field: 0})
+            queryset.filter(**{"%s__gte" % field: -delta}).update(**{field: F(field) + delta})
+        elif delta > 0:
+            queryset.update(**{field: F(field) + delta})
+
+
 class WorkerManager(models.Manager):
     """Custom query manager for Worker model."""
 
@@ -176,6 +409,54 @@ class WorkerManager(models.Manager):
         return self.filter(enabled=True, ready=True)
 
 
+    def add_load(self, worker_id, task_count, load):
+        """Atomically add to task count and current load of a worker and update its ready flag."""
+        if Case is None:
+            # Django < 1.8, update counters first and the ready flag from the new values
+            workers = self.filter(id=worker_id)
+            _add_to_counters(workers, task_count=task_count, current_load=load)
+            ready = Q(enabled=True, current_load__lt=F("max_load"), task_count__lt=F("max_load") * 3)
+            workers.filter(ready).update(ready=True)
+            workers.exclude(ready).update(ready=False)
+            return
+
+        # conditions are evaluated on values before the update
+        ready = Case(
+            When(Q(enabled=True, current_load__lt=F("max_load") - load, task_count__lt=F("max_load") * 3 - task_count), then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField(),
+        )
+        # counters change all the time, cached workers load them from the database (see refcache.register())
+        self.filter(id=worker_id).update(task_count=_add_to_counter("task_count", task_count), current_load=_add_to_counter("current_load", load), ready=ready)
+
+
+    def reconcile(self, worker_ids=None):
+        """Recompute task counts and loads of workers (all by default). Return list of fixed workers."""
+        workers = self.all()
+        opened = Task.objects.filter(state=TASK_STATES["OPEN"], worker__isnull=False).order_by()
+        if worker_ids is not None:
+            workers = workers.filter(id__in=worker_ids)
+            opened = opened.filter(worker__in=worker_ids)
+
+        counters = {}
+        for row in opened.values("worker").annotate(task_count=Count("id")):
+            counters[row["worker"]] = (row["task_count"], 0)
+        for row in opened.filter(waiting=False).values("worker").annotate(current_load=Sum("weight")):
+            counters[row["worker"]] = (counters[row["worker"]][0], row["current_load"] or 0)
+
+        result = []
+        with transaction.atomic():
+            for worker in workers.select_for_update().order_by("id"):
+                task_count, current_load = counters.get(worker.id, (0, 0))
+                if (worker.task_count, worker.current_load) != (task_count, current_load):
+                    self.add_load(worker.id, task_count - worker.task_count, current_load - worker.current_load)
+                    result.append(worker)
+                elif worker.ready != worker.compute_ready():
+                    self.add_load(worker.id, 0, 0)
+                    result.append(worker)
+        return result
+
+
 class Worker(models.Model):
     """Model for the hub_worker table."""
     worker_key          = models.CharField(max_length=255, unique=True, blank=True, help_text=_("Worker authentication key.<br />Leave blank to generate new key."))
@@ -195,24 +476,37 @@ class Worker(models.Model):
     # override default *objects* Manager
     objects = WorkerManager()
 
+    # maintained by WorkerManager.add_load(), not cached in kobo.hub.refcache
+    COUNTER_FIELDS = ("task_count", "current_load", "ready")
+
 
     def __unicode__(self):
         return u"%s" % self.name
 
 
     def save(self, *args, **kwargs):
-        # precompute task count, current load and ready
-        tasks = Task.objects.opened().filter(worker=self)
-        self.task_count = tasks.count()
-        self.current_load = sum(( task.weight for task in tasks if not task.waiting ))
-        self.ready = self.enabled and (self.current_load < self.max_load and self.task_count < 3*self.max_load)
+        # task count and current load are maintained by WorkerManager.add_load()
+        self.ready = self.compute_ready()
 
         while not self.worker_key:
             # if worker_key is empty, generate a new one
             key = random_string(64)
             if Worker.objects.filter(worker_key=key).count() == 0:
                 self.worker_key = key
+
+        if self._state.adding or kwargs.get("force_insert") or "update_fields" in kwargs:
+            super(self.__class__, self).save(*args, **kwargs)
+            return
+
+        # don't overwrite counters updated concurrently, recompute ready in the database instead
+        kwargs["update_fields"] = [ i.name for i in self._meta.concrete_fields if not i.primary_key and i.name not in self.COUNTER_FIELDS ]
         super(self.__class__, self).save(*args, **kwargs)
+        Worker.objects.add_load(self.id, 0, 0)
+
+
+    def compute_ready(self):
+        """Is the worker ready to take new tasks according to its counters?"""
+        return self.enabled and (self.current_load < self.max_load and self.task_count < 3*self.max_load)
 
 
     def export(self):
@@ -249,13 +543,20 @@ class Worker(models.Model):
         return Task.objects.assigned().filter(worker=self)
 
 
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # cached workers defer all counters, load them in a single query
+        if fields is not None and set(fields) & set(self.COUNTER_FIELDS):
+            fields = set(fields).union(set(self.COUNTER_FIELDS) & self.get_deferred_fields())
+        super(Worker, self).refresh_from_db(using=using, fields=fields, **kwargs)
+
+
     def update_worker(self, enabled, ready, task_count):
-        """Update worker attributes. Return worker_info.
+        """Return worker_info.
 
-        Update only if data provided from a worker differs.
+        Counters are maintained by the hub (see WorkerManager.add_load()),
+        values reported by the worker are not used. Counters which got out
+        of sync are fixed by the reconcile_counters command.
         """
-        if (self.enabled, self.ready, self.task_count) != (enabled, ready, task_count):
-            self.save()
         return self.export()
 
 
@@ -309,14 +610,399 @@ class TaskManager(models.Manager):
         """Return list of created tasks."""
         return self.filter(state=TASK_STATES["CREATED"]).order_by("-exclusive", "id")
 
+    def union_values(self, querysets, fields, limit):
+        """Evaluate several task querysets in a single UNION ALL query.
+
+        Each queryset is limited to *limit* rows. Return a list of lists
+        (one per queryset) of tuples with *fields* values. Databases do not
+        guarantee row order of a compound select, callers have to sort the rows.
+        """
+        result = [ [] for i in querysets ]
+        if not querysets:
+            return result
+
+        parts = []
+        params = []
+        columns = ", ".join(( "sq%%(num)d.%s" % connection.ops.quote_name(i) for i in fields ))
+        for num, queryset in enumerate(querysets):
+            sql, qs_params = queryset.values_list(*fields)[:limit].query.sql_with_params()
+            parts.append("SELECT %d, %s FROM (%s) sq%d" % (num, columns % {"num": num}, sql, num))
+            params.extend(qs_params)
+
+        cursor = connection.cursor()
+        cursor.execute(" UNION ALL ".join(parts), params)
+        for row in cursor.fetchall():
+            result[row[0]].append(tuple(row[1:]))
+        return result
+
+    def claim(self, worker_id, task_ids):
+        """Open free or assigned tasks on a worker in a single transaction.
+
+        Tasks which were taken by another worker in the meantime are skipped.
+        On PostgreSQL, rows locked by a concurrent claim are skipped as well
+        instead of waiting for the other transaction. Return list of opened task IDs.
+        """
+        task_ids = [ int(i) for i in task_ids ]
+        if not task_ids:
+            return []
+
+        # it is safe to pass initial states directly to query, they are integers
+        initial_states = ",".join(( "'%s'" % i for i in (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"]) ))
+        select_query = """
+SELECT
+  id
+FROM
+  hub_task
+WHERE
+  id in (%(task_ids)s)
+  and state in (%(initial_states)s)
+  and (worker_id is null or worker_id=%%s)
+FOR UPDATE SKIP LOCKED
+"""
+        update_query = """
+UPDATE
+  hub_task
+SET
+  state=%%s,
+  worker_id=%%s,
+  dt_started=%%s,
+  waiting=%%s
+WHERE
+  id in (%(task_ids)s)
+  and state in (%(initial_states)s)
+  and (worker_id is null or worker_id=%%s)
+"""
+        dt_started = datetime.datetime.now()
+
+        with transaction.atomic():
+            old_states = dict(self.filter(id__in=task_ids).values_list("id", "state"))
+            cursor = connection.cursor()
+            if connection.vendor == "postgresql":
+                query = select_query % { "task_ids": ",".join(["%s"] * len(task_ids)), "initial_states": initial_states }
+                cursor.execute(query, task_ids + [worker_id])
+                locked = set(( row[0] for row in cursor.fetchall() ))
+                opened = [ i for i in task_ids if i in locked ]
+                if opened:
+                    query = update_query % { "task_ids": ",".join(["%s"] * len(opened)), "initial_states": initial_states }
+                    cursor.execute(query, [TASK_STATES["OPEN"], worker_id, dt_started, False] + opened + [worker_id])
+            else:
+                # portable fallback: conditional update of each row, the database serializes writes
+                opened = []
+                query = update_query % { "task_ids": "%s", "initial_states": initial_states }
+                for task_id in task_ids:
+                    cursor.execute(query, (TASK_STATES["OPEN"], worker_id, dt_started, False, task_id, worker_id))
+                    if cursor.rowcount == 1:
+                        opened.append(task_id)
+
+            if opened:
+                load = self.filter(id__in=opened).aggregate(load=Sum("weight"))["load"]
+                Worker.objects.add_load(worker_id, len(opened), load or 0)
+                TaskEvent.objects.record([ (i, old_states.get(i), TASK_STATES["OPEN"], worker_id) for i in opened ])
+
+        return opened
+
+    def allocate_ids(self, count):
+        """Reserve count new task ids for explicit inserts, return them in ascending order.
+
+        Must run in a transaction; on databases without sequences the table
+        stays locked for inserts until the transaction ends.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [self.model._meta.db_table, count])
+            return sorted(( row[0] for row in cursor.fetchall() ))
+
+        if connection.vendor == "sqlite":
+            # the first write in a transaction takes the database write lock
+            cursor.execute("UPDATE %s SET id = id WHERE id IS NULL" % table)
+        last_ids = list(self.model._default_manager.select_for_update().order_by("-id").values_list("id", flat=True)[:1])
+        # ids of archived tasks must not be reused
+        last_ids.extend(TaskArchive.objects.order_by("-id").values_list("id", flat=True)[:1])
+        first_id = max(last_ids or [0]) + 1
+        return range(first_id, first_id + count)
+
+    def export_states(self, task_ids):
+        """Export states of tasks for watchers, much smaller than Task.export().
+
+        Return list of {"id", "parent", "method", "state", "state_label", "worker", "is_finished", "is_failed"} dicts.
+        """
+        result = []
+        workers = {None: None}
+        for chunk in _chunks(list(task_ids)):
+            for task_id, parent_id, method, state, worker_id in self.filter(id__in=chunk).order_by("id").values_list("id", "parent", "method", "state", "worker"):
+                if worker_id not in workers:
+                    worker = refcache.get(Worker, id=worker_id)
+                    workers[worker_id] = {"id": worker.id, "name": worker.name}
+                worker = workers[worker_id]
+                result.append({
+                    "id": task_id,
+                    "parent": parent_id,
+                    "method": method,
+                    "state": state,
+                    "state_label": TASK_STATES.get_value(state),
+                    "worker": worker,
+                    "is_finished": state in FINISHED_STATES,
+                    "is_failed": state in FAILED_STATES,
+                })
+        return result
+
+    def get_subtask_levels(self, task_id):
+        """Return IDs of all descendants of a task as a list of tree levels (children, grandchildren, ...)."""
+        if self._supports_recursive_query():
+            query = """
+WITH RECURSIVE tree(id, level) AS (
+  SELECT id, 1 FROM hub_task WHERE parent_id=%s
+  UNION ALL
+  SELECT hub_task.id, tree.level + 1 FROM hub_task JOIN tree ON hub_task.parent_id=tree.id
+)
+SELECT id, level FROM tree ORDER BY level, id
+"""
+            cursor = connection.cursor()
+            cursor.execute(query, [task_id])
+            levels = []
+            for subtask_id, level in cursor.fetchall():
+                if len(levels) < level:
+                    levels.append([])
+                levels[level - 1].append(subtask_id)
+            return levels
+
+        # walk the tree level by level
+        levels = []
+        parent_ids = [task_id]
+        while True:
+            subtask_ids = []
+            for chunk in _chunks(parent_ids):
+                subtask_ids.extend(self.filter(parent__in=chunk).order_by("id").values_list("id", flat=True))
+            if not subtask_ids:
+                return levels
+            levels.append(subtask_ids)
+            parent_ids = subtask_ids
+
+    def _supports_recursive_query(self):
+        if connection.vendor == "postgresql":
+            return True
+        if connection.vendor == "sqlite":
+            import sqlite3
+            return sqlite3.sqlite_version_info >= (3, 8, 3)
+        return False
+
+    def archivable(self, dt_before):
+        """Top-level finished tasks older than dt_before which can be moved to the archive.
+
+        Resubmitted tasks and tasks with logs waiting for compression stay in
+        hub_task until those are gone. Subtasks are archived together with
+        their top-level task, see TaskArchiveManager.archive().
+        """
+        return self._archivable_rows(dt_before).filter(parent__isnull=True)
+
+    def _archivable_rows(self, dt_before):
+        old = Q(dt_finished__lt=dt_before) | Q(dt_finished__isnull=True, dt_created__lt=dt_before)
+        return self.filter(old, state__in=FINISHED_STATES, resubmitted_from1__isnull=True, logcompression__isnull=True)
+
+    def reconcile_subtask_counts(self):
+        """Recompute subtask_count of all tasks. Return number of fixed tasks."""
+        query = """
+UPDATE
+  hub_task
+SET
+  subtask_count=(SELECT COUNT(*) FROM hub_task subtask WHERE subtask.parent_id=hub_task.id)
+WHERE
+  subtask_count<>(SELECT COUNT(*) FROM hub_task subtask WHERE subtask.parent_id=hub_task.id)
+"""
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(query)
+            return cursor.rowcount
+
+
+class TaskLogFile(object):
+    """Read-only log content read from the log file on demand.
+
+    Supports len(), slicing, iteration over lines, streaming reads and
+    comparison with strings without loading the whole log to memory.
+    The file is opened for each access and closed right after, no file
+    descriptor is held between accesses.
+
+    For compatibility, the string methods listed in STR_METHODS work on
+    the full content and emit a DeprecationWarning since they load the
+    whole log to memory; logs up to LOG_BUFFER_SIZE bytes are kept in
+    memory once read. Use str() where a real string is required, e.g.
+    for isinstance(log, basestring) checks.
+    """
+
+    STR_METHODS = (
+        "count", "decode", "encode", "endswith", "find", "index", "lower",
+        "lstrip", "replace", "rfind", "rstrip", "split", "splitlines",
+        "startswith", "strip", "upper",
+    )
+
+    def __init__(self, opener, size=None):
+        self._opener = opener
+        self._size = size
+        self._content = None
+
+    def __len__(self):
+        if self._size is None:
+            # plain gzip, count the uncompressed data
+            self._size = sum(len(i) for i in self.iter_chunks())
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            data = self.read(start, max(stop - start, 0))
+            if step != 1:
+                data = data[::step]
+            return data
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("log index out of range")
+        return self.read(key, 1)
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(start, stop))
+
+    def __iter__(self):
+        """Iterate over lines."""
+        if self._content is not None:
+            for line in self._content.splitlines(True):
+                yield line
+            return
+
+        log_file = self._opener()
+        try:
+            while True:
+                line = log_file.readline(LOG_BUFFER_SIZE)
+                if not line:
+                    break
+                yield line
+        finally:
+            log_file.close()
+
+    def __eq__(self, other):
+        if isinstance(other, TaskLogFile):
+            other = str(other)
+        if isinstance(other, unicode):
+            other = other.encode("utf-8")
+        if not isinstance(other, str):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        if len(self) <= LOG_BUFFER_SIZE:
+            return str(self) == other
+        offset = 0
+        for chunk in self.iter_chunks():
+            if other[offset:offset + len(chunk)] != chunk:
+                return False
+            offset += len(chunk)
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __str__(self):
+        if self._content is not None:
+            return self._content
+        content = self.read()
+        if len(content) <= LOG_BUFFER_SIZE:
+            self._content = content
+        return content
+
+    def __repr__(self):
+        return "<%s: %s bytes>" % (self.__class__.__name__, len(self))
+
+    def __getattr__(self, name):
+        # compatibility with code expecting the log as a string
+        if name not in self.STR_METHODS:
+            raise AttributeError(name)
+        warnings.warn("TaskLogFile.%s() reads the whole log to memory, use read(), iter_chunks() or iteration over lines instead" % name, DeprecationWarning, stacklevel=2)
+        return getattr(str(self), name)
+
+    def read(self, offset=0, length=-1):
+        """Read length bytes (all if negative) from offset."""
+        if self._content is not None:
+            return self._content[offset:] if length < 0 else self._content[offset:offset + length]
+        log_file = self._opener()
+        try:
+            log_file.seek(offset)
+            return log_file.read(length)
+        finally:
+            log_file.close()
+
+    def iter_chunks(self, offset=0, chunk_size=LOG_BUFFER_SIZE):
+        """Iterate over chunks of the log starting at offset."""
+        if self._content is not None:
+            for i in xrange(offset, len(self._content), chunk_size):
+                yield self._content[i:i + chunk_size]
+            return
+
+        log_file = self._opener()
+        try:
+            log_file.seek(offset)
+            while True:
+                data = log_file.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            log_file.close()
+
+
+class _LogWriter(object):
+    """Write a log to a temporary file, replace the log on close().
+
+    Readers of the old log (including the value being saved) are not
+    affected until the new content is complete.
+    """
+
+    def __init__(self, log_path, mode):
+        self._log_path = log_path
+        fd, self._tmp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(log_path), suffix=LOG_TMP_SUFFIX, dir=os.path.dirname(log_path))
+        os.fchmod(fd, mode)
+        self._file = os.fdopen(fd, "wb")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.rename(self._tmp_path, self._log_path)
+
+    def discard(self):
+        """Close the file and remove it, the log stays unchanged."""
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except OSError:
+            pass
+
 
 class TaskLogs(object):
-    """Task log wrapper."""
+    """Task log wrapper.
+
+    Logs are returned as TaskLogFile objects reading the files on demand.
+    Assigned values may be strings, file objects or iterables of chunks,
+    they are streamed to disk on save().
+    """
 
     def __init__(self, task_obj):
         self.cache = {}
         self.changed = {} # changed logs, will be written on save()
         self.task = task_obj
+        self._manifest = None
 
     def _get_absolute_log_path(self, name):
         task_dir = self.task.task_dir(self.task.id)
@@ -337,6 +1023,11 @@ class TaskLogs(object):
         if os.path.isfile(log_path):
             return io.open(log_path, 'rb', LOG_BUFFER_SIZE)
         elif os.path.isfile(log_path + ".gz"):
+            index = _read_gzip_index(log_path + ".gz")
+            if index is not None:
+                return _IndexedGzipReader(log_path + ".gz", index)
+
+            # plain gzip: seeking decompresses from the start
             out = gzip.open(log_path + ".gz", "rb")
 
             # GZipFile was not usable with BufferedReader
@@ -397,13 +1088,64 @@ class TaskLogs(object):
             if log_file is not None:
                 log_file.close()
 
+    def write_chunk(self, name, file_obj, offset=None, checksum=None, mode=0644):
+        """Stream data from file_obj into a log, return the new log size.
+
+        offset   -- truncate the log at offset before writing; append if None
+        checksum -- optional sha256 hex digest of the data; on mismatch the
+                    log is truncated back and ValueError is raised
+        """
+        name = self._get_relative_log_path(name)
+        log_path = self._get_absolute_log_path(name)
+        log_dir = os.path.dirname(log_path)
+        if not os.path.isdir(log_dir):
+            try:
+                os.makedirs(log_dir, mode=0755)
+            except OSError, ex:
+                if ex.errno != 17:
+                    raise
+
+        fd = os.open(log_path, os.O_RDWR | os.O_CREAT, mode)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            if offset is not None:
+                if offset > size:
+                    raise ValueError("Offset %s is beyond the end of the log (%s bytes)." % (offset, size))
+                os.ftruncate(fd, offset)
+                size = os.lseek(fd, 0, os.SEEK_END)
+
+            start = size
+            sha256 = hashlib.sha256()
+            while True:
+                data = file_obj.read(LOG_BUFFER_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                while data:
+                    written = os.write(fd, data)
+                    data = data[written:]
+                    size += written
+
+            if checksum is not None and checksum.lower() != sha256.hexdigest():
+                os.ftruncate(fd, start)
+                raise ValueError("Chunk checksum doesn't match.")
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        self.cache.pop(name, None)
+        self._manifest = None
+        if start == 0:
+            # a new log, appended data is picked up by stat() in manifest
+            self.update_manifest([name])
+        return size
+
     def __getitem__(self, name):
-        """Get full content of named log, as a byte string.
+        """Get content of named log as a TaskLogFile, "" if there's no such log.
 
-        This method reads (and caches) the entire uncompressed content of the
-        log file, thus may cause memory issues if log files are expected to
-        be large.  To limit the amount of memory used at once, use the
-        get_chunk method instead."""
+        The content isn't loaded to memory, the log is read when accessed.
+        Values set by __setitem__ and not saved yet are returned unchanged."""
 
         name = self._get_relative_log_path(name)
         if name not in self.cache:
@@ -411,13 +1153,9 @@ class TaskLogs(object):
             if self.task.id is None:
                 return ""
 
-            log_path = self._get_absolute_log_path(name)
-            if os.path.isfile(log_path):
-                self.cache[name] = "\n".join(read_from_file(log_path))
-            elif os.path.isfile(log_path + ".gz"):
-                fo = gzip.open(log_path + ".gz", "rb")
-                self.cache[name] = fo.read()
-                fo.close()
+            entry = self._stat_log(name)
+            if entry is not None:
+                self.cache[name] = TaskLogFile(lambda: self._open_log(name), entry["size"])
             else:
                 self.cache[name] = ""
             self.changed[name] = False
@@ -429,33 +1167,192 @@ class TaskLogs(object):
         self.cache[name] = value
         self.changed[name] = True
 
+    def writer(self, name, mode=None):
+        """Return a file object writing the named log.
+
+        The content replaces the log when the file object is closed.
+        The default mode is 0600 for traceback logs, 0644 otherwise."""
+        name = self._get_relative_log_path(name)
+        log_path = self._get_absolute_log_path(name)
+        if mode is None:
+            mode = os.path.basename(name).startswith("traceback") and 0600 or 0644
+        log_dir = os.path.dirname(log_path)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir, mode=0755)
+        out = _LogWriter(log_path, mode)
+        self.cache.pop(name, None)
+        self.changed.pop(name, None)
+        return out
+
+    def _write_log(self, name, value):
+        """Stream a string, a file object or an iterable of chunks to a log."""
+        if isinstance(value, TaskLogFile):
+            value = value.iter_chunks()
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+        elif hasattr(value, "read"):
+            value = iter(lambda read=value.read: read(LOG_BUFFER_SIZE), "")
+
+        out = self.writer(name)
+        try:
+            if isinstance(value, str):
+                out.write(value)
+            else:
+                for chunk in value:
+                    if isinstance(chunk, unicode):
+                        chunk = chunk.encode("utf-8")
+                    out.write(chunk)
+        except:
+            out.discard()
+            raise
+        out.close()
+
     def save(self):
-        for log in self.cache:
+        saved = []
+        for log in list(self.cache):
             if not self.changed.get(log, True):
                 continue
-            log_path = self._get_absolute_log_path(log)
-            if os.path.basename(log).startswith("traceback"):
-                mode = 0600
-            else:
-                mode = 0644
-            save_to_file(log_path, self.cache[log], mode=mode)
-            self.changed[log] = False
+            self._write_log(log, self.cache[log])
+            saved.append(log)
+        if saved:
+            self.update_manifest(saved)
 
-    @property
-    def list(self):
+    def _get_manifest_path(self):
+        return os.path.join(self.task.task_dir(), LOG_MANIFEST_NAME)
+
+    def _walk_logs(self):
+        """Return names of logs on disk."""
         result = []
+        task_dir = self.task.task_dir()
+        if not task_dir.endswith("/"):
+            task_dir += "/"
+
+        for root, dirs, files in os.walk(task_dir):
+            for i in files:
+                if i.endswith(".log.gz.idx"):
+                    continue
+                if i.startswith(".") and i.endswith(LOG_TMP_SUFFIX):
+                    # log being written
+                    continue
+                if i.endswith(".log.gz"):
+                    i = i[:-3]
+                name = os.path.join(root, i)[len(task_dir):]
+                if name != LOG_MANIFEST_NAME:
+                    result.append(name)
+        return result
+
+    def _stat_log(self, name):
+        """Return manifest entry of a log on disk or None if it doesn't exist.
+
+        Size is the uncompressed size, None for gzip logs without an index.
+        """
+        log_path = os.path.join(self.task.task_dir(), name)
+        try:
+            stat = os.stat(log_path)
+            return {"size": stat.st_size, "compressed": False, "mtime": int(stat.st_mtime)}
+        except OSError:
+            pass
+        try:
+            stat = os.stat(log_path + ".gz")
+        except OSError:
+            return None
+        index = _read_gzip_index(log_path + ".gz")
+        return {"size": index and index[-1][0] or None, "compressed": True, "mtime": int(stat.st_mtime)}
+
+    def _load_manifest(self):
+        """Return ({name: entry}, final) from the manifest file, (None, False) if it's missing or broken."""
+        try:
+            fo = open(self._get_manifest_path(), "rb")
+        except IOError:
+            return None, False
+        try:
+            data = json.loads(fo.read())
+            return data["logs"], data.get("final", False)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None, False
+        finally:
+            fo.close()
+
+    @property
+    def manifest(self):
+        """Return {log name: {"size": .., "compressed": .., "mtime": ..}} of logs on disk.
+
+        The manifest lists the logs, it's updated when a log is added and
+        built once for tasks created by older hubs. Sizes of logs of running
+        tasks are refreshed by stat(), final sizes are saved once the task
+        is finished.
+        """
+        if self.task.id is None:
+            return {}
+        if self._manifest is not None:
+            return self._manifest
+
+        result, final = self._load_manifest()
+        if result is None or (not final and self.task.state in FINISHED_STATES):
+            if not os.path.isdir(self.task.task_dir()):
+                return {}
+            result = self.update_manifest(result or (), rebuild=result is None)
+        elif not final:
+            for name in list(result):
+                entry = self._stat_log(name)
+                if entry is None:
+                    del result[name]
+                else:
+                    result[name] = entry
+        self._manifest = result
+        return result
+
+    def update_manifest(self, names=(), rebuild=False):
+        """Update manifest entries of logs, return the manifest.
+
+        A missing manifest is built from the logs on disk, rebuild forces it.
+        """
+        names = [ self._get_relative_log_path(i) for i in names ]
+        manifest_path = self._get_absolute_log_path(LOG_MANIFEST_NAME)
+        fd = os.open(manifest_path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            data = []
+            while True:
+                chunk = os.read(fd, LOG_BUFFER_SIZE)
+                if not chunk:
+                    break
+                data.append(chunk)
+            try:
+                result = json.loads("".join(data))["logs"]
+            except (ValueError, KeyError, TypeError):
+                result = None
+
+            if result is None or rebuild:
+                result = {}
+                names = self._walk_logs() + names
+
+            for name in names:
+                entry = self._stat_log(name)
+                if entry is None:
+                    result.pop(name, None)
+                else:
+                    result[name] = entry
 
-        if self.task.id is not None:
-            task_dir = self.task.task_dir()
-            if not task_dir.endswith("/"):
-                task_dir += "/"
+            data = json.dumps({"logs": result, "final": self.task.state in FINISHED_STATES}, sort_keys=True)
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._manifest = None
+        return result
 
-            # logs on disk
-            for root, dirs, files in os.walk(task_dir):
-                for i in files:
-                    if i.endswith(".log.gz"):
-                        i = i[:-3]
-                    result.append(os.path.join(root, i)[len(task_dir):])
+    def get_log_info(self, name):
+        """Return manifest entry of a log or None."""
+        return self.manifest.get(self._get_relative_log_path(name))
+
+    @property
+    def list(self):
+        # logs on disk
+        result = sorted(self.manifest)
 
         # cached logs
         for log in self.cache:
@@ -465,21 +1362,37 @@ class TaskLogs(object):
         return result
 
     def _gzip_log(self, name):
-        """gzip one log, do *not* throw any error on failure"""
+        """gzip one log, do *not* throw any error on failure
+
+        Return size of the uncompressed log, 0 if the log wasn't compressed.
+        """
 
         # compress only log files
         if not name.endswith(".log"):
-            return
+            return 0
 
-        import pipes
         path = self._get_absolute_log_path(name)
-        if not os.path.isfile(path + ".gz"):
-            run("gzip %s" % pipes.quote(path), can_fail=True, stdout=False)
+        if os.path.isfile(path + ".gz") or not os.path.isfile(path):
+            return 0
+
+        try:
+            return _gzip_file(path)
+        except (IOError, OSError), ex:
+            logger.error("Cannot compress log %s: %s", path, ex)
+            return 0
 
     def gzip_logs(self):
-        """gzip all task logs"""
+        """gzip all task logs, return count and total size of compressed logs"""
+        count = 0
+        size = 0
         for i in self.list:
-            self._gzip_log(i)
+            log_size = self._gzip_log(i)
+            if log_size:
+                count += 1
+                size += log_size
+        if self.task.id is not None and os.path.isdir(self.task.task_dir()):
+            self.update_manifest(rebuild=True)
+        return count, size
 
 
 class Task(models.Model):
@@ -524,6 +1437,10 @@ class Task(models.Model):
         permissions = (
             ("can_see_traceback", _("Can see traceback")),
         )
+        # indexes for free tasks ordered by priority are created in migration 0005_task_indexes
+        index_together = (
+            ("worker", "state"),
+        )
 
     def __init__(self, *args, **kwargs):
         self.logs = TaskLogs(self)
@@ -536,6 +1453,8 @@ class Task(models.Model):
             self.logs["stdout.log"] = stdout
 
         super(Task, self).__init__(*args, **kwargs)
+        self._loaded = self._get_counted_values()
+        self._loaded_state = self.state
 
     def __unicode__(self):
         if self.parent:
@@ -543,33 +1462,62 @@ class Task(models.Model):
         return u"#%s [method: %s, state: %s, worker: %s]" % (self.id, self.method, self.get_state_display(), self.worker)
 
     def save(self, *args, **kwargs):
-        # save to db to precalculate subtask counts and obtain an ID (on insert) for stdout and traceback
-        self.subtask_count = self.subtasks().count()
-        super(self.__class__, self).save()
+        # save to db to obtain an ID (on insert) for stdout and traceback
+        if self._state.adding or kwargs.get("force_insert"):
+            old = (None, None, 0, 0)
+            old_state = None
+        else:
+            old = self._loaded
+            old_state = self._loaded_state
+            if "update_fields" not in kwargs:
+                # subtask_count is maintained incrementally, don't overwrite it
+                kwargs["update_fields"] = [ i.name for i in self._meta.concrete_fields if not i.primary_key and i.name != "subtask_count" ]
+
+        with transaction.atomic():
+            super(self.__class__, self).save(*args, **kwargs)
+            self._update_counters(old, self._get_counted_values())
+            if old_state != self.state:
+                TaskEvent.objects.record([(self.id, old_state, self.state, self.worker_id)])
+                self._loaded_state = self.state
         self.logs.save()
-        if self.parent:
-            self.parent.save(*args, **kwargs)
+
+    def _get_counted_values(self):
+        """Return (parent_id, worker_id, task_count, load) values this task adds to denormalized counters."""
+        if self.state == TASK_STATES["OPEN"] and self.worker_id is not None:
+            return (self.parent_id, self.worker_id, 1, 0 if self.waiting else self.weight)
+        return (self.parent_id, None, 0, 0)
+
+    def _update_counters(self, old, new):
+        """Update parent's subtask_count and worker's task count and load when a task changes."""
+        self._loaded = new
+        if self.id is None:
+            return
+
+        old_parent_id, old_worker_id, old_task_count, old_load = old
+        new_parent_id, new_worker_id, new_task_count, new_load = new
+
+        if old_parent_id != new_parent_id:
+            if old_parent_id is not None:
+                _add_to_counters(Task.objects.filter(id=old_parent_id), subtask_count=-1)
+            if new_parent_id is not None:
+                _add_to_counters(Task.objects.filter(id=new_parent_id), subtask_count=1)
+
+        if old_worker_id == new_worker_id:
+            if old_worker_id is not None and (old_task_count, old_load) != (new_task_count, new_load):
+                Worker.objects.add_load(old_worker_id, new_task_count - old_task_count, new_load - old_load)
+            return
+
+        if old_worker_id is not None:
+            Worker.objects.add_load(old_worker_id, -old_task_count, -old_load)
+        if new_worker_id is not None:
+            Worker.objects.add_load(new_worker_id, new_task_count, new_load)
 
     @classmethod
     def get_task_dir(cls, task_id, create=False):
         '''Task files (logs, etc.) are saved in TASK_DIR in following structure based on task_id:
         TASK_DIR/millions/tens_of_thousands/task_id/*
         '''
-        task_id = int(task_id)
-        third = task_id
-        second = task_id // 10000 * 10000
-        first = task_id // 1000000 * 1000000
-
-        task_dir = os.path.abspath(settings.TASK_DIR)
-        path = os.path.join(task_dir, str(first), str(second), str(third))
-        path = os.path.abspath(path)
-        if not path.startswith(task_dir):
-            raise Exception('Possible hack, trying to read path "%s"' % path)
-
-        if create and not os.path.isdir(path):
-            os.makedirs(path, mode=0755)
-
-        return path
+        return _get_task_dir(settings.TASK_DIR, task_id, create)
 
     def task_dir(self, create=False):
         return Task.get_task_dir(self.id, create)
@@ -577,37 +1525,92 @@ class Task(models.Model):
     @classmethod
     def create_task(cls, owner_name, label, method, args=None, comment=None, parent_id=None, worker_name=None, arch_name="noarch", channel_name="default", timeout=None, priority=10, weight=1, exclusive=False, resubmitted_by=None, resubmitted_from=None, state=None):
         """Create a new task."""
+        task = cls._new_task(owner_name, label, method, args=args, comment=comment, worker_name=worker_name, arch_name=arch_name, channel_name=channel_name, timeout=timeout, priority=priority, weight=weight, exclusive=exclusive, resubmitted_by=resubmitted_by, resubmitted_from=resubmitted_from, state=state)
+
+        if parent_id is not None:
+            task.parent = cls.objects.get(id=parent_id)
+
+        # TODO: unsupported in Django 1.0
+        #task.validate()
+        task.save()
+        if task.state in (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"]):
+            wakeup.notify()
+        return task.id
+
+    @classmethod
+    def create_tasks(cls, kwargs_list):
+        """Create new tasks in bulk, kwargs are the same as in create_task(). Return list of task ids in the same order.
+
+        All tasks are validated before anything is inserted.
+        """
+        tasks = [ cls._new_task(**kwargs) for kwargs in kwargs_list ]
+        if not tasks:
+            return []
+
+        parent_ids = set(( i.parent_id for i in tasks if i.parent_id is not None ))
+        found_ids = set()
+        for chunk in _chunks(list(parent_ids)):
+            found_ids.update(cls.objects.filter(id__in=chunk).values_list("id", flat=True))
+        if parent_ids - found_ids:
+            raise cls.DoesNotExist("Parent task(s) don't exist: %s" % ", ".join(( str(i) for i in sorted(parent_ids - found_ids) )))
+
+        with transaction.atomic():
+            task_ids = cls.objects.allocate_ids(len(tasks))
+            for task, task_id in zip(tasks, task_ids):
+                task.id = task_id
+            cls.objects.bulk_create(tasks)
+
+            # bulk_create() doesn't call save(), update the counters once per parent and worker
+            subtask_counts = {}
+            worker_loads = {}
+            TaskEvent.objects.record([ (task.id, None, task.state, task.worker_id) for task in tasks ])
+            for task in tasks:
+                task._loaded = task._get_counted_values()
+                task._loaded_state = task.state
+                parent_id, worker_id, task_count, load = task._loaded
+                if parent_id is not None:
+                    subtask_counts[parent_id] = subtask_counts.get(parent_id, 0) + 1
+                if worker_id is not None:
+                    old_count, old_load = worker_loads.get(worker_id, (0, 0))
+                    worker_loads[worker_id] = (old_count + task_count, old_load + load)
+
+            for parent_id, count in subtask_counts.iteritems():
+                _add_to_counters(cls.objects.filter(id=parent_id), subtask_count=count)
+            for worker_id, (task_count, load) in worker_loads.iteritems():
+                Worker.objects.add_load(worker_id, task_count, load)
+
+        if [ i for i in tasks if i.state in (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"]) ]:
+            wakeup.notify()
+        return task_ids
+
+    @classmethod
+    def _new_task(cls, owner_name, label, method, args=None, comment=None, parent_id=None, worker_name=None, arch_name="noarch", channel_name="default", timeout=None, priority=10, weight=1, exclusive=False, resubmitted_by=None, resubmitted_from=None, state=None):
+        """Return a new unsaved task. Existence of parent_id is not checked."""
         task = cls()
-        task.owner = get_user_model().objects.get(username=owner_name)
+        task.owner = refcache.get(get_user_model(), username=owner_name)
         task.label = label
         task.method = method
         task.args = args or {}
         task.comment = comment
-
-        if parent_id is not None:
-            task.parent = cls.objects.get(id=parent_id)
+        task.parent_id = parent_id
 
         if state is not None:
             task.state = state
 
         if worker_name is not None:
-            task.worker = Worker.objects.get(name=worker_name)
+            task.worker = refcache.get(Worker, name=worker_name)
             task.state = TASK_STATES["ASSIGNED"]
 
         task.resubmitted_by = resubmitted_by
         task.resubmitted_from = resubmitted_from
 
-        task.arch = Arch.objects.get(name=arch_name)
-        task.channel = Channel.objects.get(name=channel_name)
+        task.arch = refcache.get(Arch, name=arch_name)
+        task.channel = refcache.get(Channel, name=channel_name)
         task.priority = priority
         task.timeout = timeout
         task.weight = weight
         task.exclusive = exclusive
-
-        # TODO: unsupported in Django 1.0
-        #task.validate()
-        task.save()
-        return task.id
+        return task
 
     @classmethod
     def create_shutdown_task(cls, owner_name, worker_name, kill=False):
@@ -645,6 +1648,9 @@ class Task(models.Model):
 
     def export(self, flat=True):
         """Export data for xml-rpc."""
+        if not flat:
+            # worker, parent and subtasks are exported in a few queries
+            return export_tasks([self], flat=False)[0]
 
         result = {
             "id": self.id,
@@ -671,7 +1677,7 @@ class Task(models.Model):
             "weight": self.weight,
 
             "resubmitted_by": getattr(self.resubmitted_by, "username", None),
-            "resubmitted_from": getattr(self.resubmitted_from, "id", None),
+            "resubmitted_from": self.resubmitted_from_id,
 
             # used by task watcher
             "state_label": self.get_state_display(),
@@ -679,15 +1685,6 @@ class Task(models.Model):
             "is_failed": self.is_failed(),
         }
 
-        if not flat:
-            result.update({
-                "worker": self.worker and self.worker.export() or None,
-                "parent": self.parent and self.parent.export() or None,
-                "arch": self.arch.export(),
-                "channel": self.channel.export(),
-                "subtask_id_list": [ i.id for i in self.subtasks() ],
-            })
-
         return result
 
     def subtasks(self):
@@ -758,6 +1755,9 @@ WHERE
         waiting = False
 
         with transaction.atomic():
+            # lock the row and read values counted in worker's task count and load
+            old_values = list(Task.objects.select_for_update().filter(id=self.id).values_list("state", "worker", "weight", "waiting"))
+
             cursor = connection.cursor()
             cursor.execute(query, (new_state, new_worker_id, dt_started, dt_finished, waiting, self.id, worker_id))
 
@@ -771,12 +1771,29 @@ WHERE
             if cursor.rowcount > 1:
                 raise MultipleObjectsReturned()
 
+            old_state, old_worker_id, weight, old_waiting = old_values[0]
+            TaskEvent.objects.record([(self.id, old_state, new_state, new_worker_id)])
+            old = (self.parent_id, None, 0, 0)
+            if old_state == TASK_STATES["OPEN"] and old_worker_id is not None:
+                old = (self.parent_id, old_worker_id, 1, 0 if old_waiting else weight)
+            new = (self.parent_id, None, 0, 0)
+            if new_state == TASK_STATES["OPEN"]:
+                new = (self.parent_id, new_worker_id, 1, weight)
+            self._update_counters(old, new)
+
         self.dt_started = dt_started
         self.dt_finished = dt_finished
         if new_worker_id is not None:
-            self.worker = Worker.objects.get(id=new_worker_id)
+            self.worker = refcache.get(Worker, id=new_worker_id)
         self.state = new_state
         self.waiting = waiting
+        self.weight = weight
+        self._loaded = self._get_counted_values()
+        self._loaded_state = new_state
+
+        if new_state in (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"]) or (new_state in FINISHED_STATES and self.awaited):
+            # new work is available or a waiting parent can continue
+            wakeup.notify()
 
     def free_task(self):
         """Free the task."""
@@ -816,60 +1833,96 @@ WHERE
             self.__lock(self.worker_id, new_state=TASK_STATES["CLOSED"], initial_states=(TASK_STATES["OPEN"], ))
         except (MultipleObjectsReturned, ObjectDoesNotExist):
             raise Exception("Cannot close task %d, state is %s" % (self.id, self.get_state_display()))
-        self.logs.gzip_logs()
+        compress_task_logs([self.id])
+
+    def _lock_subtasks(self, new_state, initial_states):
+        """Set state of all descendants in initial_states.
+
+        Use a single UPDATE per tree level (per chunk of IDs on huge levels)
+        instead of locking the tasks one by one. Return list of changed task IDs.
+        """
+        dt_finished = datetime.datetime.now()
+        result = []
+        for level in Task.objects.get_subtask_levels(self.id):
+            for chunk in _chunks(level):
+                # lock the rows and read values counted in workers' task count and load
+                rows = Task.objects.select_for_update().filter(id__in=chunk, state__in=initial_states).values_list("id", "state", "worker", "weight", "waiting")
+                task_ids = []
+                events = []
+                loads = {}
+                for task_id, state, worker_id, weight, waiting in rows:
+                    task_ids.append(task_id)
+                    events.append((task_id, state, new_state, worker_id))
+                    if state == TASK_STATES["OPEN"] and worker_id is not None:
+                        task_count, load = loads.get(worker_id, (0, 0))
+                        loads[worker_id] = (task_count + 1, load + (0 if waiting else weight))
+
+                if not task_ids:
+                    continue
+                Task.objects.filter(id__in=task_ids, state__in=initial_states).update(state=new_state, dt_finished=dt_finished, waiting=False)
+                TaskEvent.objects.record(events)
+                for worker_id, (task_count, load) in loads.iteritems():
+                    Worker.objects.add_load(worker_id, -task_count, -load)
+                result.extend(task_ids)
+
+        return result
 
-    @transaction.atomic
     def cancel_task(self, user=None, recursive=True):
         """Cancel the task."""
         if user is not None and not user.is_superuser:
             if self.owner.username != user.username:
                 raise Exception("You are not task owner or superuser.")
 
-        try:
-            self.__lock(self.worker_id, new_state=TASK_STATES["CANCELED"], initial_states=(TASK_STATES["FREE"], TASK_STATES["ASSIGNED"], TASK_STATES["OPEN"], TASK_STATES["CREATED"]))
-        except (MultipleObjectsReturned, ObjectDoesNotExist):
-            raise Exception("Cannot cancel task %d, state is %s" % (self.id, self.get_state_display()))
+        initial_states = (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"], TASK_STATES["OPEN"], TASK_STATES["CREATED"])
+        task_ids = [self.id]
+        with transaction.atomic():
+            try:
+                self.__lock(self.worker_id, new_state=TASK_STATES["CANCELED"], initial_states=initial_states)
+            except (MultipleObjectsReturned, ObjectDoesNotExist):
+                raise Exception("Cannot cancel task %d, state is %s" % (self.id, self.get_state_display()))
 
-        if recursive:
-            for task in self.subtasks():
-                task.cancel_task(recursive=True)
-        self.logs.gzip_logs()
+            if recursive:
+                task_ids.extend(self._lock_subtasks(TASK_STATES["CANCELED"], initial_states))
+        compress_task_logs(task_ids)
 
     def cancel_subtasks(self):
-        """Cancel all subtasks of the task."""
-        result = True
-        for task in self.subtasks():
-            try:
-                result &= task.cancel_task()
-            except (MultipleObjectsReturned, ObjectDoesNotExist):
-                result = False
-        return result
+        """Cancel all subtasks of the task.
+
+        Return True if all subtasks were canceled, False if some of them
+        were already finished and were left unchanged.
+        """
+        initial_states = (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"], TASK_STATES["OPEN"], TASK_STATES["CREATED"])
+        with transaction.atomic():
+            task_ids = self._lock_subtasks(TASK_STATES["CANCELED"], initial_states)
+            subtask_count = sum(len(level) for level in Task.objects.get_subtask_levels(self.id))
+        compress_task_logs(task_ids)
+        return len(task_ids) == subtask_count
 
-    @transaction.atomic
     def interrupt_task(self, recursive=True):
         """Set the task state to interrupted."""
-        try:
-            self.__lock(self.worker_id, new_state=TASK_STATES["INTERRUPTED"], initial_states=(TASK_STATES["OPEN"], ))
-        except (MultipleObjectsReturned, ObjectDoesNotExist):
-            raise Exception("Cannot interrupt task %d, state is %s" % (self.id, self.get_state_display()))
+        task_ids = [self.id]
+        with transaction.atomic():
+            try:
+                self.__lock(self.worker_id, new_state=TASK_STATES["INTERRUPTED"], initial_states=(TASK_STATES["OPEN"], ))
+            except (MultipleObjectsReturned, ObjectDoesNotExist):
+                raise Exception("Cannot interrupt task %d, state is %s" % (self.id, self.get_state_display()))
 
-        if recursive:
-            for task in self.subtasks():
-                task.interrupt_task(recursive=True)
-        self.logs.gzip_logs()
+            if recursive:
+                task_ids.extend(self._lock_subtasks(TASK_STATES["INTERRUPTED"], (TASK_STATES["OPEN"], )))
+        compress_task_logs(task_ids)
 
-    @transaction.atomic
     def timeout_task(self, recursive=True):
         """Set the task state to timeout."""
-        try:
-            self.__lock(self.worker_id, new_state=TASK_STATES["TIMEOUT"], initial_states=(TASK_STATES["OPEN"], ))
-        except (MultipleObjectsReturned, ObjectDoesNotExist):
-            raise Exception("Cannot interrupt task %d, state is %s" % (self.id, self.get_state_display()))
+        task_ids = [self.id]
+        with transaction.atomic():
+            try:
+                self.__lock(self.worker_id, new_state=TASK_STATES["TIMEOUT"], initial_states=(TASK_STATES["OPEN"], ))
+            except (MultipleObjectsReturned, ObjectDoesNotExist):
+                raise Exception("Cannot interrupt task %d, state is %s" % (self.id, self.get_state_display()))
 
-        if recursive:
-            for task in self.subtasks():
-                task.interrupt_task(recursive=True)
-        self.logs.gzip_logs()
+            if recursive:
+                task_ids.extend(self._lock_subtasks(TASK_STATES["INTERRUPTED"], (TASK_STATES["OPEN"], )))
+        compress_task_logs(task_ids)
 
     @transaction.atomic
     def fail_task(self, task_result=""):
@@ -882,7 +1935,7 @@ WHERE
             self.__lock(self.worker_id, new_state=TASK_STATES["FAILED"], initial_states=(TASK_STATES["OPEN"], ))
         except (MultipleObjectsReturned, ObjectDoesNotExist):
             raise Exception("Cannot fail task %i, state is %s" % (self.id, self.get_state_display()))
-        self.logs.gzip_logs()
+        compress_task_logs([self.id])
 
     def is_finished(self):
         """Is the task finished? Task state can be one of: closed, interrupted, canceled, failed."""
@@ -992,6 +2045,371 @@ WHERE
         return [finished, unfinished]
 
 
+def export_tasks(tasks, flat=True):
+    """Export a list of tasks (or a queryset) for xml-rpc.
+
+    Return the same data as [ task.export(flat=flat) for task in tasks ],
+    but use a constant number of queries regardless of the task count:
+    related objects are fetched in bulk and exported once.
+    """
+    if isinstance(tasks, models.query.QuerySet):
+        tasks = tasks.select_related("owner", "resubmitted_by", "arch", "channel")
+    tasks = list(tasks)
+
+    result = [ task.export(flat=True) for task in tasks ]
+    if flat or not tasks:
+        return result
+
+    subtask_dict = {}
+    for task_ids in _chunks([ i.id for i in tasks ]):
+        for parent_id, task_id in Task.objects.filter(parent__in=task_ids).order_by("-id").values_list("parent", "id"):
+            subtask_dict.setdefault(parent_id, []).append(task_id)
+
+    worker_dict = {}
+    for worker_ids in _chunks(list(set(( i.worker_id for i in tasks if i.worker_id is not None )))):
+        for worker in Worker.objects.filter(id__in=worker_ids).prefetch_related("arches", "channels"):
+            worker_dict[worker.id] = worker.export()
+
+    parent_dict = {}
+    for parent_ids in _chunks(list(set(( i.parent_id for i in tasks if i.parent_id is not None )))):
+        for parent in Task.objects.filter(id__in=parent_ids).select_related("owner", "resubmitted_by"):
+            parent_dict[parent.id] = parent.export()
+
+    arch_dict = {}
+    channel_dict = {}
+    for task in tasks:
+        if task.arch_id not in arch_dict:
+            arch_dict[task.arch_id] = task.arch.export()
+        if task.channel_id not in channel_dict:
+            channel_dict[task.channel_id] = task.channel.export()
+
+    for task, task_info in zip(tasks, result):
+        task_info.update({
+            "worker": worker_dict.get(task.worker_id),
+            "parent": parent_dict.get(task.parent_id),
+            "arch": arch_dict[task.arch_id],
+            "channel": channel_dict[task.channel_id],
+            "subtask_id_list": subtask_dict.get(task.id, []),
+        })
+
+    return result
+
+
+class LogCompression(models.Model):
+    """Model for hub_logcompression table: queue of tasks whose logs should be compressed."""
+    task                = models.ForeignKey(Task)
+    dt_created          = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("id", )
+
+    def __unicode__(self):
+        return u"#%s" % self.task_id
+
+
+# max number of events returned at once
+EVENT_PAGE_SIZE = 1000
+
+
+class TaskEventManager(models.Manager):
+    def record(self, events):
+        """Append state changes, a list of (task_id, old_state, new_state, worker_id) tuples."""
+        if events:
+            with transaction.atomic():
+                self._lock_seq()
+                self.bulk_create([ TaskEvent(task_id=task_id, old_state=old_state, new_state=new_state, worker_id=worker_id) for task_id, old_state, new_state, worker_id in events ])
+
+    def _lock_seq(self):
+        """Lock event inserts until the transaction ends, so that seq follows the commit order.
+
+        Readers don't wait for the lock. Writers recording events wait for
+        each other, events are recorded at the end of transactions to keep
+        the wait short.
+        """
+        cursor = connection.cursor()
+        if connection.vendor == "postgresql":
+            # conflicts with inserts, not with reads
+            cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % connection.ops.quote_name(self.model._meta.db_table))
+            return
+        if connection.vendor == "sqlite":
+            # the first write in a transaction takes the database write lock
+            return
+        # like Task.objects.allocate_ids()
+        list(self.select_for_update().order_by("-id").values_list("id", flat=True)[:1])
+
+    def get_cursor(self):
+        """Return seq up to which readers have seen all events.
+
+        Events are inserted under a lock held until commit (see record()),
+        so seq is monotonically increasing in commit order: once an event
+        is visible, no event with a lower seq can appear later.
+        """
+        last = list(self.order_by("-id").values_list("id", flat=True)[:1])
+        return last and last[0] or 0
+
+    def get_changed_task_ids(self, since_seq, task_ids):
+        """Return set of ids of tasks from task_ids with events after since_seq."""
+        result = set()
+        for chunk in _chunks(list(task_ids)):
+            result.update(self.filter(id__gt=since_seq, task_id__in=chunk).values_list("task_id", flat=True))
+        return result
+
+    def get_page(self, since_seq, limit=EVENT_PAGE_SIZE):
+        """Return (events, seq, more): events after since_seq, since_seq for the next page and whether more events are ready.
+
+        Only events up to get_cursor() are returned, so a reader following
+        seq sees every event exactly once, unless they are deleted by
+        purge() or compact() in the meantime.
+        """
+        cursor = self.get_cursor()
+        events = list(self.filter(id__gt=since_seq, id__lte=cursor).order_by("id")[:limit])
+        if events and len(events) == limit:
+            return events, events[-1].id, True
+        return events, max(since_seq, cursor), False
+
+    def purge(self, dt_before, batch_size=QUERY_CHUNK_SIZE):
+        """Delete events older than dt_before in batches. Return number of deleted events."""
+        deleted = 0
+        while True:
+            event_ids = list(self.filter(dt_created__lt=dt_before).order_by("id").values_list("id", flat=True)[:batch_size])
+            if not event_ids:
+                return deleted
+            self.filter(id__in=event_ids).delete()
+            deleted += len(event_ids)
+
+    def compact(self, dt_before, batch_size=QUERY_CHUNK_SIZE):
+        """Delete events older than dt_before except the last one of each task. Return number of deleted events.
+
+        Events are processed in id ranges of batch_size, the last event of
+        each task is looked up only for tasks in the current range.
+        """
+        old = self.filter(dt_created__lt=dt_before)
+        bounds = old.aggregate(first=Min("id"), last=Max("id"))
+        if bounds["first"] is None:
+            return 0
+
+        deleted = 0
+        for start in xrange(bounds["first"], bounds["last"] + 1, batch_size):
+            events = list(old.filter(id__gte=start, id__lt=start + batch_size).values_list("id", "task_id"))
+            if not events:
+                continue
+            last_ids = set()
+            for chunk in _chunks(sorted(set(task_id for event_id, task_id in events))):
+                last = old.filter(id__gte=start, task_id__in=chunk).order_by().values("task_id").annotate(last_id=Max("id"))
+                last_ids.update(last.values_list("last_id", flat=True))
+            event_ids = [ event_id for event_id, task_id in events if event_id not in last_ids ]
+            if event_ids:
+                self.filter(id__in=event_ids).delete()
+                deleted += len(event_ids)
+        return deleted
+
+
+class TaskEvent(models.Model):
+    """Model for hub_task_event table: append-only log of task state changes, id is the sequence number."""
+    task_id             = models.IntegerField(db_index=True)
+    old_state           = models.PositiveIntegerField(null=True, blank=True, choices=TASK_STATES.get_mapping(), help_text=_("Empty for new tasks."))
+    new_state           = models.PositiveIntegerField(choices=TASK_STATES.get_mapping())
+    worker_id           = models.IntegerField(null=True, blank=True)
+    dt_created          = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = TaskEventManager()
+
+    class Meta:
+        db_table = "hub_task_event"
+        ordering = ("id", )
+
+    def __unicode__(self):
+        return u"#%s: task #%s %s -> %s" % (self.id, self.task_id, self.old_state, self.new_state)
+
+    @property
+    def seq(self):
+        return self.id
+
+    def export(self):
+        """Export data for xml-rpc."""
+        return {
+            "seq": self.id,
+            "task_id": self.task_id,
+            "old_state": self.old_state,
+            "new_state": self.new_state,
+            "worker_id": self.worker_id,
+            "dt_created": datetime.datetime.strftime(self.dt_created, "%F %R:%S"),
+        }
+
+
+def _get_archive_dir():
+    return getattr(settings, "TASK_ARCHIVE_DIR", os.path.join(settings.TASK_DIR, "archive"))
+
+
+def _move_dir(src, dst):
+    """Move a directory, possibly to another filesystem. Return False if src doesn't exist."""
+    if not os.path.isdir(src):
+        return False
+    dst_parent = os.path.dirname(dst)
+    if not os.path.isdir(dst_parent):
+        os.makedirs(dst_parent, mode=0755)
+    shutil.move(src, dst)
+    return True
+
+
+class TaskArchiveManager(models.Manager):
+    def archive(self, dt_before, batch_size=QUERY_CHUNK_SIZE):
+        """Move a batch of old finished task trees and their logs to the archive. Return number of archived tasks.
+
+        Up to batch_size top-level tasks are archived with all their subtasks,
+        only if all tasks of the tree can be archived. Trees are never split
+        between hub_task and the archive, so subtask lists and counts of live
+        tasks stay complete.
+
+        Every batch is committed separately, an interrupted archival continues
+        where it stopped when run again.
+        """
+        root_ids = Task.objects.archivable(dt_before).order_by("id").values_list("id", flat=True)
+        last_id = 0
+        while True:
+            # skip trees which can't be archived yet
+            batch = list(root_ids.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                return 0
+            last_id = batch[-1]
+            count = self._archive_trees(batch, dt_before)
+            if count:
+                return count
+
+    def _archive_trees(self, root_ids, dt_before):
+        with transaction.atomic():
+            # lock and check again, the tasks could have changed meanwhile
+            list(Task.objects.filter(id__in=root_ids).select_for_update().values_list("id", flat=True))
+            trees = dict(( (i, [i]) for i in Task.objects.archivable(dt_before).filter(id__in=root_ids).values_list("id", flat=True) ))
+
+            # lock subtasks level by level, locked tasks can't get new subtasks
+            root_of = dict(( (i, i) for i in trees ))
+            parent_ids = list(trees)
+            while parent_ids:
+                child_ids = []
+                for chunk in _chunks(parent_ids):
+                    for task_id, parent_id in Task.objects.filter(parent__in=chunk).select_for_update().values_list("id", "parent"):
+                        root_of[task_id] = root_of[parent_id]
+                        trees[root_of[task_id]].append(task_id)
+                        child_ids.append(task_id)
+                parent_ids = child_ids
+
+            archivable = set()
+            for chunk in _chunks(list(root_of)):
+                archivable.update(Task.objects._archivable_rows(dt_before).filter(id__in=chunk).values_list("id", flat=True))
+            task_ids = sorted(( i for tree in trees.itervalues() if archivable.issuperset(tree) for i in tree ))
+
+            tasks = []
+            for chunk in _chunks(task_ids):
+                tasks.extend(Task.objects.filter(id__in=chunk).order_by("id"))
+            self.bulk_create([ TaskArchive.from_task(task) for task in tasks ])
+
+            moved = []
+            try:
+                for task in tasks:
+                    src, dst = task.task_dir(), TaskArchive.get_task_dir(task.id)
+                    if _move_dir(src, dst):
+                        moved.append((src, dst))
+                for chunk in _chunks(task_ids):
+                    Task.objects.filter(id__in=chunk).delete()
+            except:
+                for src, dst in reversed(moved):
+                    _move_dir(dst, src)
+                raise
+
+        return len(tasks)
+
+
+class TaskArchive(models.Model):
+    """Model for hub_task_archive table: old finished tasks moved out of hub_task.
+
+    Columns match hub_task, but references to workers and other tasks are
+    plain ids, because those rows may be archived or deleted as well.
+    """
+    id                  = models.IntegerField(primary_key=True)
+    owner               = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+")
+    worker_id           = models.IntegerField(null=True, blank=True)
+    parent_id           = models.IntegerField(null=True, blank=True, db_index=True)
+    state               = models.PositiveIntegerField(choices=TASK_STATES.get_mapping())
+    label               = models.CharField(max_length=255, blank=True)
+    exclusive           = models.BooleanField(default=False)
+
+    method              = models.CharField(max_length=255)
+    args                = kobo.django.fields.JSONField(blank=True, default={})
+    result              = models.TextField(blank=True)
+    comment             = models.TextField(null=True, blank=True)
+
+    arch                = models.ForeignKey(Arch, related_name="+")
+    channel             = models.ForeignKey(Channel, related_name="+")
+    timeout             = models.PositiveIntegerField(null=True, blank=True)
+
+    waiting             = models.BooleanField(default=False)
+    awaited             = models.BooleanField(default=False)
+
+    dt_created          = models.DateTimeField()
+    dt_started          = models.DateTimeField(null=True, blank=True)
+    dt_finished         = models.DateTimeField(null=True, blank=True)
+
+    priority            = models.PositiveIntegerField(default=10)
+    weight              = models.PositiveIntegerField(default=1)
+
+    resubmitted_by      = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name="+")
+    resubmitted_from_id = models.IntegerField(null=True, blank=True)
+
+    subtask_count       = models.PositiveIntegerField(default=0)
+    dt_archived         = models.DateTimeField(auto_now_add=True)
+
+    objects = TaskArchiveManager()
+
+    class Meta:
+        db_table = "hub_task_archive"
+        ordering = ("-id", )
+
+    def __init__(self, *args, **kwargs):
+        super(TaskArchive, self).__init__(*args, **kwargs)
+        self.logs = TaskLogs(self)
+
+    def __unicode__(self):
+        return u"#%s [method: %s, state: %s, archived]" % (self.id, self.method, self.get_state_display())
+
+    @classmethod
+    def _get_task_fields(cls):
+        return [ i.attname for i in cls._meta.concrete_fields if i.name != "dt_archived" ]
+
+    @classmethod
+    def from_task(cls, task):
+        return cls(**dict(( (name, getattr(task, name)) for name in cls._get_task_fields() )))
+
+    @classmethod
+    def get_task_dir(cls, task_id, create=False):
+        """Archived task files are saved in TASK_ARCHIVE_DIR (TASK_DIR/archive by default) in the same structure as in TASK_DIR."""
+        return _get_task_dir(_get_archive_dir(), task_id, create)
+
+    def task_dir(self, create=False):
+        return TaskArchive.get_task_dir(self.id, create)
+
+    def export(self, flat=True):
+        """Export data for xml-rpc, the same as Task.export()."""
+        task = Task(**dict(( (name, getattr(self, name)) for name in self._get_task_fields() )))
+        result = task.export(flat=True)
+        if flat:
+            return result
+
+        worker = Worker.objects.filter(id=self.worker_id).first()
+        parent = None
+        if self.parent_id is not None:
+            parent = Task.objects.filter(id=self.parent_id).first() or TaskArchive.objects.filter(id=self.parent_id).first()
+
+        result.update({
+            "worker": worker and worker.export() or None,
+            "parent": parent and parent.export() or None,
+            "arch": self.arch.export(),
+            "channel": self.channel.export(),
+            "subtask_id_list": list(TaskArchive.objects.filter(parent_id=self.id).values_list("id", flat=True)),
+        })
+        return result
+
+
 def _task_delete(sender, instance, **kwargs):
     """
     When Task object is deleted, appropriate task_dir is deleted also. This is
@@ -1003,4 +2421,14 @@ def _task_delete(sender, instance, **kwargs):
     except OSError:
         pass
 
+    # parent and worker may have been deleted as well
+    instance._update_counters(instance._loaded, (None, None, 0, 0))
+
 post_delete.connect(_task_delete, sender=Task)
+
+
+# reference objects cached in hub processes, see kobo.hub.refcache
+refcache.register(Arch)
+refcache.register(Channel)
+refcache.register(Worker, prefetch=("arches", "channels"), defer=Worker.COUNTER_FIELDS)
+refcache.register(settings.AUTH_USER_MODEL)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+In-process cache of small reference tables: arches, channels, workers and
+users looked up by name or id on every task creation and XML-RPC request.
+
+Every registered model has a version kept in a stamp file
+(settings.REFERENCE_CACHE_DIR, TASK_DIR/.refcache by default). Saving or
+deleting an object replaces the stamp file, which invalidates the cached
+objects of that model in all hub processes. Changes made by
+QuerySet.update() don't send signals, call invalidate() after them.
+
+Fields updated that way all the time (worker counters) are registered as
+deferred instead: they are not cached and each returned copy loads them
+from the database on first access (right away with Django < 1.8).
+
+Inside a transaction the stamp file is replaced after commit, otherwise
+another process could cache the old row under the new version. Django
+versions without transaction.on_commit() replace it right away.
+"""
+
+
+import copy
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+
+__all__ = (
+    "register",
+    "get",
+    "invalidate",
+    "get_stats",
+)
+
+
+_lock = threading.Lock()
+
+# model key -> {"version": stamp, "objects": {lookup: object}, "hits": int, "misses": int}
+_caches = {}
+
+# model key -> fields for prefetch_related()
+_prefetch = {}
+
+# model key -> fields for defer()
+_defer = {}
+
+# m2m through model key -> model key
+_through = {}
+
+# Django < 1.8 loads each deferred field in a separate query and returns
+# instances of a generated subclass, which don't compare equal to model
+# instances; deferred fields are loaded by get() there
+_LAZY_DEFER = hasattr(models.Model, "refresh_from_db")
+
+
+def _get_key(model):
+    """Return "app_label.model_name" of a model class or a model string."""
+    if isinstance(model, basestring):
+        return model.lower()
+    return ("%s.%s" % (model._meta.app_label, model._meta.model_name)).lower()
+
+
+def _get_stamp_file(key):
+    cache_dir = getattr(settings, "REFERENCE_CACHE_DIR", os.path.join(settings.TASK_DIR, ".refcache"))
+    return os.path.join(cache_dir, key)
+
+
+def _get_version(key):
+    try:
+        st = os.stat(_get_stamp_file(key))
+    except OSError:
+        return None
+    # the stamp file is replaced on every change, inode changes even within one mtime tick
+    return (st.st_ino, st.st_mtime)
+
+
+def register(model, prefetch=(), defer=()):
+    """Enable caching of a model (class or "app_label.ModelName" string).
+
+    Fields in defer are not cached, copies returned by get() load them on first access.
+    """
+    key = _get_key(model)
+    _caches[key] = {"version": None, "objects": {}, "hits": 0, "misses": 0}
+    _prefetch[key] = tuple(prefetch)
+    _defer[key] = tuple(defer)
+    if not isinstance(model, basestring):
+        for field_name in prefetch:
+            _through[_get_key(getattr(model, field_name).through)] = key
+
+
+def get(model, **kwargs):
+    """Return a copy of a cached object matching a single field lookup, e.g. get(Arch, name="noarch").
+
+    Raise model.DoesNotExist like model.objects.get().
+    """
+    key = _get_key(model)
+    lookup = tuple(kwargs.items())
+    if len(lookup) != 1:
+        raise TypeError("Exactly one lookup field is required.")
+
+    version = _get_version(key)
+    _lock.acquire()
+    try:
+        cache = _caches[key]
+        if cache["version"] != version:
+            cache["version"] = version
+            cache["objects"] = {}
+        obj = cache["objects"].get(lookup)
+        if obj is not None:
+            cache["hits"] += 1
+            return _copy(model, key, obj)
+        cache["misses"] += 1
+    finally:
+        _lock.release()
+
+    query = model._default_manager.prefetch_related(*_prefetch[key])
+    if _LAZY_DEFER:
+        query = query.defer(*_defer[key])
+    obj = query.get(**kwargs)
+
+    _lock.acquire()
+    try:
+        # don't store objects loaded under an outdated version
+        if cache["version"] == version:
+            cache["objects"][lookup] = obj
+    finally:
+        _lock.release()
+    return _copy(model, key, obj)
+
+
+def _copy(model, key, obj):
+    """Return a copy of a cached object."""
+    result = copy.copy(obj)
+    if _defer[key] and not _LAZY_DEFER:
+        # load fields which are not cached right away
+        result.__dict__.update(model._default_manager.filter(pk=obj.pk).values(*_defer[key])[0])
+    return result
+
+
+def invalidate(model):
+    """Drop cached objects of a model in this and other hub processes."""
+    key = _get_key(model)
+    _lock.acquire()
+    try:
+        _caches[key]["objects"] = {}
+    finally:
+        _lock.release()
+
+    on_commit = getattr(transaction, "on_commit", None)
+    if on_commit is None:
+        _replace_stamp(key)
+    else:
+        # runs immediately outside of transactions
+        on_commit(lambda: _replace_stamp(key))
+
+
+def _replace_stamp(key):
+    """Replace the stamp file of a model, other processes drop their cached objects."""
+    stamp_file = _get_stamp_file(key)
+    stamp_dir = os.path.dirname(stamp_file)
+    try:
+        if not os.path.isdir(stamp_dir):
+            os.makedirs(stamp_dir)
+        fd, tmp_file = tempfile.mkstemp(prefix=".%s." % key, dir=stamp_dir)
+        os.close(fd)
+        os.rename(tmp_file, stamp_file)
+    except OSError:
+        pass
+
+
+def get_stats():
+    """Return {model key: {"hits": int, "misses": int, "size": int}}."""
+    _lock.acquire()
+    try:
+        return dict(( (key, {"hits": cache["hits"], "misses": cache["misses"], "size": len(cache["objects"])}) for key, cache in _caches.iteritems() ))
+    finally:
+        _lock.release()
+
+
+def _model_changed(sender, **kwargs):
+    key = _get_key(sender)
+    if key in _caches:
+        invalidate(key)
+    elif key in _through:
+        invalidate(_through[key])
+
+
+post_save.connect(_model_changed, dispatch_uid="kobo.hub.refcache.post_save")
+post_delete.connect(_model_changed, dispatch_uid="kobo.hub.refcache.post_delete")
+m2m_changed.connect(_model_changed, dispatch_uid="kobo.hub.refcache.m2m_changed")
@@ -2,6 +2,7 @@
 
 import mimetypes
 import os
+import re
 
 try:
     import json
@@ -13,13 +14,15 @@ from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME, get_user_model
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, StreamingHttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import RedirectView
 
-from kobo.hub.models import Arch, Channel, Task
+from kobo.hub.models import Arch, Channel, Task, TaskEvent, EVENT_PAGE_SIZE, TASK_STATES
 from kobo.hub.forms import TaskSearchForm
 from kobo.django.views.generic import ExtraDetailView, SearchView
 
@@ -92,7 +95,8 @@ class TaskDetail(ExtraDetailView):
     def get_context_data(self, **kwargs):
         context = super(TaskDetail, self).get_context_data(**kwargs)
         logs = []
-        for i in kwargs['object'].logs.list:
+        manifest = kwargs['object'].logs.manifest
+        for i in manifest:
             if self.request.user.has_perm('hub.can_see_traceback'):
                 logs.append(i)
                 continue
@@ -100,11 +104,13 @@ class TaskDetail(ExtraDetailView):
                 logs.append(i)
         logs.sort()
         context["logs"] = logs
+        # log names with manifest entries (size, compressed, mtime)
+        context["log_list"] = [ dict(manifest.get(i, {}), name=i) for i in logs ]
         context['task_list'] = kwargs['object'].subtasks()
         return context
 
 
-def _stream_file(file_path, offset=0):
+def _stream_file(file_path, offset=0, length=None):
     """Generator that returns 1M file chunks."""
     try:
         f = open(file_path, "r")
@@ -112,14 +118,29 @@ def _stream_file(file_path, offset=0):
         return
 
     f.seek(offset)
-    while 1:
-        data = f.read(1024 ** 2)
+    while length is None or length > 0:
+        data = f.read(1024 ** 2 if length is None else min(length, 1024 ** 2))
         if not data:
             break
+        if length is not None:
+            length -= len(data)
         yield data
     f.close()
 
 
+def _stream_log(log_file, offset=0):
+    """Generator that returns 1M chunks of an opened (decompressed) log."""
+    try:
+        log_file.seek(offset)
+        while 1:
+            data = log_file.read(1024 ** 2)
+            if not data:
+                break
+            yield data
+    finally:
+        log_file.close()
+
+
 def _trim_log(text):
     # break at first line if possible
     nl = text.find('\n')
@@ -130,21 +151,175 @@ def _trim_log(text):
     return '<...trimmed, download required for full log>' + subtext
 
 
-def _streamed_log_response(file_path, offset, as_attachment):
-    mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(range_header, size):
+    """Return (start, end) of a single byte range, None if the header is
+    missing or not supported, False if the range is not satisfiable."""
+    match = RANGE_RE.match(range_header.replace(" ", ""))
+    if match is None:
+        # multiple ranges are not supported, send the whole file
+        return None
+    start, end = match.groups()
+    if start == "":
+        if end == "" or int(end) == 0:
+            return False
+        # suffix range: last N bytes
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start > end:
+        return False
+    return start, end
+
+
+def _accepts_encoding(request, encoding):
+    """Return True if Accept-Encoding allows the encoding with a non-zero q-value."""
+    qvalues = {}
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = [ i.strip() for i in item.split(";") ]
+        qvalue = 1.0
+        for param in params[1:]:
+            if param.lower().startswith("q="):
+                try:
+                    qvalue = float(param[2:])
+                except ValueError:
+                    qvalue = 0.0
+        if params[0]:
+            qvalues[params[0].lower()] = qvalue
+    qvalue = qvalues.get(encoding, qvalues.get("*", 0.0))
+    return qvalue > 0
+
+
+def _strip_weak(etag):
+    """Return etag without the W/ prefix of weak validators."""
+    if etag.startswith("W/"):
+        return etag[2:]
+    return etag
+
+
+def _not_modified(request, etag, mtime):
+    """Evaluate If-None-Match and If-Modified-Since request headers."""
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        # If-None-Match uses the weak comparison (RFC 7232, section 3.2)
+        etags = [ _strip_weak(i.strip()) for i in if_none_match.split(",") ]
+        return if_none_match.strip() == "*" or _strip_weak(etag) in etags
+    if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def _sendfile_response(file_path, mimetype):
+    """Return a response handing the file over to the web server if
+    TASK_LOG_SENDFILE is configured ("X-Sendfile" or "X-Accel-Redirect").
+
+    X-Accel-Redirect needs TASK_LOG_SENDFILE_URL, an internal location
+    serving TASK_DIR.
+    """
+    header = getattr(settings, "TASK_LOG_SENDFILE", None)
+    if header == "X-Sendfile":
+        value = file_path
+    elif header == "X-Accel-Redirect":
+        relative_path = os.path.relpath(file_path, settings.TASK_DIR)
+        url = getattr(settings, "TASK_LOG_SENDFILE_URL", None)
+        if url is None or relative_path.startswith(".."):
+            return None
+        value = url.rstrip("/") + "/" + relative_path
+    else:
+        return None
+    response = HttpResponse(content_type=mimetype)
+    response[header] = value
+    return response
+
+
+def _streamed_log_response(file_path, offset, as_attachment, request=None, file_name=None, content_encoding=None):
+    """Send a file, honoring conditional and Range requests.
+
+    offset -- send the file from this offset (Range is ignored then)
+    file_name -- attachment name, file name by default
+    content_encoding -- Content-Encoding of the file; the ETag differs
+    """
+    mimetype = mimetypes.guess_type(file_name or file_path)[0] or 'application/octet-stream'
 
     try:
-        content_len = os.path.getsize(file_path) - offset
+        stat = os.stat(file_path)
     except OSError:
-        content_len = 0
+        stat = None
+
+    if stat is None or request is None:
+        try:
+            content_len = os.path.getsize(file_path) - offset
+        except OSError:
+            content_len = 0
 
-    # use _stream_file() instead of passing file object in order to improve performance
-    response = StreamingHttpResponse(_stream_file(file_path, offset), content_type=mimetype)
-    response["Content-Length"] = content_len
+        # use _stream_file() instead of passing file object in order to improve performance
+        response = StreamingHttpResponse(_stream_file(file_path, offset), content_type=mimetype)
+        response["Content-Length"] = content_len
+    else:
+        size = stat.st_size
+        etag = '"%x-%x-%x%s"' % (stat.st_ino, size, int(stat.st_mtime), content_encoding and "-" + content_encoding or "")
+        status = 200
+        start, length = offset, max(size - offset, 0)
+
+        byte_range = None
+        if not offset and "HTTP_RANGE" in request.META:
+            byte_range = _parse_range(request.META["HTTP_RANGE"], size)
+            if_range = request.META.get("HTTP_IF_RANGE")
+            if if_range and if_range != etag and parse_http_date_safe(if_range) != int(stat.st_mtime):
+                # the file has changed, send all of it
+                byte_range = None
+
+        if _not_modified(request, etag, stat.st_mtime):
+            response = HttpResponse(status=304)
+        elif byte_range is False:
+            response = HttpResponse(status=416, content_type="text/plain")
+            response["Content-Range"] = "bytes */%s" % size
+        else:
+            if byte_range:
+                status = 206
+                start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+
+            response = None
+            if status == 200 and not offset:
+                response = _sendfile_response(file_path, mimetype)
+            if response is None:
+                # use _stream_file() instead of passing file object in order to improve performance
+                response = StreamingHttpResponse(_stream_file(file_path, start, length), content_type=mimetype, status=status)
+                response["Content-Length"] = length
+            if status == 206:
+                response["Content-Range"] = "bytes %s-%s/%s" % (start, start + length - 1, size)
+
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(stat.st_mtime)
+        if content_encoding:
+            response["Content-Encoding"] = content_encoding
+        if file_path.endswith(".gz"):
+            response["Vary"] = "Accept-Encoding"
 
     if as_attachment:
         # set filename to be real filesystem name
-        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(file_path)
+        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(file_name or file_path)
+
+    return response
+
+
+def _streamed_compressed_log_response(task, log_name, offset, as_attachment):
+    mimetype = mimetypes.guess_type(log_name)[0] or 'application/octet-stream'
+
+    try:
+        log_file = task.logs._open_log(log_name)
+    except Exception:
+        return HttpResponse(content_type=mimetype)
+
+    response = StreamingHttpResponse(_stream_log(log_file, offset), content_type=mimetype)
+    size = getattr(log_file, "size", None)
+    if size is not None:
+        response["Content-Length"] = max(size - offset, 0)
+
+    if as_attachment:
+        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(log_name)
 
     return response
 
@@ -180,17 +355,25 @@ def _rendered_log_response(request, task, log_name):
     return render_to_response("task/log.html", context, context_instance=RequestContext(request))
 
 
+@csrf_exempt
 def task_log(request, id, log_name):
     """
     IMPORTANT: reverse to 'task/log-json' *must* exist
     """
+    if request.method in ("PUT", "POST"):
+        return _upload_task_log(request, id, log_name)
+
     if os.path.basename(log_name).startswith("traceback") and not request.user.has_perm('hub.can_see_traceback'):
         return HttpResponseForbidden("You don't have permission to see the traceback.")
 
     task = get_object_or_404(Task, id=id)
 
     file_path = task.logs._get_absolute_log_path(log_name)
-    if not os.path.isfile(file_path) and not file_path.endswith(".gz"):
+    info = task.logs.get_log_info(log_name)
+    if info is not None:
+        if info["compressed"]:
+            file_path += ".gz"
+    elif not os.path.isfile(file_path) and not file_path.endswith(".gz"):
         file_path = task.logs._get_absolute_log_path(log_name + ".gz")
 
     offset = int(request.GET.get("offset", 0))
@@ -198,11 +381,55 @@ def task_log(request, id, log_name):
     request_format = request.GET.get("format")
 
     if request_format == "raw" or log_name.endswith(".html") or log_name.endswith(".htm"):
-        return _streamed_log_response(file_path, offset, as_attachment=(request_format == 'raw'))
+        as_attachment = (request_format == 'raw')
+        if file_path.endswith(".gz"):
+            if offset:
+                # offsets point to uncompressed data, send it from the nearest gzip block
+                return _streamed_compressed_log_response(task, log_name, offset, as_attachment)
+            if _accepts_encoding(request, "gzip"):
+                # let the client decompress the log
+                return _streamed_log_response(file_path, 0, as_attachment, request, os.path.basename(log_name), "gzip")
+        return _streamed_log_response(file_path, offset, as_attachment, request)
 
     return _rendered_log_response(request, task, log_name)
 
 
+def _upload_task_log(request, id, log_name):
+    """Write the raw request body to a log of an OPEN task.
+
+    The log is truncated at ?offset= before writing, data is appended if the
+    offset is missing. An optional X-Checksum header carries sha256 of the body.
+    The new log size is returned in the X-Log-Size header.
+    """
+    task = get_object_or_404(Task, id=id)
+    worker = getattr(request, "worker", None)
+    if worker is None or task.worker_id != worker.id:
+        response = HttpResponseForbidden("Only the worker running the task can upload its logs.", content_type="text/plain")
+    elif task.state != TASK_STATES["OPEN"]:
+        response = HttpResponse("Can't upload file for a task which is not OPEN: %s" % task.id, status=409, content_type="text/plain")
+    else:
+        try:
+            offset = request.GET.get("offset")
+            if offset not in (None, ""):
+                offset = int(offset)
+                if offset < 0:
+                    raise ValueError("Invalid offset: %s" % offset)
+            else:
+                offset = None
+            mode = int(request.GET.get("mode", "644"), 8)
+            size = task.logs.write_chunk(log_name, request, offset, request.META.get("HTTP_X_CHECKSUM"), mode)
+        except (ValueError, RuntimeError), ex:
+            response = HttpResponseBadRequest(str(ex), content_type="text/plain")
+        else:
+            response = HttpResponse(content_type="text/plain")
+            response["X-Log-Size"] = str(size)
+            return response
+
+    # clients use X-Log-Size to tell this view from hubs without log uploads
+    response["X-Log-Size"] = ""
+    return response
+
+
 def task_log_json(request, id, log_name):
     if os.path.basename(log_name).startswith("traceback") and not request.user.is_superuser:
         return HttpResponseForbidden(content_type="application/json")
@@ -233,6 +460,23 @@ def task_log_json(request, id, log_name):
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
+def task_events_json(request):
+    """Page through task state changes, see kobo.hub.xmlrpc.client.get_task_events()."""
+    try:
+        since_seq = int(request.GET.get("since", 0))
+        limit = max(1, min(int(request.GET.get("limit", EVENT_PAGE_SIZE)), EVENT_PAGE_SIZE))
+    except ValueError:
+        return HttpResponseBadRequest(content_type="application/json")
+
+    events, seq, more = TaskEvent.objects.get_page(since_seq, limit)
+    result = {
+        "seq": seq,
+        "more": more,
+        "events": [ i.export() for i in events ],
+    }
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
+
 def login(request, redirect_field_name=REDIRECT_FIELD_NAME):
     return django.contrib.auth.views.login(request, template_name="auth/login.html", redirect_field_name=redirect_field_name)
 
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+Wake up workers waiting for new work in worker.wait_for_work().
+
+Hub processes don't share memory, therefore waiters are woken up by a
+condition variable within a process and by touching a stamp file across
+processes (settings.WAKEUP_FILE, TASK_DIR/.wakeup by default).
+
+Each waiter stat()s the stamp file every POLL_INTERVAL seconds. TASK_DIR
+is often on NFS, point WAKEUP_FILE to a local file system if all hub
+processes run on a single host.
+
+Inside a transaction waiters are woken up after commit, otherwise they
+couldn't see the new work. Django versions without transaction.on_commit()
+notify right away and waiters rely on a recheck after RECHECK_DELAY.
+"""
+
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+
+__all__ = (
+    "get_cursor",
+    "notify",
+    "wait",
+)
+
+
+# how often waiters look at the stamp file
+POLL_INTERVAL = 1.5
+
+# without transaction.on_commit() a notification can be sent before the
+# transaction which created the work is committed; waiters check once more
+# after this delay
+RECHECK_DELAY = 1
+
+
+_condition = threading.Condition()
+_generation = [0]
+
+
+def _get_stamp_file():
+    return getattr(settings, "WAKEUP_FILE", os.path.join(settings.TASK_DIR, ".wakeup"))
+
+
+def _get_stamp():
+    try:
+        return os.stat(_get_stamp_file()).st_mtime
+    except OSError:
+        return 0.0
+
+
+def get_cursor():
+    """Return a cursor for wait(), notifications sent after this call end the wait.
+
+    Notifications are detected by the stamp file mtime, those sent within
+    the timestamp resolution of the file system can be merged.
+    """
+    return _get_stamp()
+
+
+def notify():
+    """Wake up all waiters in this and other hub processes after commit."""
+    on_commit = getattr(transaction, "on_commit", None)
+    if on_commit is None:
+        _notify()
+    else:
+        # runs immediately outside of transactions
+        on_commit(_notify)
+
+
+def _notify():
+    _condition.acquire()
+    try:
+        _generation[0] += 1
+        _condition.notify_all()
+    finally:
+        _condition.release()
+
+    stamp_file = _get_stamp_file()
+    try:
+        fd = os.open(stamp_file, os.O_WRONLY | os.O_CREAT, 0644)
+        os.close(fd)
+        os.utime(stamp_file, None)
+    except OSError:
+        pass
+
+
+def wait(check, timeout, cursor=None):
+    """Wait for a notification after which check() returns True.
+
+    Work available before the call doesn't end the wait, only notifications do.
+    Notifications sent since cursor (see get_cursor()) count as well,
+    check() runs once before blocking if there were any.
+    Return True if check() succeeded, False if timeout expired.
+    """
+    deadline = time.time() + timeout
+    generation = _generation[0]
+    stamp = _get_stamp()
+    recheck_at = None
+
+    if cursor is not None and stamp != cursor:
+        if check():
+            return True
+        recheck_at = time.time() + RECHECK_DELAY
+
+    while True:
+        now = time.time()
+        if recheck_at is not None and now >= recheck_at:
+            recheck_at = None
+            if check():
+                return True
+
+        if now >= deadline:
+            return False
+
+        _condition.acquire()
+        try:
+            if _generation[0] == generation:
+                _condition.wait(min(POLL_INTERVAL, deadline - now))
+            new_generation = _generation[0]
+        finally:
+            _condition.release()
+
+        new_stamp = _get_stamp()
+        if (new_generation, new_stamp) != (generation, stamp):
+            generation, stamp = new_generation, new_stamp
+            if check():
+                return True
+            recheck_at = time.time() + RECHECK_DELAY
@@ -5,6 +5,7 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
 
 import kobo.hub.models as models
+from kobo.hub import refcache
 from kobo.django.xmlrpc.decorators import admin_required, login_required
 
 
@@ -15,10 +16,13 @@ __all__ = (
     "shutdown_worker",
     "task_info",
     "get_tasks",
+    "watch_tree",
+    "get_task_events",
     "cancel_task",
     "resubmit_task",
     "list_workers",
     "create_task",
+    "create_tasks",
     "task_url",
 )
 
@@ -39,6 +43,7 @@ def enable_worker(request, worker_name):
     """enable_worker(worker_name): none
     """
     models.Worker.objects.filter(name = worker_name).update(enabled=True)
+    refcache.invalidate(models.Worker)
 
 
 @admin_required
@@ -46,6 +51,7 @@ def disable_worker(request, worker_name):
     """disable_worker(worker_name, kill): None
     """
     models.Worker.objects.filter(name = worker_name).update(enabled=False)
+    refcache.invalidate(models.Worker)
 
 @admin_required
 def get_worker_info(request, worker_name):
@@ -56,7 +62,14 @@ def get_worker_info(request, worker_name):
 
 def task_info(request, task_id, flat=False):
     """task_info(task_id, flat=False): dict or None"""
-    task = models.Task.objects.get(id=task_id)
+    result = models.export_tasks(models.Task.objects.filter(id=task_id), flat=flat)
+    if result:
+        return result[0]
+
+    # old tasks are moved to the archive
+    task = models.TaskArchive.objects.filter(id=task_id).first()
+    if task is None:
+        raise models.Task.DoesNotExist("Task matching query does not exist.")
     return task.export(flat=flat)
 
 
@@ -79,7 +92,81 @@ def get_tasks(request, task_id_list, state_list=None):
         tasks = models.Task.objects.all()
     if state_list:
         tasks = tasks.filter(state__in=state_list)
-    return [ i.export(flat=True) for i in tasks ]
+    result = models.export_tasks(tasks)
+
+    if task_id_list:
+        # old tasks are moved to the archive
+        missing_ids = set(( int(i) for i in task_id_list )) - set(( i["id"] for i in result ))
+        if missing_ids:
+            archived = models.TaskArchive.objects.filter(id__in=missing_ids)
+            if state_list:
+                archived = archived.filter(state__in=state_list)
+            result.extend(( i.export(flat=True) for i in archived ))
+            result.sort(key=lambda i: i["id"], reverse=True)
+
+    return result
+
+
+def watch_tree(request, task_id, since_seq=0):
+    """
+    Get state changes of a task and all its subtasks since the previous call.
+
+    @param task_id: root task ID
+    @type task_id: int
+    @param since_seq: seq returned by the previous call; 0 returns all tasks of the tree
+    @type since_seq: int
+    @return: {"seq": since_seq for the next call, "tasks": [{"id", "parent", "method", "state", "state_label", "worker", "is_finished", "is_failed"}]}
+    @rtype: dict
+    """
+
+    # read the cursor first, events recorded meanwhile are returned again next time
+    seq = models.TaskEvent.objects.get_cursor()
+    if since_seq:
+        seq = max(seq, since_seq)
+        if not models.TaskEvent.objects.filter(id__gt=since_seq).exists():
+            return {"seq": seq, "tasks": []}
+
+    tree_ids = [task_id]
+    for level in models.Task.objects.get_subtask_levels(task_id):
+        tree_ids.extend(level)
+    if since_seq:
+        # only events of the tree, not everything changed on the hub
+        changed_ids = models.TaskEvent.objects.get_changed_task_ids(since_seq, tree_ids)
+        tree_ids = [ i for i in tree_ids if i in changed_ids ]
+        if not tree_ids:
+            return {"seq": seq, "tasks": []}
+
+    tasks = models.Task.objects.export_states(tree_ids)
+    if not since_seq and not tasks:
+        # old tasks are moved to the archive, their subtasks are finished as well
+        task = models.TaskArchive.objects.filter(id=task_id).first()
+        if task is None:
+            raise models.Task.DoesNotExist("Task matching query does not exist.")
+        task_info = task.export(flat=True)
+        tasks = [{"id": task.id, "parent": task.parent_id, "method": task.method, "state": task.state, "state_label": task_info["state_label"], "worker": None, "is_finished": task_info["is_finished"], "is_failed": task_info["is_failed"]}]
+
+    return {"seq": seq, "tasks": tasks}
+
+
+def get_task_events(request, since_seq=0, limit=models.EVENT_PAGE_SIZE):
+    """
+    Get task state changes after since_seq, oldest first.
+
+    Call repeatedly with the returned seq to follow all state changes.
+    Seq follows the commit order, each event is returned once
+    (see TaskEvent.objects.get_cursor()).
+
+    @param since_seq: seq returned by the previous call, 0 to start from the oldest kept event
+    @type since_seq: int
+    @param limit: max number of events (at most 1000)
+    @type limit: int
+    @return: {"seq": since_seq for the next call, "more": bool, "events": [{"seq", "task_id", "old_state", "new_state", "worker_id", "dt_created"}]}
+    @rtype: dict
+    """
+
+    limit = max(1, min(int(limit), models.EVENT_PAGE_SIZE))
+    events, seq, more = models.TaskEvent.objects.get_page(int(since_seq), limit)
+    return {"seq": seq, "more": more, "events": [ i.export() for i in events ]}
 
 
 @login_required
@@ -127,6 +214,27 @@ def create_task(request, kwargs):
     return models.Task.create_task(**kwargs)
 
 
+@admin_required
+def create_tasks(request, kwargs_list):
+    """
+    Create new tasks in bulk. All tasks are validated before any of them is created.
+    This call can be invoked only by superuser.
+
+    @param kwargs_list: list of task attributes, see create_task(); task_id (cloning) is not supported
+    @type kwargs_list: [dict]
+    @return: task ids in the same order as kwargs_list
+    @rtype: [int]
+    """
+
+    for kwargs in kwargs_list:
+        if "task_id" in kwargs:
+            raise ValueError("create_tasks() doesn't support cloning tasks, use create_task().")
+        kwargs.setdefault("label", "")
+        kwargs["resubmitted_by"] = request.user
+        kwargs["resubmitted_from"] = None
+    return models.Task.create_tasks(kwargs_list)
+
+
 def task_url(request, task_id):
     """
     Get a task URL.
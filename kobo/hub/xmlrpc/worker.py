@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
 
+import datetime
 import os
 import random
 
-from kobo.client.constants import TASK_STATES
-from kobo.hub.models import Task
+from django.conf import settings
+from django.db.models import Q
+
+from kobo.client.constants import TASK_STATES, FINISHED_STATES
+from kobo.hub import wakeup
+from kobo.hub.models import Task, Worker, export_tasks
 from kobo.hub.decorators import validate_worker
 from kobo.xmlrpc import decode_xmlrpc_chunk
 
@@ -19,7 +24,10 @@ __all__ = (
     "interrupt_tasks",
     "timeout_tasks",
 
+    "heartbeat",
     "get_tasks_to_assign",
+    "claim_tasks",
+    "wait_for_work",
     "get_awaited_tasks",
     "get_worker_info",
     "get_worker_id",
@@ -30,6 +38,7 @@ __all__ = (
     "set_task_weight",
     "update_worker",
     "create_subtask",
+    "create_subtasks",
     "wait",
     "check_wait",
     "upload_task_log",
@@ -54,6 +63,19 @@ def get_worker_id(request):
     return request.worker.id
 
 
+def _get_worker_tasks(worker):
+    """Return list of task_info dicts running on a worker, set wakeup alerts."""
+    tasks = list(worker.running_tasks().order_by("-exclusive", "-awaited", "id").select_related("owner", "resubmitted_by", "worker", "arch", "channel"))
+    task_list = export_tasks(tasks)
+    for task, task_info in zip(tasks, task_list):
+        # set wakeup alert
+        if task.waiting:
+            finished, unfinished = task.check_wait()
+            if len(finished) > 0:
+                task_info["alert"] = True
+    return task_list
+
+
 @validate_worker
 def get_worker_tasks(request):
     """
@@ -61,18 +83,7 @@ def get_worker_tasks(request):
 
     @rtype: list
     """
-    task_list = []
-    for task in request.worker.running_tasks().order_by("-exclusive", "-awaited", "id"):
-        task_info = task.export()
-
-        # set wakeup alert
-        if task.waiting:
-            finished, unfinished = task.check_wait()
-            if len(finished) > 0:
-                task_info["alert"] = True
-
-        task_list.append(task_info)
-    return task_list
+    return _get_worker_tasks(request.worker)
 
 
 @validate_worker
@@ -172,9 +183,78 @@ def update_worker(request, enabled, ready, task_count):
 
 
 @validate_worker
-def get_tasks_to_assign(request):
-    task_list = []
-    max_tasks = max(request.worker.max_tasks, 10) # return info about at least 10 tasks
+def heartbeat(request, state):
+    """
+    Process a whole worker poll cycle in a single call.
+
+    Interrupt open tasks the worker doesn't run (state["task_ids"]),
+    time out tasks running too long, update worker and claim new tasks.
+
+    @param state: {"enabled": bool, "ready": bool, "task_count": int,
+                   "task_ids": [int], "finished": [int], "task_classes": dict or None}
+        - task_ids: IDs of tasks running in worker processes
+        - finished: IDs of tasks whose processes have exited
+        - task_classes: supported tasks (see claim_tasks()); no tasks are claimed if omitted
+    @type  state: dict
+    @return: {"worker_info": dict, "tasks": [dict], "interrupted": [int], "timed_out": [int],
+              "task_info": {str(task_id): dict}, "claimed": [dict], "wait_cursor": float}
+        - tasks: tasks running on the worker, see get_worker_tasks()
+        - task_info: tasks from task_ids, finished, interrupted and timed_out which are not running
+        - wait_cursor: pass to wait_for_work() not to miss work which appears in the meantime
+    @rtype: dict
+    """
+    wait_cursor = wakeup.get_cursor()
+
+    # keep the session alive, see auth.renew_session()
+    session = getattr(request, "session", None)
+    if session is not None:
+        session.modified = True
+
+    task_ids = set(state.get("task_ids", []))
+    now = datetime.datetime.now()
+    interrupted = []
+    timed_out = []
+    for task in request.worker.running_tasks():
+        if task.state == TASK_STATES["OPEN"] and task.id not in task_ids:
+            # an interrupted task appears to be open, but running task manager doesn't track it in it's pid list
+            # this happens after a power outage, for example
+            interrupted.append(task)
+        elif task.timeout is not None and task.dt_started is not None and now - task.dt_started >= datetime.timedelta(seconds=task.timeout):
+            timed_out.append(task)
+
+    for task in interrupted:
+        task.interrupt_task(recursive=True)
+    for task in timed_out:
+        task.timeout_task(recursive=True)
+
+    worker = Worker.objects.get(id=request.worker.id)
+    worker_info = worker.update_worker(state["enabled"], state["ready"], state["task_count"])
+    task_list = _get_worker_tasks(worker)
+
+    other_ids = task_ids.union(state.get("finished", []), ( i.id for i in interrupted ), ( i.id for i in timed_out ))
+    other_ids.difference_update(( i["id"] for i in task_list ))
+    task_info = dict(( (str(i["id"]), i) for i in export_tasks(Task.objects.filter(id__in=other_ids)) ))
+
+    claimed = []
+    task_classes = state.get("task_classes")
+    if task_classes is not None and worker.enabled and worker.ready:
+        # worker_info doesn't include claimed tasks, the worker adds their weight when starting them
+        claimed = _claim_tasks(worker, worker.max_load - worker.current_load, task_classes)
+
+    return {
+        "worker_info": worker_info,
+        "tasks": task_list,
+        "interrupted": sorted(( i.id for i in interrupted )),
+        "timed_out": sorted(( i.id for i in timed_out )),
+        "task_info": task_info,
+        "claimed": claimed,
+        "wait_cursor": wait_cursor,
+    }
+
+
+def _get_tasks_to_assign(worker):
+    """Return list of task_info dicts a worker should try to take."""
+    max_tasks = max(worker.max_tasks, 10) # return info about at least 10 tasks
 
     # Limit each query by max_tasks.
     # Worker sometimes doesn't succeed in taking all tasks from task_list,
@@ -182,45 +262,134 @@ def get_tasks_to_assign(request):
     # (not all tasks are taken by one worker).
     # If task_list is longer than max_tasks, return it not to perform another queries.
 
-    # exclusive tasks
-    for task in request.worker.assigned_tasks().filter(exclusive=True).order_by("-priority", "id")[:max_tasks]:
-        task_info = task.export(flat=False)
-        task_list.append(task_info)
+    querysets = [
+        # exclusive tasks
+        worker.assigned_tasks().filter(exclusive=True),
+        # awaited tasks
+        Task.objects.free().filter(awaited=True),
+        # tasks assigned to this worker
+        worker.assigned_tasks().filter(exclusive=False),
+    ]
 
-    if len(task_list) >= max_tasks:
-        return task_list
+    # free tasks for each channel relevant to the worker
+    for channel_id in worker.channels.values_list("id", flat=True):
+        querysets.append(Task.objects.free().filter(awaited=False, channel=channel_id, priority__gte=worker.min_priority))
+
+    # all candidates are fetched in a single query regardless of channel count
+    querysets = [ i.order_by("-priority", "id") for i in querysets ]
+    groups = Task.objects.union_values(querysets, ("id", "priority"), max_tasks)
+    for group in groups:
+        group.sort(key=lambda x: (-x[1], x[0]))
+
+    task_ids = []
+    for group in groups[:3]:
+        task_ids.extend(( task_id for task_id, priority in group ))
+        if len(task_ids) >= max_tasks:
+            break
+    else:
+        tasks = []
+        for group in groups[3:]:
+            tasks.extend(group)
+
+        # Shuffle the list to prevent task starvation in some channels.
+        # It could also help to lower task assignment conflicts.
+        # After that, sort it by priority again.
+        random.shuffle(tasks)
+        tasks.sort(key=lambda x: x[1], reverse=True)
+        task_ids.extend(( task_id for task_id, priority in tasks[:max_tasks] ))
+
+    task_dict = dict(( (i.id, i) for i in Task.objects.filter(id__in=task_ids).select_related("owner", "resubmitted_by", "worker", "arch", "channel") ))
+    return export_tasks([ task_dict[i] for i in task_ids if i in task_dict ], flat=False)
 
-    # awaited tasks
-    for task in Task.objects.free().filter(awaited=True).order_by("-priority", "id")[:max_tasks]:
-        task_info = task.export(flat=False)
-        task_list.append(task_info)
 
-    if len(task_list) >= max_tasks:
-        return task_list
+@validate_worker
+def get_tasks_to_assign(request):
+    return _get_tasks_to_assign(request.worker)
+
 
-    # tasks assigned to this worker
-    for task in request.worker.assigned_tasks().filter(exclusive=False).order_by("-priority", "id")[:max_tasks]:
-        task_info = task.export(flat=False)
-        task_list.append(task_info)
+def _can_take_task(task_info, task_classes):
+    """Check whether a worker supports a task; mirrors worker side checks in TaskManager.take_task()."""
+    task_class = task_classes.get(task_info["method"])
+    if task_class is None:
+        return False
+    if task_class.get("exclusive", False):
+        # always process exclusive tasks, regardless architecture or channel
+        return True
+    return task_info["arch"]["name"] in task_class.get("arches", []) and task_info["channel"]["name"] in task_class.get("channels", [])
+
+
+def _claim_tasks(worker, max_load, task_classes):
+    """Pick and open tasks for a worker, return list of opened task_info dicts."""
+    task_ids = []
+    for task_info in _get_tasks_to_assign(worker):
+        if max_load <= 0:
+            break
+        if task_info["state"] not in (TASK_STATES["FREE"], TASK_STATES["ASSIGNED"]):
+            continue
+        if not _can_take_task(task_info, task_classes):
+            continue
+        task_ids.append(task_info["id"])
+        max_load -= task_classes[task_info["method"]].get("weight", 1)
+
+    opened = Task.objects.claim(worker.id, task_ids)
+    task_dict = dict(( (i.id, i) for i in Task.objects.filter(id__in=opened).select_related("owner", "resubmitted_by", "worker", "arch", "channel") ))
+    return export_tasks([ task_dict[i] for i in opened ], flat=False)
 
-    if len(task_list) >= max_tasks:
-        return task_list
 
-    # free tasks for each channel relevant to the worker
-    tasks = []
-    for channel in request.worker.channels.all():
-        for task in Task.objects.free().filter(awaited=False, channel=channel, priority__gte=request.worker.min_priority).order_by("-priority", "id")[:max_tasks]:
-            task_info = task.export(flat=False)
-            tasks.append(task_info)
-
-    # Shuffle the list to prevent task starvation in some channels.
-    # It could also help to lower task assignment conflicts.
-    # After that, sort it by priority again.
-    random.shuffle(tasks)
-    tasks.sort(lambda x, y: cmp(x["priority"], y["priority"]), reverse=True)
-    task_list.extend(tasks[:max_tasks])
+@validate_worker
+def claim_tasks(request, max_load, task_classes):
+    """
+    Pick and open tasks for a worker in a single transaction.
 
-    return task_list
+    @param max_load: load the worker can still take (max_load - current_load)
+    @type  max_load: int
+    @param task_classes: tasks supported by the worker: {method: {"arches": [str], "channels": [str], "exclusive": bool, "weight": int}}
+    @type  task_classes: dict
+    @return: list of opened task_info dicts
+    @rtype: list
+    """
+    return _claim_tasks(request.worker, max_load, task_classes)
+
+
+# Upper limit for wait_for_work() timeout, in seconds.
+# Each waiting worker holds a hub request (a WSGI process or thread) for up
+# to this long, the WSGI server needs a request slot per idle worker on top
+# of the regular load. Lower it or set it to 0 (workers sleep instead) if
+# that's not possible.
+MAX_WAIT_TIMEOUT = getattr(settings, "WORKER_MAX_WAIT_TIMEOUT", 300)
+
+
+def _has_work(worker):
+    """Check if there's anything new for a worker to process."""
+    query = Q(state=TASK_STATES["ASSIGNED"], worker=worker)
+    query |= Q(state=TASK_STATES["FREE"], awaited=True)
+    query |= Q(state=TASK_STATES["FREE"], awaited=False, channel__in=worker.channels.all(), priority__gte=worker.min_priority)
+    # waiting tasks should be woken up
+    query |= Q(state__in=FINISHED_STATES, awaited=True, parent__worker=worker, parent__waiting=True)
+    return Task.objects.filter(query).exists()
+
+
+@validate_worker
+def wait_for_work(request, timeout, cursor=None):
+    """
+    Wait until new work for a worker appears: a task is created, freed
+    or assigned, or a subtask of a waiting task finishes.
+
+    Tasks finishing on the worker don't end the wait, the worker notices
+    them itself within the timeout.
+
+    The timeout is capped by settings.WORKER_MAX_WAIT_TIMEOUT, see MAX_WAIT_TIMEOUT.
+
+    @param timeout: max time to wait, in seconds
+    @type  timeout: int
+    @param cursor: wait_cursor returned by heartbeat(); work which appeared
+                   since the heartbeat ends the wait right away
+    @type  cursor: float
+    @return: True if there's new work, False on timeout
+    @rtype: bool
+    """
+    timeout = min(max(int(timeout), 0), MAX_WAIT_TIMEOUT)
+    return wakeup.wait(lambda: _has_work(request.worker), timeout, cursor)
 
 
 @validate_worker
@@ -240,6 +409,29 @@ def create_subtask(request, label, method, args, parent_id):
     return Task.create_task(parent_task.owner.username, label, method, args=args, parent_id=parent_id, arch_name=parent_task.arch.name, channel_name=parent_task.channel.name)# priority=priority, weight=weight)
 
 
+@validate_worker
+def create_subtasks(request, subtask_list, parent_id):
+    """Create subtasks in bulk, return their ids in the same order.
+
+    @param subtask_list: list of {"method": str, "args": dict, "label": str} dicts
+    @type subtask_list: [dict]
+    @rtype: [int]
+    """
+    parent_task = Task.objects.get_and_verify(task_id=parent_id, worker=request.worker)
+    kwargs_list = []
+    for subtask in subtask_list:
+        kwargs_list.append({
+            "owner_name": parent_task.owner.username,
+            "label": subtask.get("label", ""),
+            "method": subtask["method"],
+            "args": subtask.get("args"),
+            "parent_id": parent_id,
+            "arch_name": parent_task.arch.name,
+            "channel_name": parent_task.channel.name,
+        })
+    return Task.create_tasks(kwargs_list)
+
+
 @validate_worker
 def wait(request, task_id, child_list=None):
     task = Task.objects.get(id=task_id)
@@ -284,9 +476,12 @@ def upload_task_log(request, task_id, relative_path, mode, chunk_start, chunk_le
     if task.state != TASK_STATES["OPEN"]:
         raise ValueError("Can't upload file for a task which is not OPEN: %s" % task_id)
 
+    new_log = not os.path.exists(full_path)
     try:
         decode_xmlrpc_chunk(chunk_start, chunk_len, chunk_checksum, encoded_chunk, write_to=full_path, mode=mode)
     except ValueError:
         return False
 
+    if new_log:
+        task.logs.update_manifest([relative_path])
     return True
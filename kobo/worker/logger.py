@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
+import collections
+import httplib
+import socket
+import tempfile
 import threading
 import time
-import Queue
 from cStringIO import StringIO
-from xmlrpclib import Fault
+from xmlrpclib import Fault, ProtocolError
 
 
 __all__ = (
@@ -14,58 +17,202 @@ __all__ = (
 )
 
 
+# errors of an unreachable or failing hub
+SEND_ERRORS = (Fault, ProtocolError, httplib.HTTPException, socket.error)
+
+
 class LoggingThread(threading.Thread):
-    """Send stdout data to hub in a background thread."""
+    """Send stdout data to hub in a background thread.
+
+    Data is kept in a bounded buffer and sent once it reaches flush_size bytes
+    or after flush_interval seconds. Writers block while the buffer is full.
+    Failed uploads are retried with exponential backoff, data is spilled
+    to a local file in the meantime and replayed when the hub is back.
+    """
 
     def __init__(self, hub, task_id, *args, **kwargs):
+        self._buffer_size = kwargs.pop("buffer_size", 1024 ** 2)
+        self._flush_size = kwargs.pop("flush_size", 1200)
+        self._flush_interval = kwargs.pop("flush_interval", 5)
+        self._retry_delay = kwargs.pop("retry_delay", 1)
+        self._max_retry_delay = kwargs.pop("max_retry_delay", 60)
+        # retries before spooled data is dropped when stopping
+        self._stop_retries = kwargs.pop("stop_retries", 5)
+        self._spool_dir = kwargs.pop("spool_dir", None)
+        self._logger = kwargs.pop("logger", None)
         threading.Thread.__init__(self, *args, **kwargs)
         self._hub = hub
         self._task_id = task_id
-        self._queue = Queue.Queue()
-        self._event = threading.Event()
+        self._cond = threading.Condition()
+        self._buffer = collections.deque()
+        self._buffered = 0
         self._running = True
         self._send_time = 0
-        self._send_data = ""
+        self._spool = None
+        self._spool_offset = 0
+        self._spool_size = 0
+        self._failures = 0
+        self._retry_time = 0
+        self._bytes_sent = 0
+        self._send_count = 0
+        self._send_failures = 0
+        self._send_latency = 0.0
+        self._send_latency_total = 0.0
 
     def run(self):
-        """Send queue content to hub."""
-        while self._running or not self._queue.empty() or self._send_data:
-            if self._queue.empty():
-                self._event.wait(5)
-
-            self._event.clear()
-            while True:
-                try:
-                    self._send_data += self._queue.get_nowait()
-                except Queue.Empty:
-                    break
-
-            if not self._send_data:
+        """Send buffer content to hub."""
+        while True:
+            data = self._take()
+            if data:
+                if self._spool_size > self._spool_offset:
+                    # keep the order, older data waits in the spool file
+                    self._spill(data)
+                else:
+                    try:
+                        self._send(data)
+                    except SEND_ERRORS:
+                        self._spill(data)
+                        self._failed()
+
+            if self._spool_size > self._spool_offset and time.time() >= self._retry_time:
+                self._replay()
+
+            if self._running:
                 continue
-
-            now = int(time.time())
-            if self._running and len(self._send_data) < 1200 and now - self._send_time < 5:
+            if self._buffered:
                 continue
-
-            if isinstance(self._send_data, unicode):
-                self._send_data = self._send_data.encode('utf-8')
-
-            try:
-                self._hub.upload_task_log(StringIO(self._send_data), self._task_id, "stdout.log", append=True)
-                self._send_time = now
-                self._send_data = ""
-            except Fault:
+            if self._spool_size > self._spool_offset and self._failures <= self._stop_retries:
                 continue
+            break
+
+        dropped = self._spool_size - self._spool_offset
+        if dropped:
+            self._logger and self._logger.error("Task %s: hub unreachable, dropped %s bytes of stdout log." % (self._task_id, dropped))
+
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def _take(self):
+        """Wait until there is something to do, return buffered data."""
+        self._cond.acquire()
+        try:
+            while self._running and self._buffered < self._flush_size:
+                now = time.time()
+                timeouts = []
+                if self._buffer:
+                    timeouts.append(self._send_time + self._flush_interval - now)
+                if self._spool_size > self._spool_offset:
+                    timeouts.append(self._retry_time - now)
+                if timeouts and min(timeouts) <= 0:
+                    break
+                self._cond.wait(min(timeouts + [self._flush_interval]))
+
+            if not self._running and self._spool_size > self._spool_offset:
+                # wait for the next retry when stopping, new data can't arrive
+                delay = self._retry_time - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+
+            data = "".join(self._buffer)
+            self._buffer.clear()
+            self._buffered = 0
+            self._cond.notifyAll()
+            return data
+        finally:
+            self._cond.release()
+
+    def _send(self, data):
+        start = time.time()
+        try:
+            self._hub.upload_task_log(StringIO(data), self._task_id, "stdout.log", append=True)
+        except SEND_ERRORS:
+            self._send_failures += 1
+            raise
+        self._send_time = time.time()
+        self._send_latency = self._send_time - start
+        self._send_latency_total += self._send_latency
+        self._send_count += 1
+        self._bytes_sent += len(data)
+        self._failures = 0
+
+    def _failed(self):
+        """Schedule the next attempt with exponential backoff."""
+        self._failures += 1
+        delay = min(self._retry_delay * 2 ** (self._failures - 1), self._max_retry_delay)
+        self._retry_time = time.time() + delay
+
+    def _spill(self, data):
+        """Append data to the spool file."""
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(prefix="kobo-task-%s-" % self._task_id, dir=self._spool_dir)
+        self._spool.seek(self._spool_size)
+        self._spool.write(data)
+        self._spool_size += len(data)
+
+    def _replay(self):
+        """Send spooled data, truncate the spool file when done."""
+        while self._spool_offset < self._spool_size:
+            self._spool.seek(self._spool_offset)
+            data = self._spool.read(min(self._buffer_size, self._spool_size - self._spool_offset))
+            try:
+                self._send(data)
+            except SEND_ERRORS:
+                self._failed()
+                return
+            self._spool_offset += len(data)
+
+        self._spool.seek(0)
+        self._spool.truncate()
+        self._spool_offset = 0
+        self._spool_size = 0
+
+    def get_metrics(self):
+        """Return a dict with buffer and upload statistics."""
+        count = self._send_count
+        return {
+            "bytes_buffered": self._buffered,
+            "bytes_spooled": self._spool_size - self._spool_offset,
+            "bytes_sent": self._bytes_sent,
+            "send_count": count,
+            "send_failures": self._send_failures,
+            "send_latency": self._send_latency,
+            "send_latency_avg": count and self._send_latency_total / count or 0.0,
+        }
 
     def write(self, data):
-        """Add data to the queue and set the event for sending queue content."""
-        self._queue.put(data)
-        self._event.set()
+        """Add data to the buffer, wait while the buffer is full.
+
+        Writes from the logging thread itself (e.g. output printed while
+        uploading) never wait, the buffer can't be drained meanwhile.
+        """
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if not data:
+            return
+
+        wait = threading.current_thread() is not self
+        self._cond.acquire()
+        try:
+            while wait and self._buffered and self._buffered + len(data) > self._buffer_size and self.is_alive():
+                self._cond.wait(1)
+            empty = not self._buffer
+            self._buffer.append(data)
+            self._buffered += len(data)
+            # wake up the thread to recompute its timeout when the buffer was empty
+            if empty or self._buffered >= self._flush_size:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
 
     def stop(self):
         """Send remaining data to hub and finish."""
-        self._running = False
-        self._event.set()
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
         self.join()
 
 
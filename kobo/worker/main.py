@@ -49,18 +49,15 @@ def main_loop(conf, foreground=False):
     while 1:
         try:
             tm.log_debug(80 * '-')
-            # poll hub for new tasks
-            tm.hub._login()
-            tm.update_worker_info()
-            tm.update_tasks()
-            tm.get_next_task()
+            # report to hub, process task updates and take new tasks
+            tm.poll()
 
             # write to stdout / stderr
             sys.stdout.flush()
             sys.stderr.flush()
 
-            # sleep for some time
-            tm.sleep()
+            # wait for new work or sleep for some time
+            tm.wait_for_work()
 
         except (ShutdownException, KeyboardInterrupt):
             # ignore keyboard interrupts and sigterm
@@ -97,6 +97,19 @@ class TaskBase(Plugin):
         self._subtask_list.append(subtask_id)
         return subtask_id
 
+    def spawn_subtasks(self, subtask_list):
+        """Spawn new subtasks in one call.
+
+        subtask_list = [{"method": ..., "args": ..., "label": ...}, ...]
+        Return list of subtask ids in the same order.
+        """
+        if self.foreground:
+            raise RuntimeError("Foreground tasks can't spawn subtasks.")
+
+        subtask_ids = self.hub.worker.create_subtasks(subtask_list, self.task_id)
+        self._subtask_list.extend(subtask_ids)
+        return subtask_ids
+
     def wait(self, subtasks=None):
         """Wait until subtasks finish.
 
@@ -127,9 +140,10 @@ class TaskBase(Plugin):
 
         # remove finished subtasks from the list, check results
         fail = False
-        for i in finished:
-            state = self.hub.worker.get_task(i)
-            if state['state'] != TASK_STATES['CLOSED']:
+        with self.hub.batch() as batch:
+            calls = [ batch.worker.get_task(i) for i in finished ]
+        for i, call in zip(finished, calls):
+            if call.result['state'] != TASK_STATES['CLOSED']:
                 fail = True
             self._subtask_list.remove(i)
 
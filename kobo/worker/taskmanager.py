@@ -105,6 +105,9 @@ class TaskManager(kobo.log.LoggingBase):
         self.task_dict = {}     # { task_id: { task information obtained from self.hub.get_worker_tasks() } }
 
         self.locked = False     # if task manager is locked, it waits until tasks finish and exits
+        self.use_heartbeat = True   # False if hub doesn't support worker.heartbeat()
+        self.use_claim_tasks = True # False if hub doesn't support worker.claim_tasks()
+        self.wait_cursor = None     # returned by worker.heartbeat(), see wait_for_work()
 
         self.task_container = TaskContainer()
 
@@ -122,6 +125,31 @@ class TaskManager(kobo.log.LoggingBase):
         """Sleep between polls."""
         time.sleep(self.conf.get("SLEEP_TIME", 20))
 
+    def wait_for_work(self):
+        """Wait until hub has new work for the worker, sleep if that's not possible."""
+        if self.locked or not self.worker_info["enabled"]:
+            self.sleep()
+            return
+
+        # work which appeared since the last heartbeat ends the wait right away
+        sleep_time = self.conf.get("SLEEP_TIME", 20)
+        args = [sleep_time]
+        if self.wait_cursor is not None:
+            args.append(self.wait_cursor)
+            self.wait_cursor = None
+
+        try:
+            start = time.time()
+            if not self.hub.worker.wait_for_work(*args):
+                # hub may cap the timeout, sleep the rest
+                time.sleep(max(0, sleep_time - (time.time() - start)))
+        except (ShutdownException, KeyboardInterrupt):
+            raise
+        except Exception, ex:
+            # hub doesn't support wait_for_work() or the call failed
+            self.log_debug("Cannot wait for work: %s" % ex)
+            self.sleep()
+
     def update_worker_info(self):
         """Update worker_info dictionary."""
 
@@ -187,24 +215,116 @@ class TaskManager(kobo.log.LoggingBase):
         self.task_dict = task_list
         self.log_debug("Current tasks: %r" % self.task_dict.keys())
 
+        self.log_debug("pids: %s" % self.pid_dict.values())
+        for task_id in self.pid_dict.keys():
+            if self.is_finished_task(task_id):
+                self.log_info("Task has finished: %s" % task_id)
+                finished_tasks.add(task_id)
+                # the subprocess handles most everything, we just need to clear things out
+                if self.cleanup_task(task_id):
+                    del self.pid_dict[task_id]
+                if task_id in self.task_dict:
+                    del self.task_dict[task_id]
+
+        # send state changes and lingering task lookups in a single request
+        batch = self.hub.batch()
+
+        interrupt_call = None
         if interrupted_list:
             self.log_warning("Closing interrupted tasks: %r" % sorted(interrupted_list))
+            interrupt_call = batch.worker.interrupt_tasks(interrupted_list)
+
+        timeout_call = None
+        if timeout_list:
+            self.log_warning("Closing timed out tasks: %r" % sorted(timeout_list))
+            timeout_call = batch.worker.timeout_tasks(timeout_list)
+
+        lingering_calls = []
+        for task_id, pid in self.pid_dict.items():
+            if task_id not in self.task_dict:
+                # expected to happen when:
+                #  - we are in the narrow gap between the time the task records its result
+                #    and the time the process actually exits.
+                #  - task is canceled
+                #  - task is forcibly reassigned/unassigned
+                lingering_calls.append((task_id, pid, batch.worker.get_task_no_verify(task_id)))
+
+        batch.send()
+
+        for call in (interrupt_call, timeout_call):
+            if call is None:
+                continue
             try:
-                self.hub.worker.interrupt_tasks(interrupted_list)
+                call.result
             except (ShutdownException, KeyboardInterrupt):
                 raise
             except Exception, ex:
                 self.log_error("%s" % ex)
 
-        if timeout_list:
-            self.log_warning("Closing timed out tasks: %r" % sorted(timeout_list))
+        for task_id, pid, call in lingering_calls:
             try:
-                self.hub.worker.timeout_tasks(timeout_list)
+                task = call.result
+                if task["state"] == TASK_STATES["CANCELED"]:
+                    self.log_info("Killing canceled task %r (pid %r)" % (task_id, pid))
+                    if self.cleanup_task(task_id):
+                        del self.pid_dict[task_id]
+                        finished_tasks.add(task_id)
+                if task["state"] == TASK_STATES["TIMEOUT"]:
+                    self.log_info("Killing timed out task %r (pid %r)" % (task_id, pid))
+                    if self.cleanup_task(task_id):
+                        del self.pid_dict[task_id]
+                        finished_tasks.add(task_id)
+                elif "worker_id" in task and task["worker_id"] != self.worker_info["id"]:
+                    self.log_info("Killing reassigned task %r (pid %r)" % (task_id, pid))
+                    # TODO: Task.cleanup() - be careful, cleanup may remove running task's data!
+                    if self.cleanup_task(task_id):
+                        del self.pid_dict[task_id]
+                else:
+                    self.log_warning("Lingering task %r (pid %r)" % (task_id, pid))
             except (ShutdownException, KeyboardInterrupt):
                 raise
-            except Exception, ex:
-                self.log_error("%s" % ex)
+            except Exception:
+                # TODO: do not catch generic error
+                self.log_error("Invalid task %r (pid %r)" % (task_id, pid))
+                raise
+
+        if finished_tasks:
+            with self.hub.batch() as batch:
+                finished_calls = [ batch.worker.get_task(task_id) for task_id in sorted(finished_tasks) ]
+            for call in finished_calls:
+                self.finish_task(call.result)
+
+        self.update_worker_info()
+
+    def poll(self):
+        """Report to hub, process task updates and take new tasks.
+
+        Use heartbeat(), fall back to the update_worker_info(), update_tasks()
+        and get_next_task() cycle on hubs without worker.heartbeat().
+        """
+        if self.use_heartbeat:
+            try:
+                self.heartbeat()
+                return
+            except Fault, ex:
+                if "is not supported" not in ex.faultString:
+                    raise
+                self.log_info("Hub doesn't support worker.heartbeat, using the old poll cycle.")
+                self.use_heartbeat = False
 
+        self.hub._login()
+        self.update_worker_info()
+        self.update_tasks()
+        self.get_next_task()
+
+    def heartbeat(self):
+        """Report worker state to hub and process the response in a single call.
+
+        Replaces the update_worker_info(), update_tasks() and get_next_task() poll cycle.
+        The first call is made with no running tasks, so nothing is lost when
+        the hub doesn't support it (see poll()).
+        """
+        finished_tasks = set()
         self.log_debug("pids: %s" % self.pid_dict.values())
         for task_id in self.pid_dict.keys():
             if self.is_finished_task(task_id):
@@ -216,45 +336,82 @@ class TaskManager(kobo.log.LoggingBase):
                 if task_id in self.task_dict:
                     del self.task_dict[task_id]
 
-        for task_id, pid in self.pid_dict.items():
-            if task_id not in self.task_dict:
-                # expected to happen when:
-                #  - we are in the narrow gap between the time the task records its result
-                #    and the time the process actually exits.
-                #  - task is canceled
-                #  - task is forcibly reassigned/unassigned
+        state = {
+            "enabled": self.worker_info["enabled"],
+            "ready": self.worker_info["ready"],
+            "task_count": len(self.pid_dict),
+            "task_ids": self.pid_dict.keys(),
+            "finished": sorted(finished_tasks),
+            # locked task manager takes only awaited tasks, see get_next_task()
+            "task_classes": not self.locked and self.get_task_classes() or None,
+        }
 
-                try:
-                    task = self.hub.worker.get_task_no_verify(task_id)
-                    if task["state"] == TASK_STATES["CANCELED"]:
-                        self.log_info("Killing canceled task %r (pid %r)" % (task_id, pid))
-                        if self.cleanup_task(task_id):
-                            del self.pid_dict[task_id]
-                            finished_tasks.add(task_id)
-                    if task["state"] == TASK_STATES["TIMEOUT"]:
-                        self.log_info("Killing timed out task %r (pid %r)" % (task_id, pid))
-                        if self.cleanup_task(task_id):
-                            del self.pid_dict[task_id]
-                            finished_tasks.add(task_id)
-                    elif "worker_id" in task and task["worker_id"] != self.worker_info["id"]:
-                        self.log_info("Killing reassigned task %r (pid %r)" % (task_id, pid))
-                        # TODO: Task.cleanup() - be careful, cleanup may remove running task's data!
-                        if self.cleanup_task(task_id):
-                            del self.pid_dict[task_id]
-                    else:
-                        self.log_warning("Lingering task %r (pid %r)" % (task_id, pid))
-                except (ShutdownException, KeyboardInterrupt):
-                    raise
-                except Exception:
-                    # TODO: do not catch generic error
-                    self.log_error("Invalid task %r (pid %r)" % (task_id, pid))
-                    raise
+        try:
+            result = self.hub.worker.heartbeat(state)
+        except Fault, ex:
+            if "PermissionDenied" not in ex.faultString:
+                raise
+            # session has expired
+            self.hub._login(force=True)
+            result = self.hub.worker.heartbeat(state)
+
+        self.worker_info = result["worker_info"]
+        self.wait_cursor = result.get("wait_cursor")
+        task_info_dict = dict(( (int(task_id), task_info) for task_id, task_info in result["task_info"].iteritems() ))
+
+        self.task_dict = {}
+        for task_info in result["tasks"]:
+            self.log_debug("Checking task: %s." % self._task_str(task_info))
+            self.task_dict[task_info["id"]] = task_info
+            self.wakeup_task(task_info)
+        self.log_debug("Current tasks: %r" % self.task_dict.keys())
+
+        if result["interrupted"]:
+            self.log_warning("Closed interrupted tasks: %r" % result["interrupted"])
+            finished_tasks.update(result["interrupted"])
+
+        if result["timed_out"]:
+            self.log_warning("Closed timed out tasks: %r" % result["timed_out"])
+            finished_tasks.update(result["timed_out"])
+
+        for task_id, pid in self.pid_dict.items():
+            if task_id in self.task_dict:
+                continue
+            # see update_tasks() for when this is expected to happen
+            task = task_info_dict.get(task_id)
+            if task is None:
+                self.log_error("Invalid task %r (pid %r)" % (task_id, pid))
+            elif task["state"] in (TASK_STATES["CANCELED"], TASK_STATES["TIMEOUT"]):
+                if task["state"] == TASK_STATES["CANCELED"]:
+                    self.log_info("Killing canceled task %r (pid %r)" % (task_id, pid))
+                else:
+                    self.log_info("Killing timed out task %r (pid %r)" % (task_id, pid))
+                if self.cleanup_task(task_id):
+                    del self.pid_dict[task_id]
+                    finished_tasks.add(task_id)
+            elif task["worker"] != self.worker_info["id"]:
+                self.log_info("Killing reassigned task %r (pid %r)" % (task_id, pid))
+                if self.cleanup_task(task_id):
+                    del self.pid_dict[task_id]
+            else:
+                self.log_warning("Lingering task %r (pid %r)" % (task_id, pid))
 
         for task_id in sorted(finished_tasks):
-            task_info = self.hub.worker.get_task(task_id)
-            self.finish_task(task_info)
+            if task_id in task_info_dict:
+                self.finish_task(task_info_dict[task_id])
 
-        self.update_worker_info()
+        if self.locked:
+            self.get_next_task()
+        elif not self.worker_info["enabled"]:
+            self.log_info("Worker is disabled.")
+        elif not self.worker_info["ready"]:
+            self.log_info("Worker is not ready to take another task.")
+
+        self.log_debug("Claimed tasks: %r" % [ task_info["id"] for task_info in result["claimed"] ])
+        for task_info in result["claimed"]:
+            self.log_info("Taking claimed task %s" % self._task_str(task_info))
+            self.task_dict[task_info["id"]] = task_info
+            self.start_task(task_info)
 
     def get_next_task(self):
         """ """
@@ -280,12 +437,43 @@ class TaskManager(kobo.log.LoggingBase):
 
             return
 
-        assigned_task_list = self.hub.worker.get_tasks_to_assign()
-        self.log_debug("Current assigned tasks: %r" % [ task_info["id"] for task_info in assigned_task_list ])
+        if not self.use_claim_tasks:
+            assigned_task_list = self.hub.worker.get_tasks_to_assign()
+            self.log_debug("Current assigned tasks: %r" % [ task_info["id"] for task_info in assigned_task_list ])
 
-        # process assigned tasks first
-        for task_info in assigned_task_list:
-            self.take_task(task_info)
+            # process assigned tasks first
+            for task_info in assigned_task_list:
+                self.take_task(task_info)
+            return
+
+        # pick and open tasks on hub in a single call
+        max_load = self.worker_info["max_load"] - self.worker_info["current_load"]
+        try:
+            claimed_task_list = self.hub.worker.claim_tasks(max_load, self.get_task_classes())
+        except Fault, ex:
+            if "is not supported" not in ex.faultString:
+                raise
+            self.log_info("Hub doesn't support worker.claim_tasks, opening tasks one by one.")
+            self.use_claim_tasks = False
+            return self.get_next_task()
+        self.log_debug("Claimed tasks: %r" % [ task_info["id"] for task_info in claimed_task_list ])
+
+        for task_info in claimed_task_list:
+            self.log_info("Taking claimed task %s" % self._task_str(task_info))
+            self.start_task(task_info)
+
+    def get_task_classes(self):
+        """Return supported tasks in a format suitable for hub.worker.claim_tasks()."""
+        result = {}
+        for method in self.task_container:
+            TaskClass = self.task_container[method]
+            result[method] = {
+                "arches": list(getattr(TaskClass, "arches", [])),
+                "channels": list(getattr(TaskClass, "channels", [])),
+                "exclusive": bool(getattr(TaskClass, "exclusive", False)),
+                "weight": getattr(TaskClass, "weight", 1),
+            }
+        return result
 
     def take_task(self, task_info):
         """Attempt to open the specified task. Return True on success, False otherwise."""
@@ -333,6 +521,12 @@ class TaskManager(kobo.log.LoggingBase):
             self.log_error("Cannot open task %s: %s" % (self._task_str(task_info), reason))
             return
 
+        self.start_task(task_info)
+
+    def start_task(self, task_info):
+        """Run an opened task, either in foreground or in a forked process."""
+        TaskClass = self.task_container[task_info["method"]]
+
         self.worker_info["current_load"] += TaskClass.weight
         self.worker_info["ready"] = self.worker_info["current_load"] < self.worker_info["max_load"]
 
@@ -385,7 +579,13 @@ class TaskManager(kobo.log.LoggingBase):
         task = TaskClass(hub, self.conf, task_info["id"], task_info["args"])
 
         # redirect stdout and stderr
-        thread = kobo.worker.logger.LoggingThread(hub, task_info["id"])
+        thread = kobo.worker.logger.LoggingThread(hub, task_info["id"],
+            buffer_size=self.conf.get("TASK_LOG_BUFFER_SIZE", 1024 ** 2),
+            flush_size=self.conf.get("TASK_LOG_FLUSH_SIZE", 1200),
+            flush_interval=self.conf.get("TASK_LOG_FLUSH_INTERVAL", 5),
+            max_retry_delay=self.conf.get("TASK_LOG_MAX_RETRY_DELAY", 60),
+            spool_dir=self.conf.get("TASK_LOG_SPOOL_DIR", None),
+            logger=self._logger)
         sys.stdout = kobo.worker.logger.LoggingIO(open(os.devnull, "w"), thread)
         sys.stderr = sys.stdout
         thread.start()
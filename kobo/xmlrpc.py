@@ -4,17 +4,26 @@
 import base64
 import cookielib
 import fcntl
+import gzip
 import hashlib
 import httplib
+import itertools
 import os
 import socket
 import ssl
 import sys
 import threading
 import time
+import urllib
 import urllib2
 import xmlrpclib
 import urlparse
+from cStringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import kobo.shortcuts
 
@@ -28,6 +37,7 @@ except ImportError:
 __all__ = (
     "CookieTransport",
     "SafeCookieTransport",
+    "JSONRPCServerProxy",
     "retry_request_decorator",
     "encode_xmlrpc_chunks_iterator",
     "decode_xmlrpc_chunk",
@@ -37,6 +47,30 @@ __all__ = (
 CONNECTION_LOCK = threading.Lock()
 
 
+if hasattr(xmlrpclib, "gzip_encode"):
+    gzip_encode = xmlrpclib.gzip_encode
+    gzip_decode = xmlrpclib.gzip_decode
+else:
+    # python 2.6-
+    def gzip_encode(data):
+        """Return data compressed by gzip."""
+        result = StringIO()
+        gz = gzip.GzipFile(mode="wb", fileobj=result, compresslevel=1)
+        gz.write(data)
+        gz.close()
+        return result.getvalue()
+
+    def gzip_decode(data):
+        """Return data decompressed by gzip, raise ValueError on invalid data."""
+        gz = gzip.GzipFile(mode="rb", fileobj=StringIO(data))
+        try:
+            return gz.read()
+        except IOError:
+            raise ValueError("invalid data")
+        finally:
+            gz.close()
+
+
 class TimeoutHTTPConnection(httplib.HTTPConnection):
     def connect(self):
         httplib.HTTPConnection.connect(self)
@@ -205,14 +239,37 @@ class CookieTransport(xmlrpclib.Transport):
         import kobo.xmlrpc
         client = xmlrpclib.ServerProxy("http://<server>/xmlrpc", transport=kobo.xmlrpc.CookieTransport())
         # for https:// connections use kobo.xmlrpc.SafeCookieTransport() instead.
+
+    Up to pool_size idle keep-alive connections per host are kept for reuse
+    (0 disables the pool). Connections idle for more than keep_alive_timeout
+    seconds are closed instead of reused, servers drop them anyway.
+    The pool belongs to the transport instance and is dropped in forked
+    processes, so a forked task process with a new HubProxy opens new
+    connections. TLS sessions are not resumed (the ssl module of Python 2
+    has no session API), each new https connection does a full handshake.
+
+    Responses may be gzip compressed. Request bodies larger than gzip_threshold
+    bytes are compressed once the server announced "Accept-Encoding: gzip"
+    in a response (None disables request compression).
+
+    Requests are sent with content_type, JSONRPCServerProxy switches it to
+    application/json. Responses are parsed according to their Content-Type.
     """
 
     _use_datetime = False # fix for python 2.5+
     scheme = "http"
+    content_type = "text/xml"
 
     def __init__(self, *args, **kwargs):
         cookiejar = kwargs.pop("cookiejar", None)
         self.timeout = kwargs.pop("timeout", 0)
+        self.pool_size = kwargs.pop("pool_size", 2)
+        self.keep_alive_timeout = kwargs.pop("keep_alive_timeout", 4)
+        self.gzip_threshold = kwargs.pop("gzip_threshold", 16 * 1024)
+        self._gzip_hosts = set() # hosts accepting gzip compressed requests
+        self._pool = {} # host -> [(connection, release time)]
+        self._pool_lock = threading.Lock()
+        self._pool_pid = os.getpid()
         self.proxy_config = self._get_proxy(**kwargs)
         self.no_proxy = os.environ.get("no_proxy", "").lower().split(',')
         self.context = kwargs.pop('context', None)
@@ -278,6 +335,70 @@ class CookieTransport(xmlrpclib.Transport):
         return proxy_settings
 
     def make_connection(self, host):
+        """Return an idle pooled connection to host or a new one."""
+        conn = self._get_pooled_connection(host)
+        if conn is None:
+            conn = self._new_connection(host)
+        return conn
+
+    def _get_pooled_connection(self, host):
+        self._pool_lock.acquire()
+        try:
+            if self._pool_pid != os.getpid():
+                # sockets inherited from the parent process must not be shared
+                self._pool = {}
+                self._pool_pid = os.getpid()
+            idle = self._pool.get(host, [])
+            while idle:
+                conn, released = idle.pop()
+                if time.time() - released < self.keep_alive_timeout:
+                    return conn
+                conn.close()
+            return None
+        finally:
+            self._pool_lock.release()
+
+    def _release_connection(self, host, conn, response):
+        """Return a connection with fully read response to the pool."""
+        if response.will_close or not self.pool_size:
+            conn.close()
+            return
+        self._pool_lock.acquire()
+        try:
+            idle = self._pool.setdefault(host, [])
+            if self._pool_pid == os.getpid() and len(idle) < self.pool_size:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._pool_lock.release()
+        conn.close()
+
+    def _discard_connection(self, host, conn):
+        """Close a failed connection, idle connections to host are likely stale as well."""
+        conn.close()
+        self._pool_lock.acquire()
+        try:
+            idle = self._pool.pop(host, [])
+        finally:
+            self._pool_lock.release()
+        for i, released in idle:
+            i.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._pool_lock.acquire()
+        try:
+            pool = self._pool
+            self._pool = {}
+        finally:
+            self._pool_lock.release()
+        for idle in pool.itervalues():
+            for conn, released in idle:
+                conn.close()
+        if hasattr(xmlrpclib.Transport, "close"):
+            xmlrpclib.Transport.close(self)
+
+    def _new_connection(self, host):
         host.lower()
         host_ = host  # Host with(out) port
         if ':' in host:
@@ -307,8 +428,10 @@ class CookieTransport(xmlrpclib.Transport):
             return conn
         else:
             CONNECTION_LOCK.acquire()
-            self._connection = (None, None) # this disables connection caching which causes a race condition when running in threads
+            # xmlrpclib caches a single connection which is not thread safe, connections are pooled by this class
+            self._connection = (None, None)
             conn = xmlrpclib.Transport.make_connection(self, host)
+            self._connection = (None, None)
             CONNECTION_LOCK.release()
             if self.timeout:
                 conn.timeout = self.timeout
@@ -320,6 +443,30 @@ class CookieTransport(xmlrpclib.Transport):
     def send_host(self, connection, host):
         return xmlrpclib.Transport.send_host(self, connection, host)
 
+    def send_content(self, connection, request_body, encode=False):
+        """Send the request body, gzip compressed if encode is set."""
+        if sys.version_info[:2] < (2, 7):
+            return xmlrpclib.Transport.send_content(self, connection, request_body)
+
+        connection.putheader("Content-Type", self.content_type)
+        if encode:
+            request_body = gzip_encode(request_body)
+            connection.putheader("Content-Encoding", "gzip")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        """Parse XML-RPC or decode JSON-RPC response data."""
+        if not hasattr(response, "getheader") or not response.getheader("Content-Type", "").startswith("application/json"):
+            return xmlrpclib.Transport.parse_response(self, response)
+
+        data = response.read()
+        if response.getheader("Content-Encoding", "") == "gzip":
+            data = gzip_decode(data)
+        if self.verbose:
+            print "body:", repr(data)
+        return json.loads(data)
+
     def send_cookies(self, connection, cookie_request):
         """Add cookies to the header."""
         self.cookiejar.add_cookie_header(cookie_request)
@@ -328,6 +475,45 @@ class CookieTransport(xmlrpclib.Transport):
             if header.startswith("Cookie"):
                 connection.putheader(header, value)
 
+    def raw_request(self, host, method, handler, body, headers=None):
+        """Send a plain HTTP request with the session cookies.
+
+        @return: (status, reason, response headers, response body)
+        @rtype:  (int, str, httplib.HTTPMessage, str)
+        """
+        request_url = "%s://%s/" % (self.scheme, host)
+        cookie_request = urllib2.Request(request_url)
+
+        for attempt in (0, 1):
+            h = self._get_pooled_connection(host)
+            reused = h is not None
+            if not reused:
+                h = self._new_connection(host)
+            try:
+                h.putrequest(method, handler)
+                self.send_cookies(h, cookie_request)
+                h.putheader("Content-Length", str(len(body)))
+                for header, value in sorted((headers or {}).items()):
+                    h.putheader(header, value)
+                h.endheaders()
+                h.send(body)
+                response = h.getresponse()
+                data = response.read()
+            except (socket.error, httplib.BadStatusLine):
+                self._discard_connection(host, h)
+                if not reused or attempt:
+                    raise
+                # the server closed an idle connection, retry with a new one
+                continue
+            except:
+                self._discard_connection(host, h)
+                raise
+            self._release_connection(host, h, response)
+            break
+
+        self._save_cookies(response.msg, cookie_request)
+        return response.status, response.reason, response.msg, data
+
     def _save_cookies(self, headers, cookie_request):
         cookie_response = CookieResponse(headers)
         self.cookiejar.extract_cookies(cookie_response, cookie_request)
@@ -445,12 +631,14 @@ class CookieTransport(xmlrpclib.Transport):
         if verbose:
             h.set_debuglevel(1)
 
+        encode = self.gzip_threshold is not None and len(request_body) > self.gzip_threshold and host in self._gzip_hosts
+
         try:
             self.send_request(h, handler, request_body)
             self.send_host(h, host)
             self.send_cookies(h, cookie_request)
             self.send_user_agent(h)
-            self.send_content(h, request_body)
+            self.send_content(h, request_body, encode)
 
             response = h.getresponse(buffering=True)
 
@@ -466,7 +654,7 @@ class CookieTransport(xmlrpclib.Transport):
                 self._extra_headers = [("Authorization", "Negotiate %s" % challenge)]
                 self.send_host(h, host)
                 self.send_user_agent(h)
-                self.send_content(h, request_body)
+                self.send_content(h, request_body, encode)
                 self._extra_headers = []
                 response = h.getresponse(buffering=True)
                 self._kerberos_verify_response(vc, host, handler, response.status, response.reason, response.msg)
@@ -474,18 +662,29 @@ class CookieTransport(xmlrpclib.Transport):
             if response.status == 200:
                 self.verbose = verbose
                 self._save_cookies(response.msg, cookie_request)
-                return self.parse_response(response)
+                if "gzip" in response.getheader("Accept-Encoding", ""):
+                    self._gzip_hosts.add(host)
+                try:
+                    result = self.parse_response(response)
+                except xmlrpclib.Fault:
+                    # the whole response was read, connection can be reused
+                    self._release_connection(host, h, response)
+                    raise
+                self._release_connection(host, h, response)
+                return result
         except xmlrpclib.Fault:
             raise
         except Exception:
             # All unexpected errors leave connection in
             # a strange state, so we clear it.
-            self.close()
+            # xmlrpclib.Transport.request() retries once on a dropped keep-alive connection.
+            self._discard_connection(host, h)
             raise
 
         # discard any response data and raise exception
         if (response.getheader("content-length", 0)):
             response.read()
+        h.close()
         raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
 
     # override the appropriate request method
@@ -505,7 +704,7 @@ class SafeCookieTransport(xmlrpclib.SafeTransport, CookieTransport):
     """
     scheme = "https"
 
-    def make_connection(self, host):
+    def _new_connection(self, host):
         host.lower()
         host_ = host  # Host with(out) port
         if ':' in host:
@@ -534,7 +733,11 @@ class SafeCookieTransport(xmlrpclib.SafeTransport, CookieTransport):
             conn.set_timeout(self.timeout)
             return conn
         else:
+            CONNECTION_LOCK.acquire()
+            self._connection = (None, None)
             conn = xmlrpclib.SafeTransport.make_connection(self, host)
+            self._connection = (None, None)
+            CONNECTION_LOCK.release()
             if self.timeout:
                 conn.timeout = self.timeout
             return conn
@@ -547,9 +750,16 @@ class SafeCookieTransport(xmlrpclib.SafeTransport, CookieTransport):
         # python 2.6-
         request = CookieTransport._request
 
+    # SafeTransport methods would take precedence over the pooling ones
+    make_connection = CookieTransport.make_connection
+    close = CookieTransport.close
+    send_content = CookieTransport.send_content
+    parse_response = CookieTransport.parse_response
+
     def __init__(self, *args, **kwargs):
         self.context = kwargs.pop('context', None)
-        xmlrpclib.SafeTransport.__init__(self, *args, **kwargs)
+        # SafeTransport doesn't know CookieTransport keyword arguments
+        xmlrpclib.SafeTransport.__init__(self, *args)
         CookieTransport.__init__(self, *args, **kwargs)
 
     def send_request(self, connection, handler, request_body):
@@ -559,6 +769,54 @@ class SafeCookieTransport(xmlrpclib.SafeTransport, CookieTransport):
         return xmlrpclib.SafeTransport.send_host(self, connection, host)
 
 
+class JSONRPCServerProxy(object):
+    """
+    JSON-RPC 2.0 counterpart of xmlrpclib.ServerProxy for kobo hubs.
+
+    The transport must be a CookieTransport, its content_type is switched
+    to application/json. Errors are raised as xmlrpclib.Fault.
+
+    USAGE:
+    >>> import kobo.xmlrpc
+        client = kobo.xmlrpc.JSONRPCServerProxy("http://<server>/xmlrpc/client/", transport=kobo.xmlrpc.CookieTransport())
+        client.task_info(1)
+    """
+
+    def __init__(self, uri, transport, verbose=False):
+        scheme, rest = urllib.splittype(uri)
+        self.__host, self.__handler = urllib.splithost(rest)
+        if not self.__handler:
+            self.__handler = "/RPC2"
+        self.__transport = transport
+        self.__transport.content_type = "application/json"
+        self.__verbose = verbose
+        self.__ids = itertools.count(1)
+
+    def __request(self, method_name, params):
+        request_body = json.dumps({"jsonrpc": "2.0", "method": method_name, "params": params, "id": self.__ids.next()}, default=_json_default)
+        response = self.__transport.request(self.__host, self.__handler, request_body, verbose=self.__verbose)
+        if not isinstance(response, dict):
+            raise xmlrpclib.ResponseError("Not a JSON-RPC response: %r" % (response, ))
+        error = response.get("error")
+        if error:
+            raise xmlrpclib.Fault(error.get("code"), error.get("message"))
+        return response.get("result")
+
+    def __repr__(self):
+        return "<JSONRPCServerProxy for %s%s>" % (self.__host, self.__handler)
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__request, name)
+
+
+def _json_default(value):
+    if isinstance(value, xmlrpclib.DateTime):
+        return str(value)
+    if isinstance(value, xmlrpclib.Binary):
+        return value.data.encode("base64")
+    raise TypeError("cannot serialize %r" % type(value))
+
+
 def retry_request_decorator(transport_class):
     """Use this class decorator on a Transport to retry requests which failed on socket errors."""
     class RetryTransportClass(transport_class):
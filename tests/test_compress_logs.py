@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import stat
+from StringIO import StringIO
+
+from shutil import rmtree
+
+import django
+import django.conf
+import django.test
+from django.core.management import call_command
+from django.test.utils import get_runner
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, Arch, Channel, Worker, LogCompression, TASK_STATES
+from django.contrib.auth.models import User
+
+
+class TestCompressLogs(django.test.TestCase):
+    def setUp(self):
+        super(TestCompressLogs, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+        self.tasks = []
+
+    def tearDown(self):
+        for task in self.tasks:
+            if os.path.exists(task.task_dir()):
+                rmtree(task.task_dir())
+        super(TestCompressLogs, self).tearDown()
+
+    def create_task(self):
+        task = Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", state=TASK_STATES["OPEN"], worker=self.worker)
+        self.tasks.append(task)
+        task.logs["stdout.log"] = "output\n" * 1000
+        task.logs["traceback.log"] = "traceback\n"
+        task.logs.save()
+        return task
+
+    def log_path(self, task, name):
+        return os.path.join(task.task_dir(), name)
+
+    def compress_logs(self):
+        stdout = StringIO()
+        call_command("compress_logs", processes=2, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_close_task_enqueues(self):
+        task = self.create_task()
+        task.close_task(task_result="done")
+
+        self.assertEqual(list(LogCompression.objects.values_list("task", flat=True)), [task.id])
+        self.assertTrue(os.path.isfile(self.log_path(task, "stdout.log")))
+        self.assertFalse(os.path.isfile(self.log_path(task, "stdout.log.gz")))
+
+    def test_compress_logs(self):
+        tasks = [ self.create_task() for i in range(3) ]
+        for task in tasks:
+            task.fail_task()
+        # tasks may be enqueued more times
+        LogCompression.objects.create(task=tasks[0])
+
+        output = self.compress_logs()
+        self.assertTrue("Compressed 6 log(s) of 3 task(s)" in output)
+        self.assertTrue("MB/s" in output)
+        self.assertEqual(LogCompression.objects.count(), 0)
+
+        for task in tasks:
+            self.assertFalse(os.path.isfile(self.log_path(task, "stdout.log")))
+            self.assertTrue(os.path.isfile(self.log_path(task, "stdout.log.gz")))
+            self.assertEqual(stat.S_IMODE(os.stat(self.log_path(task, "traceback.log.gz")).st_mode), 0600)
+
+            logs = Task.objects.get(id=task.id).logs
+            self.assertEqual(logs["stdout.log"], "output\n" * 1000)
+            self.assertEqual(sorted(logs.list), ["stdout.log", "traceback.log"])
+
+        self.assertTrue("Compressed 0 log(s) of 0 task(s)" in self.compress_logs())
+
+    def test_gzip_logs(self):
+        task = self.create_task()
+        self.assertEqual(task.logs.gzip_logs(), (2, 7010))
+        self.assertEqual(task.logs.gzip_logs(), (0, 0))
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+from StringIO import StringIO
+
+import django
+import django.conf
+import django.test
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from django.contrib.auth.models import User
+
+
+class TestCounters(django.test.TestCase):
+    def setUp(self):
+        super(TestCounters, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=2)
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def get_worker(self):
+        return Worker.objects.get(id=self.worker.id)
+
+    def assertWorkerCounters(self, task_count, current_load, ready):
+        worker = self.get_worker()
+        self.assertEqual((worker.task_count, worker.current_load, worker.ready), (task_count, current_load, ready))
+
+    def test_subtask_count(self):
+        parent = self.create_task()
+        child = self.create_task(parent=parent)
+        self.create_task(parent=parent)
+        self.create_task(parent=child)
+        self.assertEqual(Task.objects.get(id=parent.id).subtask_count, 2)
+        self.assertEqual(Task.objects.get(id=child.id).subtask_count, 1)
+
+        # stale instance doesn't overwrite the counter
+        parent.label = "label"
+        parent.save()
+        self.assertEqual(Task.objects.get(id=parent.id).subtask_count, 2)
+
+        Task.objects.get(id=child.id).delete()
+        self.assertEqual(Task.objects.get(id=parent.id).subtask_count, 1)
+
+    def test_subtask_change_doesnt_save_ancestors(self):
+        def state_change_queries(depth):
+            parent = None
+            for i in range(depth):
+                parent = self.create_task(parent=parent, state=TASK_STATES["OPEN"], worker=self.worker)
+            task = Task.objects.get(id=parent.id)
+            with CaptureQueriesContext(connection) as queries:
+                task.close_task(task_result="done")
+            return len(queries)
+
+        # the first state change loads the worker to the reference cache
+        state_change_queries(1)
+        self.assertEqual(state_change_queries(2), state_change_queries(10))
+
+    def test_state_transitions(self):
+        task = self.create_task(weight=1)
+        self.assertWorkerCounters(0, 0, True)
+
+        task.open_task(self.worker.id)
+        self.assertWorkerCounters(1, 1, True)
+
+        other = self.create_task(weight=1)
+        other.open_task(self.worker.id)
+        self.assertWorkerCounters(2, 2, False)
+
+        Task.objects.get(id=other.id).wait()
+        self.assertWorkerCounters(2, 1, True)
+
+        Task.objects.get(id=other.id).close_task()
+        task.fail_task()
+        self.assertWorkerCounters(0, 0, True)
+
+    def test_cancel_assigned(self):
+        task = self.create_task()
+        task.assign_task(self.worker.id)
+        task.cancel_task()
+        self.assertWorkerCounters(0, 0, True)
+
+    def test_claim(self):
+        tasks = [ self.create_task(weight=i) for i in (1, 2) ]
+        Task.objects.claim(self.worker.id, [ i.id for i in tasks ])
+        self.assertWorkerCounters(2, 3, False)
+
+    def test_worker_save_keeps_counters(self):
+        worker = self.get_worker()
+        self.create_task(state=TASK_STATES["OPEN"], worker=self.worker)
+        worker.max_load = 1
+        worker.save()
+        self.assertWorkerCounters(1, 1, False)
+
+    def test_reconcile(self):
+        parent = self.create_task()
+        self.create_task(parent=parent, state=TASK_STATES["OPEN"], worker=self.worker, weight=2)
+        self.create_task(state=TASK_STATES["OPEN"], worker=self.worker, waiting=True)
+        Task.objects.filter(id=parent.id).update(subtask_count=5)
+        Worker.objects.filter(id=self.worker.id).update(task_count=0, current_load=7, ready=False)
+
+        stdout = StringIO()
+        call_command("reconcile_counters", stdout=stdout)
+        self.assertTrue("worker test-worker" in stdout.getvalue())
+        self.assertEqual(Task.objects.get(id=parent.id).subtask_count, 1)
+        self.assertWorkerCounters(2, 2, False)
+
+        self.assertEqual(Task.objects.reconcile_subtask_counts(), 0)
+        self.assertEqual(Worker.objects.reconcile(), [])
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, TaskArchive, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import client
+from kobo.hub.xmlrpc import worker as worker_xmlrpc
+from django.contrib.auth.models import User
+
+
+class FakeRequest(object):
+    def __init__(self, user, worker=None):
+        self.user = user
+        self.worker = worker
+
+
+class TestCreateTasks(django.test.TestCase):
+    def setUp(self):
+        super(TestCreateTasks, self).setUp()
+        self.user = User.objects.create(username="testuser", is_superuser=True)
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+
+    def get_kwargs(self, count, **kwargs):
+        result = []
+        for i in range(count):
+            task_kwargs = {"owner_name": "testuser", "method": "DummyTask", "label": "task-%s" % i, "args": {"number": i}}
+            task_kwargs.update(kwargs)
+            result.append(task_kwargs)
+        return result
+
+    def test_create_tasks(self):
+        task_ids = client.create_tasks(FakeRequest(self.user), self.get_kwargs(5, priority=20))
+        self.assertEqual(task_ids, sorted(task_ids))
+        for i, task_id in enumerate(task_ids):
+            task = Task.objects.get(id=task_id)
+            self.assertEqual((task.label, task.args, task.priority, task.state), ("task-%s" % i, {"number": i}, 20, TASK_STATES["FREE"]))
+            self.assertEqual(task.resubmitted_by, self.user)
+            self.assertFalse(os.path.exists(task.task_dir()))
+
+        # ids continue after tasks created one by one
+        task_id = Task.create_task("testuser", "label", "DummyTask")
+        self.assertEqual(client.create_tasks(FakeRequest(self.user), self.get_kwargs(1)), [task_id + 1])
+        self.assertEqual(client.create_tasks(FakeRequest(self.user), []), [])
+
+    def test_skip_archived_ids(self):
+        task_id = Task.create_task("testuser", "label", "DummyTask")
+        task = Task.objects.get(id=task_id)
+        TaskArchive.from_task(task).save()
+        task.delete()
+        self.assertEqual(Task.create_tasks(self.get_kwargs(1)), [task_id + 1])
+
+    def test_validate_before_insert(self):
+        kwargs_list = self.get_kwargs(3)
+        kwargs_list[2]["arch_name"] = "x86_64"
+        self.assertRaises(Arch.DoesNotExist, Task.create_tasks, kwargs_list)
+
+        kwargs_list = self.get_kwargs(3)
+        kwargs_list[1]["parent_id"] = 123456
+        self.assertRaises(Task.DoesNotExist, Task.create_tasks, kwargs_list)
+
+        kwargs_list = self.get_kwargs(3)
+        kwargs_list[0]["task_id"] = 1
+        self.assertRaises(ValueError, client.create_tasks, FakeRequest(self.user), kwargs_list)
+
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_counters(self):
+        parent_id = Task.create_task("testuser", "label", "DummyTask")
+        Task.create_tasks(self.get_kwargs(3, parent_id=parent_id) + self.get_kwargs(2, worker_name="test-worker", state=TASK_STATES["OPEN"]))
+        self.assertEqual(Task.objects.get(id=parent_id).subtask_count, 3)
+
+        # worker_name implies the ASSIGNED state, like in create_task()
+        worker = Worker.objects.get(id=self.worker.id)
+        self.assertEqual((worker.task_count, worker.current_load), (0, 0))
+        self.assertEqual(Task.objects.filter(worker=self.worker, state=TASK_STATES["ASSIGNED"]).count(), 2)
+
+    def test_constant_query_count(self):
+        def create_queries(count):
+            with CaptureQueriesContext(connection) as queries:
+                Task.create_tasks(self.get_kwargs(count))
+            return len(queries)
+
+        create_queries(1)
+        self.assertEqual(create_queries(2), create_queries(20))
+        # inserts are split only by the database parameter limit
+        self.assertTrue(create_queries(1000) < 50)
+
+    def test_create_subtasks(self):
+        parent = Task.objects.get(id=Task.create_task("testuser", "label", "DummyTask", worker_name="test-worker"))
+        request = FakeRequest(self.user, Worker.objects.get(id=self.worker.id))
+        subtask_ids = worker_xmlrpc.create_subtasks(request, [{"method": "DummyTask", "args": {"number": i}} for i in range(3)], parent.id)
+        self.assertEqual([ Task.objects.get(id=i).args["number"] for i in subtask_ids ], [0, 1, 2])
+        self.assertEqual(sorted(i.id for i in Task.objects.get(id=parent.id).subtasks()), subtask_ids)
+        self.assertEqual(Task.objects.get(id=parent.id).subtask_count, 3)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
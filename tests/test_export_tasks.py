@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES, export_tasks
+from kobo.hub.xmlrpc import client
+from django.contrib.auth.models import User
+
+
+class TestExportTasks(django.test.TestCase):
+    def setUp(self):
+        super(TestExportTasks, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+        self.worker.arches.add(self.arch)
+        self.worker.channels.add(self.channel)
+
+    def create_task(self, **kwargs):
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def create_tree(self, width):
+        root = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker)
+        children = [ self.create_task(parent=root, resubmitted_by=self.user) for i in range(width) ]
+        for i in range(width):
+            self.create_task(parent=children[0])
+        return root
+
+    def test_export(self):
+        root = self.create_tree(2)
+        info = Task.objects.get(id=root.id).export(flat=False)
+        self.assertEqual(info["worker"]["arches"], [self.arch.export()])
+        self.assertEqual(info["channel"], self.channel.export())
+        self.assertEqual(info["parent"], None)
+        self.assertEqual(len(info["subtask_id_list"]), 2)
+
+        child = Task.objects.get(id=info["subtask_id_list"][-1])
+        info = child.export(flat=False)
+        self.assertEqual(info["parent"], Task.objects.get(id=root.id).export())
+        self.assertEqual(info["resubmitted_by"], "testuser")
+        self.assertEqual(info["worker"], None)
+
+        tasks = Task.objects.order_by("id")
+        self.assertEqual(export_tasks(tasks, flat=False), [ i.export(flat=False) for i in tasks ])
+        self.assertEqual(export_tasks(tasks), [ i.export() for i in tasks ])
+
+    def test_query_count(self):
+        def export_queries(width):
+            self.create_tree(width)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(len(client.get_tasks(None, list(Task.objects.values_list("id", flat=True)))), Task.objects.count())
+                export_tasks(Task.objects.all(), flat=False)
+            Task.objects.all().delete()
+            return len(queries)
+
+        self.assertEqual(export_queries(2), export_queries(20))
+
+    def test_task_info(self):
+        root = self.create_tree(1)
+        with CaptureQueriesContext(connection) as queries:
+            info = client.task_info(None, root.id, flat=False)
+        self.assertEqual(info["worker"]["name"], "test-worker")
+        self.assertTrue(len(queries) <= 6, queries.captured_queries)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
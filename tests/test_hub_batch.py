@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import xmlrpclib
+
+import django
+import django.conf
+import django.test
+from django.test.utils import get_runner, override_settings
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.client import HubBatch
+from kobo.xmlrpc import CookieTransport
+
+
+def echo(request, value):
+    return value
+
+
+def fail(request):
+    raise ValueError("failed")
+
+
+def fault(request):
+    raise xmlrpclib.Fault(3, "custom fault")
+
+
+with override_settings(XMLRPC_METHODS={"test": ((echo, "test.echo"), (fail, "test.fail"), (fault, "test.fault"))}):
+    from kobo.django.xmlrpc import views
+
+
+class FakeResponse(object):
+    def __init__(self, response):
+        self.response = response
+        self.data = response.content
+
+    def getheader(self, name, default=None):
+        return self.response.get(name, default)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        result, self.data = self.data[:size], self.data[size:]
+        return result
+
+
+class ViewTransport(CookieTransport):
+    """Pass requests directly to the test XML-RPC handler, count them."""
+
+    def __init__(self):
+        CookieTransport.__init__(self)
+        self.requests = 0
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.requests += 1
+        request = django.test.RequestFactory().post(handler, request_body, content_type=self.content_type)
+        self.verbose = verbose
+        return self.parse_response(FakeResponse(views.test_handler(request)))
+
+
+class TestHubBatch(django.test.SimpleTestCase):
+    def setUp(self):
+        self.transport = ViewTransport()
+        self.hub = xmlrpclib.ServerProxy("http://localhost/xmlrpc/test/", transport=self.transport, allow_none=True)
+
+    def test_batch(self):
+        with HubBatch(self.hub) as batch:
+            calls = [ batch.test.echo(i) for i in range(10) ]
+            failed = batch.test.fail()
+            faulted = batch.test.fault()
+            missing = batch.test.missing()
+            last = batch.test.echo({"a": None})
+            self.assertRaises(RuntimeError, getattr, last, "result")
+
+        self.assertEqual(self.transport.requests, 1)
+        self.assertEqual([ i.result for i in calls ], range(10))
+        self.assertEqual(last.result, {"a": None})
+
+        try:
+            failed.result
+        except xmlrpclib.Fault, ex:
+            self.assertEqual((ex.faultCode, ex.faultString), (1, "ValueError: failed"))
+        else:
+            self.fail("Fault not raised")
+
+        try:
+            faulted.result
+        except xmlrpclib.Fault, ex:
+            self.assertEqual((ex.faultCode, ex.faultString), (3, "custom fault"))
+        else:
+            self.fail("Fault not raised")
+
+        self.assertRaises(xmlrpclib.Fault, getattr, missing, "result")
+
+    def test_chunks(self):
+        batch = HubBatch(self.hub)
+        batch.max_calls = 4
+        calls = [ batch.test.echo(i) for i in range(10) ]
+        self.assertEqual(batch.send(), calls)
+        self.assertEqual(self.transport.requests, 3)
+        self.assertEqual([ i.result for i in calls ], range(10))
+
+        # nothing queued, nothing sent
+        self.assertEqual(batch.send(), [])
+        self.assertEqual(self.transport.requests, 3)
+
+    def test_not_sent_on_error(self):
+        try:
+            with HubBatch(self.hub) as batch:
+                batch.test.echo(1)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.transport.requests, 0)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import sys
+import xmlrpclib
+
+import django
+import django.conf
+import django.test
+from django.test.utils import get_runner, override_settings
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.client import HubProxy
+from kobo.django.xmlrpc.serializers import XMLRPCSerializer, JSONRPCSerializer, get_serializer
+from kobo.xmlrpc import CookieTransport, JSONRPCServerProxy
+
+
+def echo(request, value):
+    return value
+
+
+def fail(request):
+    raise ValueError("failed")
+
+
+def renew_session(request):
+    return False
+
+
+with override_settings(XMLRPC_METHODS={"test": ((echo, "echo"), (fail, "fail"), (renew_session, "auth.renew_session"))}):
+    from kobo.django.xmlrpc import views
+
+
+class FakeResponse(object):
+    def __init__(self, response):
+        self.response = response
+        self.data = response.content
+
+    def getheader(self, name, default=None):
+        return self.response.get(name, default)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        result, self.data = self.data[:size], self.data[size:]
+        return result
+
+
+class ViewTransport(CookieTransport):
+    """Pass requests directly to the test XML-RPC handler."""
+
+    def __init__(self, json_support=True):
+        CookieTransport.__init__(self)
+        self.json_support = json_support
+        self.content_types = []
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.content_types.append(self.content_type)
+        if self.content_type == "application/json" and not self.json_support:
+            raise xmlrpclib.ProtocolError(host + handler, 500, "INTERNAL SERVER ERROR", {})
+        request = django.test.RequestFactory().post(handler, request_body, content_type=self.content_type)
+        self.verbose = verbose
+        return self.parse_response(FakeResponse(views.test_handler(request)))
+
+
+class TestSerializers(django.test.SimpleTestCase):
+    def test_xmlrpc_dumps(self):
+        values = [
+            {"id": 1, "label": "<a & b>", u"unicode": u"žluťoučký", "args": {"list": [1, -2, 2 ** 31 - 1, None, True, False, 1.5, (1, "x")]}},
+            [],
+            {},
+            "",
+            xmlrpclib.DateTime(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+            xmlrpclib.Binary("\x00\x01"),
+        ]
+        serializer = XMLRPCSerializer()
+        for value in values:
+            self.assertEqual(serializer.dumps_result(value), xmlrpclib.dumps((value, ), methodresponse=1, allow_none=True))
+
+        self.assertRaises(OverflowError, serializer.dumps_result, 2 ** 31)
+        self.assertRaises(TypeError, serializer.dumps_result, {1: 2})
+        self.assertRaises(TypeError, XMLRPCSerializer(allow_none=False).dumps_result, None)
+
+    def test_get_serializer(self):
+        self.assertTrue(isinstance(get_serializer("application/json; charset=utf-8"), JSONRPCSerializer))
+        self.assertTrue(isinstance(get_serializer("text/xml"), XMLRPCSerializer))
+        self.assertTrue(isinstance(get_serializer(None), XMLRPCSerializer))
+
+
+class TestJSONRPC(django.test.SimpleTestCase):
+    def call(self, data):
+        request = django.test.RequestFactory().post("/xmlrpc/test/", data, content_type="application/json")
+        response = views.test_handler(request)
+        self.assertEqual(response["Content-Type"], "application/json")
+        return json.loads(response.content)
+
+    def test_handler(self):
+        self.assertEqual(self.call(json.dumps({"jsonrpc": "2.0", "method": "echo", "params": [{"a": [1, None]}], "id": 7})),
+                         {"jsonrpc": "2.0", "result": {"a": [1, None]}, "id": 7})
+
+        result = self.call(json.dumps({"jsonrpc": "2.0", "method": "fail", "params": [], "id": 8}))
+        self.assertEqual((result["error"], result["id"]), ({"code": 1, "message": "ValueError: failed"}, 8))
+
+        self.assertEqual(self.call("{")["error"]["code"], -32700)
+        self.assertEqual(self.call("[]")["error"]["code"], -32600)
+
+        # XML-RPC is still the default
+        request = django.test.RequestFactory().post("/xmlrpc/test/", xmlrpclib.dumps(("x", ), "echo"), content_type="text/xml")
+        self.assertEqual(xmlrpclib.loads(views.test_handler(request).content)[0], ("x", ))
+
+    def test_server_proxy(self):
+        transport = ViewTransport()
+        proxy = JSONRPCServerProxy("http://localhost/xmlrpc/test/", transport=transport)
+        value = {"list": [1, "x", None, True], "date": xmlrpclib.DateTime(datetime.datetime(2020, 1, 2, 3, 4, 5))}
+        self.assertEqual(proxy.echo(value), {"list": [1, "x", None, True], "date": "20200102T03:04:05"})
+        self.assertRaises(xmlrpclib.Fault, proxy.fail)
+        self.assertEqual(transport.content_types, ["application/json"] * 2)
+
+    def get_hub(self, transport):
+        hub = HubProxy.__new__(HubProxy)
+        hub._conf = {"HUB_PROTOCOL": "jsonrpc"}
+        hub._hub = None
+        hub._hub_url = "http://localhost/xmlrpc"
+        hub._client_type = "test"
+        hub._transport = transport
+        hub._logger = None
+        hub._auth_method = "password"
+        hub._auto_logout = False
+        hub._login()
+        return hub
+
+    def test_hub_proxy(self):
+        transport = ViewTransport()
+        hub = self.get_hub(transport)
+        self.assertTrue(isinstance(hub._hub, JSONRPCServerProxy))
+        self.assertEqual(hub.echo("x"), "x")
+        self.assertEqual(transport.content_types, ["application/json"] * 2)
+
+    def test_hub_proxy_old_hub(self):
+        transport = ViewTransport(json_support=False)
+        hub = self.get_hub(transport)
+        self.assertFalse(isinstance(hub._hub, JSONRPCServerProxy))
+        self.assertEqual(hub.echo("x"), "x")
+        self.assertEqual(transport.content_types, ["application/json", "text/xml", "text/xml"])
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import run_tests # set sys.path
+
+import threading
+import time
+from xmlrpclib import Fault
+
+import mock
+
+from kobo.worker.logger import LoggingThread
+
+
+class FakeHub(object):
+    def __init__(self):
+        self.data = []
+        self.fail = 0
+        self.attempts = 0
+        self.event = threading.Event()
+        self.event.set()
+        self.callback = None
+
+    def upload_task_log(self, file_obj, task_id, remote_file_name, append=True, mode=0644):
+        self.attempts += 1
+        self.event.wait()
+        if self.callback is not None:
+            self.callback()
+        if self.fail:
+            self.fail -= 1
+            raise Fault(1, "hub is down")
+        self.data.append(file_obj.read())
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestLoggingThread(unittest.TestCase):
+    def start(self, **kwargs):
+        self.hub = FakeHub()
+        kwargs.setdefault("retry_delay", 0.01)
+        kwargs.setdefault("logger", mock.Mock())
+        thread = LoggingThread(self.hub, 1, **kwargs)
+        thread.start()
+        return thread
+
+    def test_stop(self):
+        thread = self.start(flush_interval=60)
+        thread.write("line 1\n")
+        thread.write(u"žluťoučký\n")
+        thread.stop()
+        self.assertEqual("".join(self.hub.data), "line 1\n" + u"žluťoučký\n".encode("utf-8"))
+        self.assertEqual(thread.get_metrics()["bytes_sent"], len("".join(self.hub.data)))
+
+    def test_flush_size(self):
+        thread = self.start(flush_size=10, flush_interval=60)
+        thread.write("x" * 5)
+        # the first write is sent right away
+        self.assertTrue(wait_for(lambda: self.hub.data == ["x" * 5]))
+        thread.write("x" * 5)
+        time.sleep(0.1)
+        self.assertEqual(len(self.hub.data), 1)
+        thread.write("x" * 5)
+        self.assertTrue(wait_for(lambda: len(self.hub.data) == 2))
+        thread.stop()
+
+    def test_flush_interval(self):
+        thread = self.start(flush_size=1000, flush_interval=0.2)
+        thread.write("a")
+        self.assertTrue(wait_for(lambda: len(self.hub.data) == 1))
+        thread.write("b")
+        thread.write("c")
+        self.assertTrue(wait_for(lambda: len(self.hub.data) == 2))
+        self.assertEqual(self.hub.data, ["a", "bc"])
+        thread.stop()
+
+    def test_hub_down(self):
+        thread = self.start(flush_size=1, buffer_size=4)
+        self.hub.fail = 4
+        for i in range(20):
+            thread.write("%02d" % i)
+        self.assertTrue(wait_for(lambda: thread.get_metrics()["send_failures"] == 4))
+        thread.stop()
+
+        metrics = thread.get_metrics()
+        self.assertEqual("".join(self.hub.data), "".join("%02d" % i for i in range(20)))
+        self.assertEqual((metrics["bytes_sent"], metrics["bytes_spooled"], metrics["bytes_buffered"]), (40, 0, 0))
+        # spooled data is replayed in buffer sized chunks
+        self.assertTrue(max(len(i) for i in self.hub.data) <= 4)
+
+    def test_give_up(self):
+        thread = self.start(stop_retries=2)
+        self.hub.fail = 1000
+        thread.write("lost")
+        thread.stop()
+        self.assertEqual(self.hub.data, [])
+        # the first attempt and two retries
+        self.assertEqual(self.hub.attempts, 3)
+        self.assertEqual(thread.get_metrics()["bytes_spooled"], 4)
+        self.assertTrue("dropped 4 bytes" in thread._logger.error.call_args[0][0])
+
+    def test_backpressure(self):
+        thread = self.start(flush_size=1, buffer_size=10)
+        self.hub.event.clear()
+        thread.write("a" * 8)
+        self.assertTrue(wait_for(lambda: self.hub.attempts == 1))
+
+        writer = threading.Thread(target=lambda: [ thread.write(i * 8) for i in ("b", "c") ])
+        writer.start()
+        time.sleep(0.2)
+        # the upload is stuck, "c" doesn't fit into the buffer
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(thread.get_metrics()["bytes_buffered"], 8)
+
+        self.hub.event.set()
+        writer.join()
+        thread.stop()
+        self.assertEqual("".join(self.hub.data), "a" * 8 + "b" * 8 + "c" * 8)
+
+    def test_write_from_logging_thread(self):
+        thread = self.start(flush_size=1, buffer_size=4, flush_interval=60)
+
+        def callback():
+            # output printed while uploading must not wait for the full buffer
+            self.hub.callback = None
+            thread.write("yyyy")
+            thread.write("zzzz")
+
+        self.hub.callback = callback
+        thread.write("xxxx")
+        thread.stop()
+        self.assertEqual("".join(self.hub.data), "xxxxyyyyzzzz")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub import refcache
+from kobo.hub.middleware import get_worker
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import client
+from kobo.hub.xmlrpc import worker as worker_xmlrpc
+from django.contrib.auth.models import User
+
+
+class FakeRequest(object):
+    def __init__(self, user):
+        self.user = user
+        self.worker = None
+
+
+class TestRefCache(django.test.TestCase):
+    def setUp(self):
+        super(TestRefCache, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.worker_user = User.objects.create(username="worker/test-worker")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+        self.worker.arches.add(self.arch)
+        self.worker.channels.add(self.channel)
+
+    def get_stats(self, model):
+        return refcache.get_stats()["%s.%s" % (model._meta.app_label, model._meta.model_name)]
+
+    def test_create_task(self):
+        Task.create_task("testuser", "label", "DummyTask", worker_name="test-worker")
+        hits = self.get_stats(Arch)["hits"]
+        with CaptureQueriesContext(connection) as queries:
+            task_id = Task.create_task("testuser", "label", "DummyTask", worker_name="test-worker")
+        self.assertEqual(self.get_stats(Arch)["hits"], hits + 1)
+
+        tables = [ table for table in ("hub_arch", "hub_channel", "hub_worker", "auth_user") if [ i for i in queries.captured_queries if i["sql"].startswith("SELECT") and ('FROM "%s"' % table) in i["sql"] ] ]
+        self.assertEqual(tables, [])
+
+        task = Task.objects.get(id=task_id)
+        self.assertEqual((task.owner, task.worker, task.arch, task.channel), (self.user, self.worker, self.arch, self.channel))
+
+    def test_middleware(self):
+        request = FakeRequest(self.worker_user)
+        self.assertEqual(get_worker(request), self.worker)
+        misses = self.get_stats(Worker)["misses"]
+        with CaptureQueriesContext(connection) as queries:
+            worker = get_worker(request)
+            self.assertEqual(worker.export()["arches"], [self.arch.export()])
+        # only the counters are loaded
+        self.assertEqual(len(queries), 1)
+        self.assertTrue("hub_arch" not in queries.captured_queries[0]["sql"])
+        self.assertEqual(self.get_stats(Worker)["misses"], misses)
+        self.assertEqual(get_worker(FakeRequest(self.user)), None)
+
+    def test_invalidate(self):
+        request = FakeRequest(self.worker_user)
+        self.assertEqual(get_worker(request).enabled, True)
+
+        # copies are returned, changing them doesn't affect the cache
+        get_worker(request).max_load = 10
+        self.assertEqual(get_worker(request).max_load, 1)
+
+        self.user.is_superuser = True
+        client.disable_worker(FakeRequest(self.user), "test-worker")
+        self.assertEqual(get_worker(request).enabled, False)
+
+        worker = Worker.objects.get(id=self.worker.id)
+        worker.max_load = 5
+        worker.save()
+        self.assertEqual(get_worker(request).max_load, 5)
+
+        self.worker.arches.clear()
+        self.assertEqual(get_worker(request).export()["arches"], [])
+
+    def test_load_changes(self):
+        request = FakeRequest(self.worker_user)
+        get_worker(request)
+        version = refcache._get_version("hub.worker")
+
+        # counters are not cached, load changes don't invalidate workers
+        task = Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", state=TASK_STATES["OPEN"], worker=self.worker)
+        self.assertEqual(refcache._get_version("hub.worker"), version)
+        misses = self.get_stats(Worker)["misses"]
+
+        # counters of cached workers are loaded in a single query
+        with CaptureQueriesContext(connection) as queries:
+            worker = get_worker(request)
+            self.assertEqual((worker.task_count, worker.current_load, worker.ready), (1, 1, False))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.get_stats(Worker)["misses"], misses)
+
+        request.worker = get_worker(request)
+        self.assertEqual(worker_xmlrpc.get_worker_info(request)["task_count"], 1)
+        task.close_task()
+        self.assertEqual(refcache._get_version("hub.worker"), version)
+        request.worker = get_worker(request)
+        self.assertEqual(worker_xmlrpc.get_worker_info(request)["task_count"], 0)
+        self.assertEqual(worker_xmlrpc.update_worker(request, True, True, 0)["ready"], True)
+
+    def test_other_process(self):
+        refcache.get(Arch, name="noarch")
+        Arch.objects.filter(id=self.arch.id).update(pretty_name="changed")
+        self.assertEqual(refcache.get(Arch, name="noarch").pretty_name, "noarch")
+
+        # another process replaces the stamp file
+        stamp_file = refcache._get_stamp_file("hub.arch")
+        os.rename(stamp_file, stamp_file + ".old")
+        open(stamp_file, "w").close()
+        os.unlink(stamp_file + ".old")
+        self.assertEqual(refcache.get(Arch, name="noarch").pretty_name, "changed")
+
+    def test_does_not_exist(self):
+        self.assertRaises(Arch.DoesNotExist, refcache.get, Arch, name="x86_64")
+        self.assertRaises(Arch.DoesNotExist, Task.create_task, "testuser", "label", "DummyTask", arch_name="x86_64")
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
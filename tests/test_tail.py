@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import unittest
+import os
+import random
+import sys
+import tempfile
+import time
+import unittest2 as unittest
 from StringIO import StringIO
 
 from kobo.hub.models import _tail as tail
@@ -17,6 +22,16 @@ SAMPLE_LINES = [
 ]
 SAMPLE_STRING = '\n'.join(SAMPLE_LINES)
 
+# Run with KOBO_TAIL_BENCHMARK_MB=1024 to tail a 1GB log.
+BENCHMARK_MB = int(os.environ.get("KOBO_TAIL_BENCHMARK_MB", 16))
+
+
+class NonSeekable(object):
+    """File wrapper forcing tail to read from the beginning."""
+
+    def __init__(self, fh):
+        self.readline = fh.readline
+
 
 class TestTail(unittest.TestCase):
 
@@ -58,6 +73,50 @@ class TestTail(unittest.TestCase):
         self.assertEqual(actual, expected)
         self.assertEqual(offset, len(SAMPLE_STRING))
 
+    def test_tail_seek(self):
+        """tail of a seekable file reads the end only, result doesn't change"""
+        rand = random.Random(0)
+        lines = [ "x" * rand.choice([0, 1, 5, 10, 30, 100]) for i in range(2000) ]
+        data = "\n".join(lines)
+
+        for max_size, max_line_size in ((40, 10), (100, 1024), (1000, 50), (len(data), 10)):
+            expected = tail(NonSeekable(StringIO(data)), max_size, max_line_size)
+            fh = StringIO(data)
+            self.assertEqual(tail(fh, max_size, max_line_size), expected)
+
+    def test_tail_long_line(self):
+        """lines longer than the search limit are split at the search start"""
+        data = "a\n" + "x" * (3 * 1024 ** 2)
+        (actual, offset) = tail(StringIO(data), 40, 10)
+
+        self.assertEqual(actual, "x" * 40)
+        self.assertEqual(offset, len(data))
+
+    def test_tail_benchmark(self):
+        """compare tail of a big log with reading the whole file"""
+        fd, path = tempfile.mkstemp(prefix="kobo-test-tail-")
+        self.addCleanup(os.unlink, path)
+        # 1MB of 32 byte lines
+        block = "".join("%08d some build output line\n" % i for i in range(1024 ** 2 / 32))
+        fo = os.fdopen(fd, "wb")
+        for i in xrange(BENCHMARK_MB):
+            fo.write(block)
+        fo.close()
+
+        fh = open(path, "rb")
+        start = time.time()
+        (actual, offset) = tail(fh, 64 * 1024, 8192)
+        seek_time = time.time() - start
+        fh.seek(0)
+        start = time.time()
+        expected = tail(NonSeekable(fh), 64 * 1024, 8192)
+        read_time = time.time() - start
+        fh.close()
+
+        sys.stderr.write("\n%s MB log: tail %.4fs, reading the whole file %.4fs\n" % (BENCHMARK_MB, seek_time, read_time))
+        self.assertEqual((actual, offset), expected)
+        self.assertEqual(offset, BENCHMARK_MB * 1024 ** 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import sys
+from StringIO import StringIO
+
+from shutil import rmtree
+
+import django
+import django.conf
+import django.test
+from django.core.management import call_command
+from django.test.utils import get_runner
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, TaskArchive, Arch, Channel, Worker, LogCompression, TASK_STATES
+from kobo.hub.xmlrpc import client
+from django.contrib.auth.models import User
+
+
+class TestTaskArchive(django.test.TestCase):
+    def setUp(self):
+        super(TestTaskArchive, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+        self.old = datetime.datetime.now() - datetime.timedelta(days=100)
+        self.task_ids = []
+
+    def tearDown(self):
+        for task_id in self.task_ids:
+            for task_dir in (Task.get_task_dir(task_id), TaskArchive.get_task_dir(task_id)):
+                if os.path.exists(task_dir):
+                    rmtree(task_dir)
+        super(TestTaskArchive, self).tearDown()
+
+    def create_task(self, dt_finished=None, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["CLOSED"])
+        task = Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", worker=self.worker, **kwargs)
+        Task.objects.filter(id=task.id).update(dt_finished=dt_finished or self.old)
+        self.task_ids.append(task.id)
+        return task
+
+    def archive_tasks(self, **kwargs):
+        stdout = StringIO()
+        call_command("archive_tasks", stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_archive(self):
+        parent = self.create_task()
+        child = self.create_task(parent=parent, result="child result")
+        child.logs["stdout.log"] = "output"
+        child.logs.save()
+        recent = self.create_task(dt_finished=datetime.datetime.now())
+        running = self.create_task(state=TASK_STATES["OPEN"])
+
+        # the parent is archived together with its child
+        output = self.archive_tasks(batch_size=1)
+        self.assertTrue("Archived 2 task(s) in 1 batch(es)." in output)
+        self.assertEqual(sorted(TaskArchive.objects.values_list("id", flat=True)), [parent.id, child.id])
+        self.assertEqual(sorted(Task.objects.values_list("id", flat=True)), [recent.id, running.id])
+
+        archived = TaskArchive.objects.get(id=child.id)
+        self.assertEqual((archived.parent_id, archived.worker_id, archived.result), (parent.id, self.worker.id, "child result"))
+        self.assertEqual(archived.logs["stdout.log"], "output")
+        self.assertFalse(os.path.exists(Task.get_task_dir(child.id)))
+
+        self.assertTrue("Archived 0 task(s) in 0 batch(es)." in self.archive_tasks())
+
+    def test_keep_referenced_tasks(self):
+        resubmitted = self.create_task(state=TASK_STATES["FAILED"])
+        self.create_task(state=TASK_STATES["OPEN"], resubmitted_from=resubmitted)
+        queued = self.create_task()
+        LogCompression.objects.create(task=queued)
+        parent = self.create_task()
+        self.create_task(parent=parent, state=TASK_STATES["OPEN"])
+        # a subtask referenced by a resubmitted task keeps the whole tree
+        tree = self.create_task()
+        self.create_task(parent=self.create_task(parent=tree))
+        self.create_task(state=TASK_STATES["OPEN"], resubmitted_from=self.create_task(parent=tree, state=TASK_STATES["FAILED"]))
+
+        self.assertEqual(self.archive_tasks(), "Archived 0 task(s) in 0 batch(es).\n")
+
+    def test_keep_subtasks_of_live_tasks(self):
+        parent = self.create_task(state=TASK_STATES["OPEN"])
+        child = self.create_task(parent=parent)
+
+        self.assertEqual(self.archive_tasks(), "Archived 0 task(s) in 0 batch(es).\n")
+        parent = Task.objects.get(id=parent.id)
+        self.assertEqual(parent.subtask_count, 1)
+        self.assertEqual([ i.id for i in parent.subtasks() ], [child.id])
+
+    def test_skip_blocked_trees(self):
+        blocked = self.create_task()
+        self.create_task(parent=blocked, state=TASK_STATES["OPEN"])
+        task = self.create_task()
+
+        self.assertEqual(TaskArchive.objects.archive(datetime.datetime.now() - datetime.timedelta(days=1), batch_size=1), 1)
+        self.assertEqual(list(TaskArchive.objects.values_list("id", flat=True)), [task.id])
+
+    def test_max_batches(self):
+        tasks = [ self.create_task() for i in range(3) ]
+        self.assertTrue("Archived 2 task(s) in 2 batch(es)." in self.archive_tasks(batch_size=1, max_batches=2))
+        # continue where it stopped
+        self.assertTrue("Archived 1 task(s) in 1 batch(es)." in self.archive_tasks(batch_size=1))
+        self.assertEqual(TaskArchive.objects.count(), len(tasks))
+
+    def test_xmlrpc_fallback(self):
+        parent = self.create_task()
+        child = self.create_task(parent=parent)
+        live = self.create_task(dt_finished=datetime.datetime.now())
+        expected = Task.objects.get(id=child.id).export(flat=True)
+        TaskArchive.objects.archive(datetime.datetime.now() - datetime.timedelta(days=1), batch_size=1)
+
+        self.assertEqual(client.task_info(None, child.id, flat=True), expected)
+        info = client.task_info(None, child.id, flat=False)
+        self.assertEqual(info["parent"]["id"], parent.id)
+        self.assertEqual(info["worker"]["name"], "test-worker")
+        self.assertRaises(Task.DoesNotExist, client.task_info, None, 123456)
+
+        tasks = client.get_tasks(None, [parent.id, child.id, live.id])
+        self.assertEqual([ i["id"] for i in tasks ], [live.id, child.id, parent.id])
+        self.assertEqual(client.get_tasks(None, [child.id], [TASK_STATES["FAILED"]]), [])
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
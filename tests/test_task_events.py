@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import sys
+from StringIO import StringIO
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.core.management import call_command
+from django.test.utils import get_runner
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub import views
+from kobo.hub.models import Task, TaskEvent, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import client
+from django.contrib.auth.models import User
+
+
+class TestTaskEvents(django.test.TestCase):
+    def setUp(self):
+        super(TestTaskEvents, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=100)
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def run_task(self):
+        task = self.create_task()
+        task.open_task(self.worker.id)
+        Task.objects.get(id=task.id).close_task()
+        return task
+
+    def test_get_task_events(self):
+        tasks = [ self.run_task() for i in range(3) ]
+
+        result = client.get_task_events(None, 0, 4)
+        self.assertEqual(result["more"], True)
+        self.assertEqual([ (i["task_id"], i["new_state"]) for i in result["events"] ], [
+            (tasks[0].id, TASK_STATES["FREE"]),
+            (tasks[0].id, TASK_STATES["OPEN"]),
+            (tasks[0].id, TASK_STATES["CLOSED"]),
+            (tasks[1].id, TASK_STATES["FREE"]),
+        ])
+        self.assertEqual(result["events"][1]["worker_id"], self.worker.id)
+
+        result = client.get_task_events(None, result["seq"])
+        self.assertEqual((result["more"], len(result["events"])), (False, 5))
+        seq = result["seq"]
+        self.assertEqual(client.get_task_events(None, seq), {"seq": seq, "more": False, "events": []})
+
+        task = self.run_task()
+        result = client.get_task_events(None, seq)
+        self.assertEqual([ i["task_id"] for i in result["events"] ], [task.id] * 3)
+
+    def test_cursor(self):
+        self.assertEqual(TaskEvent.objects.get_cursor(), 0)
+        task = self.run_task()
+        # committed events are visible right away
+        self.assertEqual(TaskEvent.objects.get_cursor(), TaskEvent.objects.filter(task_id=task.id).order_by("-id")[0].id)
+
+    def test_record_locks_seq(self):
+        with mock.patch.object(TaskEvent.objects, "_lock_seq") as lock_seq:
+            self.run_task()
+        self.assertEqual(lock_seq.call_count, 3)
+
+    def test_json(self):
+        self.run_task()
+        factory = django.test.RequestFactory()
+        response = views.task_events_json(factory.get("/task/events-json/", {"since": 0, "limit": 2}))
+        result = json.loads(response.content)
+        self.assertEqual((result["more"], len(result["events"])), (True, 2))
+
+        response = views.task_events_json(factory.get("/task/events-json/", {"since": result["seq"]}))
+        self.assertEqual(len(json.loads(response.content)["events"]), 1)
+
+        self.assertEqual(views.task_events_json(factory.get("/task/events-json/", {"since": "x"})).status_code, 400)
+
+    def test_prune(self):
+        old_tasks = [ self.run_task() for i in range(2) ]
+        TaskEvent.objects.update(dt_created=datetime.datetime.now() - datetime.timedelta(days=10))
+        TaskEvent.objects.filter(task_id=old_tasks[0].id).update(dt_created=datetime.datetime.now() - datetime.timedelta(days=100))
+        task = self.run_task()
+
+        stdout = StringIO()
+        call_command("prune_task_events", stdout=stdout)
+        self.assertTrue("Deleted 3 event(s) older than 90 day(s)." in stdout.getvalue())
+        self.assertTrue("Compacted 2 event(s) older than 7 day(s)." in stdout.getvalue())
+
+        self.assertEqual([ (i.task_id, i.new_state) for i in TaskEvent.objects.all() ], [
+            (old_tasks[1].id, TASK_STATES["CLOSED"]),
+            (task.id, TASK_STATES["FREE"]),
+            (task.id, TASK_STATES["OPEN"]),
+            (task.id, TASK_STATES["CLOSED"]),
+        ])
+
+    def test_compact_batches(self):
+        tasks = [ self.run_task() for i in range(5) ]
+        TaskEvent.objects.update(dt_created=datetime.datetime.now() - datetime.timedelta(days=10))
+        # a task changed before and after dt_before keeps its last old event
+        TaskEvent.objects.record([(tasks[0].id, TASK_STATES["CLOSED"], TASK_STATES["FREE"], None)])
+        dt_before = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.assertEqual(TaskEvent.objects.compact(dt_before, batch_size=2), 10)
+        self.assertEqual([ (i.task_id, i.new_state) for i in TaskEvent.objects.all() ],
+            [ (i.id, TASK_STATES["CLOSED"]) for i in tasks ] + [(tasks[0].id, TASK_STATES["FREE"])])
+        self.assertEqual(TaskEvent.objects.compact(dt_before, batch_size=2), 0)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
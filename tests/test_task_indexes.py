@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check that hot hub_task queries use indexes on a big synthetic table.
+
+Runs only with KOBO_INDEX_BENCHMARK_TASKS set to the number of tasks to load
+(100k takes a few seconds, 1M tasks is a realistic size of a busy hub).
+"""
+
+import datetime
+import os
+import random
+import sys
+import time
+import unittest2 as unittest
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from django.contrib.auth.models import User
+
+
+TASK_COUNT = int(os.environ.get("KOBO_INDEX_BENCHMARK_TASKS", 0))
+CHANNEL_COUNT = 20
+WORKER_COUNT = 50
+
+
+def _generate_tasks(owner_id, arch_id, channel_ids, worker_ids):
+    """Generate rows of a typical hub: most tasks finished, a few free or running, half of them subtasks."""
+    now = datetime.datetime.now()
+    for task_id in xrange(1, TASK_COUNT + 1):
+        r = random.random()
+        if r < 0.01:
+            state, worker_id = TASK_STATES["FREE"], None
+        elif r < 0.015:
+            state, worker_id = TASK_STATES["ASSIGNED"], random.choice(worker_ids)
+        elif r < 0.02:
+            state, worker_id = TASK_STATES["OPEN"], random.choice(worker_ids)
+        else:
+            state, worker_id = random.choice((TASK_STATES["CLOSED"], TASK_STATES["FAILED"])), random.choice(worker_ids)
+        parent_id = task_id > 1 and task_id % 2 == 0 and random.randint(1, task_id - 1) or None
+        awaited = parent_id is not None and random.random() < 0.1
+        yield (task_id, False, state, "", False, "DummyTask", "{}", "", False, awaited, now, random.randint(0, 30), 1, 0, arch_id, random.choice(channel_ids), owner_id, parent_id, worker_id)
+
+
+@unittest.skipUnless(TASK_COUNT, "KOBO_INDEX_BENCHMARK_TASKS not set")
+@unittest.skipUnless(django.VERSION >= (1, 8), "indexes are created by migrations, setUpTestData() needs Django 1.8")
+class TestTaskIndexes(django.test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="testuser")
+        arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        channel_ids = [ Channel.objects.create(name="channel-%s" % i).id for i in range(CHANNEL_COUNT) ]
+        worker_ids = [ Worker.objects.create(name="worker-%s" % i).id for i in range(WORKER_COUNT) ]
+        cls.channel_id = channel_ids[0]
+        cls.worker_id = worker_ids[0]
+
+        start = time.time()
+        cursor = connection.cursor()
+        cursor.executemany("""
+INSERT INTO hub_task
+  (id, archive, state, label, exclusive, method, args, result, waiting, awaited, dt_created, priority, weight, subtask_count, arch_id, channel_id, owner_id, parent_id, worker_id)
+VALUES
+  (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+""", _generate_tasks(owner.id, arch.id, channel_ids, worker_ids))
+        cursor.execute("ANALYZE")
+        sys.stderr.write("\nLoaded %d tasks in %.1f s\n" % (TASK_COUNT, time.time() - start))
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [ row[-1] for row in cursor.fetchall() ]
+        else:
+            cursor.execute("EXPLAIN " + sql, params)
+            plan = [ row[0] for row in cursor.fetchall() ]
+
+        start = time.time()
+        list(queryset)
+        sys.stderr.write("%8.2f ms: %s\n" % ((time.time() - start) * 1000, " | ".join(plan)))
+        return plan
+
+    def assertIndexScan(self, queryset, index_name=None):
+        plan = self.explain(queryset)
+        for line in plan:
+            if connection.vendor == "sqlite":
+                if " hub_task" in line:
+                    self.assertTrue(" USING " in line, "Not an index scan: %s" % line)
+            elif connection.vendor == "postgresql":
+                self.assertFalse("Seq Scan on hub_task" in line, "Not an index scan: %s" % line)
+        if index_name is not None:
+            self.assertTrue(index_name in "\n".join(plan), "Index %s not used: %s" % (index_name, plan))
+
+    def test_free_channel_tasks(self):
+        queryset = Task.objects.free().filter(awaited=False, channel=self.channel_id, priority__gte=5).order_by("-priority", "id").values_list("id", "priority")[:10]
+        self.assertIndexScan(queryset, "hub_task_free_channel")
+
+    def test_free_awaited_tasks(self):
+        queryset = Task.objects.free().filter(awaited=True).order_by("-priority", "id").values_list("id", "priority")[:10]
+        self.assertIndexScan(queryset, "hub_task_free_awaited")
+
+    def test_worker_tasks(self):
+        worker = Worker.objects.get(id=self.worker_id)
+        self.assertIndexScan(worker.running_tasks())
+        self.assertIndexScan(worker.assigned_tasks().filter(exclusive=True).order_by("-priority", "id")[:10])
+
+    def test_subtasks(self):
+        task = Task.objects.filter(subtask_count=0, parent__isnull=False).order_by("id")[0]
+        self.assertIndexScan(Task.objects.get(id=task.parent_id).subtasks())
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import shutil
+import sys
+import xmlrpclib
+from StringIO import StringIO
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.test.utils import get_runner
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from django.core.urlresolvers import resolve
+
+from kobo.client import HubProxy
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from django.contrib.auth.models import User
+
+
+class FakeWorkerProxy(object):
+    def __init__(self):
+        self.calls = []
+
+    def upload_task_log(self, *args):
+        self.calls.append(args)
+
+
+class FakeHub(object):
+    def __init__(self):
+        self.worker = FakeWorkerProxy()
+
+
+def call_view(method, path, data, content_type="application/octet-stream", worker=None, **extra):
+    """Call a hub view as a worker."""
+    request = django.test.RequestFactory().generic(method, path, data, content_type=content_type, **extra)
+    request.worker = worker
+    match = resolve(request.path)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+class ViewTransport(object):
+    """Pass raw requests directly to hub views."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.requests = []
+
+    def raw_request(self, host, method, handler, body, headers=None):
+        self.requests.append((method, handler, len(body)))
+        # the hub is deployed under /hub, like HUB_URL = http://localhost/hub/xmlrpc
+        if not handler.startswith("/hub/"):
+            return 404, "NOT FOUND", {}, ""
+        extra = dict(( ("HTTP_%s" % key.upper().replace("-", "_"), value) for key, value in headers.items() if key != "Content-Type" ))
+        response = call_view(method, handler[len("/hub"):], body, headers["Content-Type"], self.worker, **extra)
+        return response.status_code, response.reason_phrase, response, response.content
+
+
+class TestTaskLogUpload(django.test.TestCase):
+    def setUp(self):
+        super(TestTaskLogUpload, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker")
+        self.task = Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", state=TASK_STATES["OPEN"], worker=self.worker)
+        self.addCleanup(shutil.rmtree, self.task.task_dir(), True)
+
+    def put(self, data, log_name="stdout.log", checksum=None, **query):
+        url = "/task/%s/log/%s" % (self.task.id, log_name)
+        if query:
+            url += "?" + "&".join("%s=%s" % i for i in query.items())
+        extra = {}
+        if checksum is not None:
+            extra["HTTP_X_CHECKSUM"] = checksum
+        return call_view("PUT", url, data, worker=self.worker, **extra)
+
+    def read_log(self, log_name="stdout.log"):
+        return Task.objects.get(id=self.task.id).logs[log_name]
+
+    def test_append(self):
+        self.assertEqual(self.put("line 1\n")["X-Log-Size"], "7")
+        response = self.put("line 2\n", checksum=hashlib.sha256("line 2\n").hexdigest())
+        self.assertEqual((response.status_code, response["X-Log-Size"]), (200, "14"))
+        self.assertEqual(self.read_log(), "line 1\nline 2\n")
+
+    def test_offset(self):
+        self.put("abcdef")
+        self.assertEqual(self.put("XY", offset=2)["X-Log-Size"], "4")
+        self.assertEqual(self.read_log(), "abXY")
+        self.assertEqual(self.put("", offset=0)["X-Log-Size"], "0")
+        self.assertEqual(self.put("abc", offset=5).status_code, 400)
+        self.assertEqual(self.put("abc", offset=-1).status_code, 400)
+
+    def test_checksum_mismatch(self):
+        self.put("abc")
+        response = self.put("def", checksum=hashlib.sha256("xyz").hexdigest())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.read_log(), "abc")
+
+    def test_rejected(self):
+        self.assertEqual(self.put("abc", log_name="../escape.log").status_code, 400)
+
+        Worker.objects.create(name="other-worker")
+        Task.objects.filter(id=self.task.id).update(worker=Worker.objects.get(name="other-worker"))
+        self.assertEqual(self.put("abc").status_code, 403)
+
+        Task.objects.filter(id=self.task.id).update(worker=self.worker, state=TASK_STATES["CLOSED"])
+        response = self.put("abc")
+        self.assertEqual((response.status_code, response["X-Log-Size"]), (409, ""))
+
+    def get_hub(self, transport):
+        hub = HubProxy.__new__(HubProxy)
+        hub._hub = FakeHub()
+        hub._hub_url = "http://localhost/hub/xmlrpc"
+        hub._conf = {}
+        hub._logger = mock.Mock()
+        hub._transport = transport
+        hub._http_log_upload = True
+        return hub
+
+    def test_hub_proxy(self):
+        transport = ViewTransport(self.worker)
+        hub = self.get_hub(transport)
+
+        hub.upload_task_log(StringIO("traceback"), self.task.id, "traceback.log", append=False, mode=0600)
+        hub.upload_task_log(StringIO("line 1\n"), self.task.id, "stdout.log")
+        hub.upload_task_log(StringIO("line 2\n"), self.task.id, "stdout.log")
+        self.assertEqual(self.read_log(), "line 1\nline 2\n")
+        self.assertEqual(self.read_log("traceback.log"), "traceback")
+        self.assertEqual(hub._hub.worker.calls, [])
+        self.assertEqual([ i[0] for i in transport.requests ], ["PUT"] * 3)
+        self.assertTrue(transport.requests[0][1].startswith("/hub/task/%s/log/traceback.log?" % self.task.id))
+        self.assertRaises(xmlrpclib.ProtocolError, hub.upload_task_log, StringIO("x"), self.task.id, "../x.log")
+
+    def test_hub_proxy_old_hub(self):
+        class OldHubTransport(object):
+            def raw_request(self, host, method, handler, body, headers=None):
+                return 200, "OK", {}, "<html></html>"
+
+        hub = self.get_hub(OldHubTransport())
+        hub.upload_task_log(StringIO("line 1\n"), self.task.id, "stdout.log")
+        hub.upload_task_log(StringIO("line 2\n"), self.task.id, "stdout.log")
+        self.assertEqual([ i[1] for i in hub._hub.worker.calls ], ["stdout.log", "stdout.log"])
+        self.assertEqual(hub._http_log_upload, False)
+        self.assertTrue(hub._logger.warning.called)
+
+    def test_hub_proxy_errors(self):
+        class ErrorTransport(object):
+            def __init__(self, status, headers):
+                self.status = status
+                self.headers = headers
+
+            def raw_request(self, host, method, handler, body, headers=None):
+                return self.status, "ERROR", self.headers, ""
+
+        # a proxy error or an error of the upload view doesn't switch to XML-RPC
+        for status, headers in ((502, {}), (503, {}), (409, {"X-Log-Size": ""})):
+            hub = self.get_hub(ErrorTransport(status, headers))
+            self.assertRaises(xmlrpclib.ProtocolError, hub.upload_task_log, StringIO("x"), self.task.id, "stdout.log")
+            self.assertEqual((hub._http_log_upload, hub._hub.worker.calls), (True, []))
+
+        # missing endpoint
+        for status in (404, 405):
+            hub = self.get_hub(ErrorTransport(status, {}))
+            hub.upload_task_log(StringIO("x"), self.task.id, "stdout.log")
+            self.assertEqual((hub._http_log_upload, len(hub._hub.worker.calls)), (False, 1))
+
+    def test_hub_web_url(self):
+        hub = self.get_hub(None)
+        self.assertEqual(hub._get_hub_web_url(), "http://localhost/hub")
+        hub._hub_url = "http://localhost/hub/xmlrpc/"
+        self.assertEqual(hub._get_hub_web_url(), "http://localhost/hub")
+        hub._conf = {"HUB_WEB_URL": "https://web/kobo/"}
+        self.assertEqual(hub._get_hub_web_url(), "https://web/kobo")
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
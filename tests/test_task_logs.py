@@ -3,6 +3,12 @@
 
 import sys
 import os
+import gzip
+import json
+import warnings
+from StringIO import StringIO
+
+import mock
 
 from shutil import rmtree
 
@@ -19,7 +25,10 @@ if 'setup' in dir(django):
     # on settings being loaded before import.
     django.setup()
 
-from kobo.hub.models import Task, Arch, Channel
+from kobo.hub import views
+from kobo.hub.models import Task, TaskLogs, Arch, Channel, TaskLogFile, TASK_STATES, LOG_MANIFEST_NAME, _IndexedGzipReader
+from kobo.hub.xmlrpc import worker as worker_xmlrpc
+from kobo.xmlrpc import encode_xmlrpc_chunks_iterator
 from django.contrib.auth.models import User
 
 TASK_ID = 123
@@ -140,6 +149,229 @@ class TestTaskLogs(django.test.TestCase):
         self.assertEqual(chunk_min1, chunk_min3)
         self.assertEqual(chunk_min2, chunk_min3)
 
+    def test_lazy_log(self):
+        for name in ('test.log', 'test_compressed.log'):
+            log = self.task_logs()[name]
+            self.assertTrue(isinstance(log, TaskLogFile))
+            self.assertEqual(len(log), len(self.log_content))
+            self.assertEqual(log[1:3], b'in')
+            self.assertEqual(log[-6:], b'Line 3')
+            self.assertEqual(log[0], b'L')
+            self.assertEqual(list(log), self.log_content.splitlines(True))
+            self.assertEqual("".join(log.iter_chunks(chunk_size=4)), self.log_content)
+            self.assertNotEqual(log, self.log_content + "x")
+            # listed string methods still work, with a warning
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                self.assertEqual(log.splitlines(), self.log_content.splitlines())
+            self.assertEqual([w.category for w in caught], [DeprecationWarning])
+            self.assertRaises(AttributeError, getattr, log, "zfill")
+            self.assertEqual(str(log), self.log_content)
+
+        self.assertEqual(self.task_logs()['notexist.log'], "")
+
+    def test_streaming_save(self):
+        task_logs = self.task_logs()
+        task_logs['stream.log'] = (b'chunk %d\n' % i for i in range(3))
+        task_logs['file.log'] = StringIO(b'file content')
+        task_logs['copy.log'] = task_logs['test_compressed.log']
+        task_logs['sub/traceback.log'] = u'unicode ☺'.encode('utf-8').decode('utf-8')
+        task_logs.save()
+
+        task_logs = self.task_logs()
+        self.assertEqual(task_logs['stream.log'], b'chunk 0\nchunk 1\nchunk 2\n')
+        self.assertEqual(task_logs['file.log'], b'file content')
+        self.assertEqual(task_logs['copy.log'], self.log_content)
+        self.assertEqual(task_logs['sub/traceback.log'], u'unicode ☺'.encode('utf-8').decode('utf-8'))
+        path = task_logs._get_absolute_log_path('sub/traceback.log')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+
+        out = task_logs.writer('written.log')
+        out.write(b'abc')
+        out.close()
+        self.assertEqual(self.task_logs()['written.log'], b'abc')
+
+    def test_save_onto_itself(self):
+        for name in ('test.log', 'test_compressed.log'):
+            task_logs = self.task_logs()
+            task_logs[name] = task_logs[name]
+            task_logs.changed[name] = True
+            task_logs.save()
+            self.assertEqual(self.task_logs()[name], self.log_content)
+        self.assertFalse([ i for i in os.listdir(task_logs.task.task_dir()) if i.endswith('.tmp') ])
+
+    def test_no_open_files(self):
+        fd_dir = '/proc/self/fd'
+        if not os.path.isdir(fd_dir):
+            return
+        before = len(os.listdir(fd_dir))
+        task_logs = self.task_logs()
+        logs = [ task_logs[name] for name in ('test.log', 'test_compressed.log') ]
+        for log in logs:
+            self.assertEqual(log[1:3], b'in')
+            self.assertEqual(len(list(log)), 3)
+        self.assertEqual(len(os.listdir(fd_dir)), before)
+
+
+class TestCompressedTaskLogs(django.test.TestCase):
+    def setUp(self):
+        super(TestCompressedTaskLogs, self).setUp()
+        user = User.objects.create()
+        arch = Arch.objects.create(name='testarch')
+        channel = Channel.objects.create(name='testchannel')
+        self.task = Task.objects.create(arch=arch, channel=channel, owner=user)
+        self.addCleanup(rmtree, self.task.task_dir(), True)
+
+        self.log_content = "".join("line %04d ☺\n" % i for i in range(1000))
+        self.task.logs['test.log'] = self.log_content
+        self.task.logs.save()
+        with mock.patch("kobo.hub.models.LOG_GZIP_BLOCK_SIZE", 1000):
+            self.task.logs.gzip_logs()
+        self.gz_path = os.path.join(self.task.task_dir(), 'test.log.gz')
+
+    def task_logs(self):
+        return Task.objects.get(id=self.task.id).logs
+
+    def test_gzip_members(self):
+        self.assertFalse(os.path.exists(os.path.join(self.task.task_dir(), 'test.log')))
+        self.assertTrue(os.path.exists(self.gz_path + '.idx'))
+        self.assertEqual(self.task_logs().list, ['test.log'])
+
+        # readable by any gzip reader
+        self.assertEqual(gzip.open(self.gz_path).read(), self.log_content)
+        self.assertEqual(self.task_logs()['test.log'], self.log_content)
+
+    def test_get_chunk(self):
+        log_file = self.task_logs()._open_log('test.log')
+        self.assertTrue(isinstance(log_file, _IndexedGzipReader))
+        self.assertEqual(log_file.size, len(self.log_content))
+        # seeking to the end decompresses the last block only
+        log_file.seek(-10, os.SEEK_END)
+        self.assertTrue(log_file._file.tell() > os.path.getsize(self.gz_path) / 2)
+        self.assertEqual(log_file.read(), self.log_content[-10:])
+        log_file.close()
+
+        for offset in (0, 1, 999, 1000, 1001, 5555, len(self.log_content) - 1, len(self.log_content)):
+            self.assertEqual(self.task_logs().get_chunk('test.log', offset, 1500), self.log_content[offset:offset + 1500])
+        self.assertEqual(self.task_logs().get_chunk('test.log', 2500), self.log_content[2500:])
+
+    def test_short_member(self):
+        # an index claiming more data than the file holds must not loop forever
+        index = [(0, 0), (len(self.log_content) + 5000, os.path.getsize(self.gz_path))]
+        log_file = _IndexedGzipReader(self.gz_path, index)
+        self.assertRaises(IOError, log_file.seek, len(self.log_content) + 100)
+        log_file.close()
+
+    def test_tail(self):
+        content, offset = self.task_logs().tail('test.log', 100, 20)
+        self.assertEqual(offset, len(self.log_content))
+        self.assertEqual(content, "".join("line %04d ☺\n" % i for i in range(993, 1000)))
+
+    def test_plain_gzip(self):
+        os.unlink(self.gz_path + '.idx')
+        self.assertFalse(isinstance(self.task_logs()._open_log('test.log'), _IndexedGzipReader))
+        self.assertEqual(self.task_logs().get_chunk('test.log', 5555, 100), self.log_content[5555:5655])
+        self.assertEqual(self.task_logs().tail('test.log', 100, 20)[1], len(self.log_content))
+
+        # an index not matching the file is ignored
+        gz = gzip.open(self.gz_path, 'wb')
+        gz.write(self.log_content)
+        gz.close()
+        with open(self.gz_path + '.idx', 'w') as index:
+            index.write('0 0\n10 10\n')
+        self.assertFalse(isinstance(self.task_logs()._open_log('test.log'), _IndexedGzipReader))
+        self.assertEqual(self.task_logs().get_chunk('test.log', 5555, 100), self.log_content[5555:5655])
+
+    def test_raw_download(self):
+        request = django.test.RequestFactory().get('/task/%s/log/test.log' % self.task.id, {'format': 'raw', 'offset': 5555})
+        response = views.task_log(request, self.task.id, 'test.log')
+        self.assertEqual(int(response['Content-Length']), len(self.log_content) - 5555)
+        self.assertEqual("".join(response.streaming_content), self.log_content[5555:])
+
+
+class TestLogManifest(django.test.TestCase):
+    def setUp(self):
+        super(TestLogManifest, self).setUp()
+        user = User.objects.create()
+        arch = Arch.objects.create(name='testarch')
+        channel = Channel.objects.create(name='testchannel')
+        self.task = Task.objects.create(arch=arch, channel=channel, owner=user, state=TASK_STATES["OPEN"])
+        self.addCleanup(rmtree, self.task.task_dir(), True)
+        self.manifest_path = os.path.join(self.task.task_dir(), LOG_MANIFEST_NAME)
+
+        self.task.logs['stdout.log'] = 'x' * 100
+        self.task.logs['sub/traceback.log'] = 'traceback'
+        self.task.logs.save()
+
+    def task_logs(self):
+        return Task.objects.get(id=self.task.id).logs
+
+    def sizes(self):
+        return dict((name, (info['size'], info['compressed'])) for name, info in self.task_logs().manifest.items())
+
+    def test_manifest(self):
+        self.assertTrue(os.path.isfile(self.manifest_path))
+        self.assertEqual(self.sizes(), {'stdout.log': (100, False), 'sub/traceback.log': (9, False)})
+        with mock.patch('os.walk') as walk:
+            self.assertEqual(self.task_logs().list, ['stdout.log', 'sub/traceback.log'])
+        self.assertFalse(walk.called)
+
+    def test_uploads(self):
+        request = mock.Mock(worker=object())
+        request.user.is_authenticated.return_value = True
+        self.task_logs().write_chunk('stdout.log', StringIO('y' * 50))
+        for chunk in encode_xmlrpc_chunks_iterator(StringIO('z' * 10)):
+            worker_xmlrpc.upload_task_log(request, self.task.id, 'xmlrpc.log', 0644, *chunk)
+        self.assertEqual(self.sizes()['stdout.log'], (150, False))
+        self.assertEqual(self.sizes()['xmlrpc.log'], (10, False))
+
+    def test_gzip_logs(self):
+        self.task_logs().gzip_logs()
+        self.assertEqual(self.sizes(), {'stdout.log': (100, True), 'sub/traceback.log': (9, True)})
+
+    def test_appends(self):
+        # appending to a known log doesn't rewrite the manifest
+        with mock.patch.object(TaskLogs, 'update_manifest') as update_manifest:
+            task_logs = self.task_logs()
+            task_logs.write_chunk('stdout.log', StringIO('y' * 50))
+            task_logs.write_chunk('stdout.log', StringIO('y' * 50))
+        self.assertFalse(update_manifest.called)
+        self.assertEqual(self.sizes()['stdout.log'], (200, False))
+
+        # final sizes are saved once the task is finished
+        Task.objects.filter(id=self.task.id).update(state=TASK_STATES["CLOSED"])
+        self.assertEqual(self.sizes()['stdout.log'], (200, False))
+        with open(self.manifest_path) as manifest:
+            data = json.load(manifest)
+        self.assertTrue(data['final'])
+        self.assertEqual(data['logs']['stdout.log']['size'], 200)
+
+    def test_legacy_task(self):
+        # a missing manifest is built once
+        os.unlink(self.manifest_path)
+        self.assertEqual(self.sizes()['stdout.log'], (100, False))
+        self.assertTrue(os.path.isfile(self.manifest_path))
+        with mock.patch('os.walk') as walk:
+            task_logs = self.task_logs()
+            self.assertEqual(task_logs.get_log_info('stdout.log')['size'], 100)
+            self.assertEqual(task_logs.get_log_info('sub/traceback.log')['size'], 9)
+        self.assertFalse(walk.called)
+
+        self.task_logs().write_chunk('new.log', StringIO('new'))
+        self.assertEqual(sorted(self.sizes()), ['new.log', 'stdout.log', 'sub/traceback.log'])
+
+        # saved for finished tasks
+        os.unlink(self.manifest_path)
+        Task.objects.filter(id=self.task.id).update(state=TASK_STATES["CLOSED"])
+        self.assertEqual(self.sizes()['new.log'], (3, False))
+        self.assertTrue(os.path.isfile(self.manifest_path))
+
+    def test_detail_view(self):
+        response = django.test.Client().get('/task/%s/' % self.task.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('stdout.log</a> (100\xc2\xa0bytes)' in response.content)
+        # traceback requires a permission
+        self.assertFalse('traceback.log' in response.content)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from django.contrib.auth.models import User
+
+
+class TestTaskTree(django.test.TestCase):
+    def setUp(self):
+        super(TestTaskTree, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=100)
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["OPEN"])
+        kwargs.setdefault("worker", self.worker)
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def create_tree(self, width):
+        """Return root, list of levels below it."""
+        root = self.create_task()
+        children = [ self.create_task(parent=root) for i in range(width) ]
+        grandchildren = [ self.create_task(parent=children[0]) for i in range(width) ]
+        return root, [children, grandchildren]
+
+    def get_states(self, tasks):
+        return [ Task.objects.get(id=i.id).state for i in tasks ]
+
+    def test_subtask_levels(self):
+        root, levels = self.create_tree(3)
+        expected = [ [ i.id for i in level ] for level in levels ]
+        self.assertEqual(Task.objects.get_subtask_levels(root.id), expected)
+
+        with mock.patch.object(Task.objects.__class__, "_supports_recursive_query", return_value=False):
+            self.assertEqual(Task.objects.get_subtask_levels(root.id), expected)
+
+        self.assertEqual(Task.objects.get_subtask_levels(levels[1][0].id), [])
+
+    def test_cancel_tree(self):
+        root = self.create_task()
+        free = self.create_task(parent=root, state=TASK_STATES["FREE"], worker=None)
+        closed = self.create_task(parent=root, state=TASK_STATES["CLOSED"])
+        # descendants of finished tasks are processed as well
+        opened = self.create_task(parent=closed)
+        self.assertEqual(Worker.objects.get(id=self.worker.id).task_count, 2)
+
+        with mock.patch("kobo.hub.models.compress_task_logs") as compress_task_logs:
+            Task.objects.get(id=root.id).cancel_task()
+
+        self.assertEqual(self.get_states([root, free, closed, opened]), [TASK_STATES["CANCELED"], TASK_STATES["CANCELED"], TASK_STATES["CLOSED"], TASK_STATES["CANCELED"]])
+        self.assertEqual(sorted(compress_task_logs.call_args[0][0]), [root.id, free.id, opened.id])
+        worker = Worker.objects.get(id=self.worker.id)
+        self.assertEqual((worker.task_count, worker.current_load), (0, 0))
+
+    def test_cancel_subtasks(self):
+        root, levels = self.create_tree(2)
+        with mock.patch("kobo.hub.models.compress_task_logs"):
+            self.assertEqual(Task.objects.get(id=root.id).cancel_subtasks(), True)
+        self.assertEqual(self.get_states([root]), [TASK_STATES["OPEN"]])
+        self.assertEqual(set(self.get_states(levels[0] + levels[1])), set([TASK_STATES["CANCELED"]]))
+
+    def test_cancel_subtasks_finished(self):
+        root = self.create_task()
+        closed = self.create_task(parent=root, state=TASK_STATES["CLOSED"])
+        free = self.create_task(parent=root, state=TASK_STATES["FREE"], worker=None)
+
+        # finished subtasks are left unchanged and reported by the result
+        with mock.patch("kobo.hub.models.compress_task_logs"):
+            self.assertEqual(Task.objects.get(id=root.id).cancel_subtasks(), False)
+        self.assertEqual(self.get_states([root, closed, free]), [TASK_STATES["OPEN"], TASK_STATES["CLOSED"], TASK_STATES["CANCELED"]])
+
+    def test_cancel_query_count(self):
+        def cancel_queries(width):
+            root, levels = self.create_tree(width)
+            with mock.patch("kobo.hub.models.compress_task_logs"):
+                with CaptureQueriesContext(connection) as queries:
+                    Task.objects.get(id=root.id).cancel_task()
+            self.assertEqual(set(self.get_states(levels[0] + levels[1])), set([TASK_STATES["CANCELED"]]))
+            return len(queries)
+
+        # the first cancel loads the worker to the reference cache
+        cancel_queries(1)
+        self.assertEqual(cancel_queries(2), cancel_queries(50))
+
+    def test_interrupt_tree(self):
+        root = self.create_task()
+        opened = self.create_task(parent=root)
+        free = self.create_task(parent=root, state=TASK_STATES["FREE"], worker=None)
+
+        with mock.patch("kobo.hub.models.compress_task_logs"):
+            Task.objects.get(id=root.id).interrupt_task()
+        self.assertEqual(self.get_states([root, opened, free]), [TASK_STATES["INTERRUPTED"], TASK_STATES["INTERRUPTED"], TASK_STATES["FREE"]])
+
+    def test_timeout_tree(self):
+        root, levels = self.create_tree(2)
+
+        with mock.patch("kobo.hub.models.compress_task_logs"):
+            Task.objects.get(id=root.id).timeout_task()
+        self.assertEqual(self.get_states([root]), [TASK_STATES["TIMEOUT"]])
+        self.assertEqual(set(self.get_states(levels[0] + levels[1])), set([TASK_STATES["INTERRUPTED"]]))
+
+    def test_not_recursive(self):
+        root, levels = self.create_tree(2)
+
+        with mock.patch("kobo.hub.models.compress_task_logs"):
+            Task.objects.get(id=root.id).interrupt_task(recursive=False)
+        self.assertEqual(set(self.get_states(levels[0])), set([TASK_STATES["OPEN"]]))
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -13,7 +13,7 @@ import mock
 import django
 import django.conf
 import django.test
-from django.test.utils import get_runner
+from django.test.utils import get_runner, override_settings
 
 # Only for Django >= 1.7
 if 'setup' in dir(django):
@@ -423,6 +423,88 @@ class TestViewLog(django.test.TestCase):
 
         self.assertEqual(all_content, self.big_log_content)
 
+    def test_view_raw_range(self):
+        content = small_log_content()
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=5-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 5-9/%s' % len(content))
+        self.assertEqual(response['Content-Length'], '5')
+        self.assertEqual(response_content(response), content[5:10])
+
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=-4')
+        self.assertEqual((response.status_code, response_content(response)), (206, content[-4:]))
+
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=30-')
+        self.assertEqual((response.status_code, response_content(response)), (206, content[30:]))
+
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%s' % len(content))
+
+        # multiple ranges are not supported
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual((response.status_code, response_content(response)), (200, content))
+
+    def test_view_raw_conditional(self):
+        response = self.get_log('small.log', data={'format': 'raw'})
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        # weak validators match as well, e.g. from caches which modified the response
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_IF_NONE_MATCH='"other", W/%s' % etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_IF_NONE_MATCH='W/"other"')
+        self.assertEqual(response.status_code, 200)
+
+        # If-Range doesn't match, the whole file is sent
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.get_log('small.log', data={'format': 'raw'}, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, response_content(response)), (200, small_log_content()))
+
+    def test_view_zipped_raw_accept_gzip(self):
+        response = self.get_log('zipped_small.log', data={'format': 'raw'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=zipped_small.log')
+        self.assertEqual(gzip_decompress(response_content(response)), small_log_content())
+
+        plain = self.get_log('zipped_small.log', data={'format': 'raw'})
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertNotEqual(response['ETag'], plain['ETag'])
+
+        # gzip refused explicitly or by a zero wildcard
+        for accept in ('gzip;q=0, deflate', 'GZIP; q=0.0', 'deflate, *;q=0', 'identity'):
+            refused = self.get_log('zipped_small.log', data={'format': 'raw'}, HTTP_ACCEPT_ENCODING=accept)
+            self.assertFalse(refused.has_header('Content-Encoding'), accept)
+            self.assertEqual(refused['ETag'], plain['ETag'])
+
+        for accept in ('deflate;q=1, gzip;q=0.5', '*'):
+            accepted = self.get_log('zipped_small.log', data={'format': 'raw'}, HTTP_ACCEPT_ENCODING=accept)
+            self.assertEqual(accepted['Content-Encoding'], 'gzip', accept)
+
+    def test_view_raw_sendfile(self):
+        path = os.path.join(django.conf.settings.TASK_DIR, '0', '0', str(TASK_ID), 'small.log')
+        with override_settings(TASK_LOG_SENDFILE='X-Sendfile'):
+            response = self.get_log('small.log', data={'format': 'raw'})
+            self.assertEqual(response['X-Sendfile'], os.path.abspath(path))
+            self.assertEqual(response.content, '')
+
+            # partial content is still sent by the hub
+            response = self.get_log('small.log', data={'format': 'raw', 'offset': 10})
+            self.assertEqual(response_content(response), small_log_content()[10:])
+
+        with override_settings(TASK_LOG_SENDFILE='X-Accel-Redirect', TASK_LOG_SENDFILE_URL='/protected/tasks/'):
+            response = self.get_log('small.log', data={'format': 'raw'})
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/tasks/0/0/%s/small.log' % TASK_ID)
+
     def assertGetLog(self, log_name, view_type='log', test_content_length=True,
                      expected_content=None, data={}):
         """Verify log can be successfully retrieved and response has certain properties.
@@ -445,9 +527,9 @@ class TestViewLog(django.test.TestCase):
 
         return response, content
 
-    def get_log(self, log_name, view_type='log', data={}):
+    def get_log(self, log_name, view_type='log', data={}, **extra):
         url = '/task/{0}/{1}/{2}'.format(TASK_ID, view_type, log_name)
-        return self.client.get(url, data)
+        return self.client.get(url, data, **extra)
 
 if __name__ == '__main__':
     TestRunner = get_runner(django.conf.settings)
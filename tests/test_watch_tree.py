@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import xmlrpclib
+from StringIO import StringIO
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.client.task_watcher import TaskWatcher
+from kobo.hub.models import Task, TaskEvent, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import client
+from django.contrib.auth.models import User
+
+
+class FakeClientProxy(object):
+    """Call hub functions directly, count calls."""
+
+    def __init__(self, watch_tree=True):
+        self.calls = []
+        self.has_watch_tree = watch_tree
+
+    def watch_tree(self, task_id, since_seq):
+        self.calls.append("watch_tree")
+        if not self.has_watch_tree:
+            raise xmlrpclib.Fault(1, 'Exception: method "client.watch_tree" is not supported')
+        return client.watch_tree(None, task_id, since_seq)
+
+    def task_info(self, task_id, flat):
+        self.calls.append("task_info")
+        return client.task_info(None, task_id, flat)
+
+
+class FakeHubProxy(object):
+    def __init__(self, watch_tree=True):
+        self.client = FakeClientProxy(watch_tree)
+
+
+class TestWatchTree(django.test.TestCase):
+    def setUp(self):
+        super(TestWatchTree, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=100)
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def create_tree(self, width):
+        root = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker)
+        children = [ self.create_task(parent=root) for i in range(width) ]
+        return root, children
+
+    def test_events(self):
+        task = self.create_task()
+        task.open_task(self.worker.id)
+        Task.objects.get(id=task.id).close_task()
+        events = TaskEvent.objects.filter(task_id=task.id)
+        self.assertEqual([ (i.old_state, i.new_state, i.worker_id) for i in events ], [
+            (None, TASK_STATES["FREE"], None),
+            (TASK_STATES["FREE"], TASK_STATES["OPEN"], self.worker.id),
+            (TASK_STATES["OPEN"], TASK_STATES["CLOSED"], self.worker.id),
+        ])
+        self.assertEqual(sorted(i.seq for i in events), [ i.id for i in events ])
+
+    def test_watch_tree(self):
+        root, children = self.create_tree(3)
+        other = self.create_task()
+
+        result = client.watch_tree(None, root.id)
+        self.assertEqual([ i["id"] for i in result["tasks"] ], [root.id] + [ i.id for i in children ])
+        self.assertEqual(result["tasks"][0]["worker"], {"id": self.worker.id, "name": "test-worker"})
+        self.assertEqual(result["tasks"][1]["parent"], root.id)
+        seq = result["seq"]
+
+        self.assertEqual(client.watch_tree(None, root.id, seq), {"seq": seq, "tasks": []})
+
+        other.open_task(self.worker.id)
+        children[1].open_task(self.worker.id)
+        new = self.create_task(parent=children[0])
+        result = client.watch_tree(None, root.id, seq)
+        self.assertEqual([ (i["id"], i["state_label"]) for i in result["tasks"] ], [(children[1].id, "OPEN"), (new.id, "FREE")])
+        self.assertTrue(result["seq"] > seq)
+
+    def test_events_of_other_tasks(self):
+        root, children = self.create_tree(2)
+        other = self.create_task()
+        seq = client.watch_tree(None, root.id)["seq"]
+
+        other.open_task(self.worker.id)
+        with mock.patch.object(TaskEvent.objects, "get_changed_task_ids", wraps=TaskEvent.objects.get_changed_task_ids) as get_changed:
+            self.assertEqual(client.watch_tree(None, root.id, seq)["tasks"], [])
+        self.assertEqual(sorted(get_changed.call_args[0][1]), sorted([root.id] + [ i.id for i in children ]))
+        self.assertEqual(TaskEvent.objects.get_changed_task_ids(seq, [root.id, other.id]), set([other.id]))
+
+    def test_missing_task(self):
+        self.assertRaises(Task.DoesNotExist, client.watch_tree, None, 999999)
+
+        class FaultClientProxy(FakeClientProxy):
+            def watch_tree(self, task_id, since_seq):
+                try:
+                    return FakeClientProxy.watch_tree(self, task_id, since_seq)
+                except Exception, ex:
+                    raise xmlrpclib.Fault(1, "%s: %s" % (type(ex).__name__, ex))
+
+        hub = FakeHubProxy()
+        hub.client = FaultClientProxy()
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            self.assertRaises(SystemExit, TaskWatcher(hub, 999999).update)
+        self.assertEqual(stdout.getvalue(), "No such task id: 999999\n")
+
+    def test_events_returned_once(self):
+        root, children = self.create_tree(1)
+        seq = client.watch_tree(None, root.id)["seq"]
+        children[0].open_task(self.worker.id)
+        result = client.watch_tree(None, root.id, seq)
+        self.assertEqual([ i["id"] for i in result["tasks"] ], [children[0].id])
+        self.assertEqual(client.watch_tree(None, root.id, result["seq"]), {"seq": result["seq"], "tasks": []})
+
+    def test_constant_query_count(self):
+        def watch_queries(width):
+            root, children = self.create_tree(width)
+            seq = client.watch_tree(None, root.id)["seq"]
+            for child in children:
+                child.open_task(self.worker.id)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(len(client.watch_tree(None, root.id, seq)["tasks"]), width)
+            return len(queries)
+
+        self.assertEqual(watch_queries(2), watch_queries(50))
+
+    def watch(self, hub, root_id):
+        watcher = TaskWatcher(hub, root_id)
+        stdout = StringIO()
+        with mock.patch("sys.stdout", stdout):
+            watcher.update()
+            Task.objects.get(id=root_id).close_task()
+            for child in Task.objects.get(id=root_id).subtasks():
+                child.open_task(self.worker.id)
+                child.close_task()
+            watcher.update()
+        self.assertTrue(watcher.is_finished())
+        return stdout.getvalue()
+
+    def test_task_watcher(self):
+        root, children = self.create_tree(3)
+        hub = FakeHubProxy()
+        output = self.watch(hub, root.id)
+        self.assertEqual(hub.client.calls, ["watch_tree", "watch_tree"])
+        self.assertTrue("%s DummyTask: OPEN (test-worker) -> CLOSED" % root.id in output)
+        self.assertTrue("  %s DummyTask: FREE -> CLOSED (test-worker)" % children[2].id in output)
+
+    def test_task_watcher_old_hub(self):
+        root, children = self.create_tree(3)
+        hub = FakeHubProxy(watch_tree=False)
+        output = self.watch(hub, root.id)
+        self.assertEqual(hub.client.calls, ["watch_tree"] + ["task_info"] * 8)
+        self.assertTrue("%s DummyTask: OPEN (test-worker) -> CLOSED" % root.id in output)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
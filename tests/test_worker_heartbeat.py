@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare hub queries and RPCs of a worker poll cycle:
+update_worker_info() + update_tasks() + get_next_task() vs. heartbeat().
+"""
+
+import sys
+import time
+import xmlrpclib
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.db import connection, transaction
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.client import HubBatch
+from kobo.django.xmlrpc.dispatcher import DjangoXMLRPCDispatcher
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import worker as worker_xmlrpc
+from kobo.worker.task import TaskBase
+from kobo.worker.taskmanager import TaskManager, TaskContainer
+from django.contrib.auth.models import User
+
+
+class DummyTask(TaskBase):
+    arches = ["noarch"]
+    channels = ["default"]
+    exclusive = False
+    foreground = False
+    weight = 1
+
+
+class DummyTaskContainer(TaskContainer):
+    pass
+
+DummyTaskContainer.register_plugin(DummyTask)
+
+
+class FakeUser(object):
+    username = "worker/test-worker"
+
+    def is_authenticated(self):
+        return True
+
+
+class FakeRequest(object):
+    def __init__(self, worker):
+        self.user = FakeUser()
+        self.worker = worker
+
+
+class FakeWorkerProxy(object):
+    """Call hub functions directly, count calls."""
+
+    def __init__(self, hub):
+        self._hub = hub
+
+    def __getattr__(self, name):
+        function = getattr(worker_xmlrpc, name)
+
+        def _call(*args):
+            self._hub.calls.append(name)
+            if name in self._hub.missing:
+                raise xmlrpclib.Fault(1, 'Exception: method "worker.%s" is not supported' % name)
+            # the worker is looked up on each request by the hub middleware
+            worker = Worker.objects.get(id=self._hub.worker_id)
+            return function(FakeRequest(worker), *args)
+        return _call
+
+
+class FakeSystemProxy(object):
+    """Run multicalls through the hub dispatcher, count calls."""
+
+    def __init__(self, hub):
+        self._hub = hub
+        self._dispatcher = DjangoXMLRPCDispatcher()
+        self._dispatcher.register_module(worker_xmlrpc, "worker")
+
+    def multicall(self, call_list):
+        self._hub.calls.append("system.multicall")
+        worker = Worker.objects.get(id=self._hub.worker_id)
+        return self._dispatcher.system_multicall(FakeRequest(worker), call_list)
+
+
+class FakeHubProxy(object):
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.calls = []
+        self.missing = set()
+        self.worker = FakeWorkerProxy(self)
+        self.system = FakeSystemProxy(self)
+
+    def _login(self, force=False, verbose=False):
+        self.calls.append("auth.renew_session")
+
+    def batch(self):
+        return HubBatch(self)
+
+
+class TestHeartbeat(django.test.TestCase):
+    def setUp(self):
+        super(TestHeartbeat, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=10)
+        self.worker.arches.add(self.arch)
+        self.worker.channels.add(self.channel)
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=self.channel, method="DummyTask", **kwargs)
+
+    def create_task_manager(self):
+        hub = FakeHubProxy(self.worker.id)
+        with mock.patch("kobo.worker.taskmanager.HubProxy", return_value=hub):
+            tm = TaskManager(conf=None)
+        tm.task_container = DummyTaskContainer()
+        tm.fork_task = mock.Mock(side_effect=lambda task_info: 10000 + task_info["id"])
+        tm.cleanup_task = mock.Mock(return_value=True)
+        tm.is_finished_task = lambda task_id: task_id in self.exited
+        hub.calls = []
+        return tm
+
+    def create_tasks(self, tm):
+        """Prepare tasks for a cycle: running, finished, waiting and free ones."""
+        self.exited = set()
+        running = [ self.create_task(state=TASK_STATES["OPEN"], worker=self.worker) for i in range(3) ]
+        finished = [ self.create_task(state=TASK_STATES["CLOSED"], worker=self.worker) for i in range(2) ]
+        waiting = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker, waiting=True)
+        self.create_task(state=TASK_STATES["CLOSED"], parent=waiting, awaited=True)
+        interrupted = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker)
+        free = [ self.create_task() for i in range(5) ]
+
+        for task in running + finished + [waiting]:
+            tm.pid_dict[task.id] = 10000 + task.id
+        self.exited.update(( i.id for i in finished ))
+        return interrupted, free
+
+    def run_cycle(self, tm, cycle):
+        with mock.patch("os.kill"):
+            with CaptureQueriesContext(connection) as queries:
+                cycle()
+        return len(queries), len(tm.hub.calls)
+
+    def old_cycle(self, tm):
+        tm.hub._login()
+        tm.update_worker_info()
+        tm.update_tasks()
+        tm.get_next_task()
+
+    def test_heartbeat(self):
+        tm = self.create_task_manager()
+        interrupted, free = self.create_tasks(tm)
+
+        self.run_cycle(tm, tm.heartbeat)
+        self.assertEqual(tm.hub.calls, ["heartbeat"])
+        self.assertEqual(Task.objects.get(id=interrupted.id).state, TASK_STATES["INTERRUPTED"])
+        self.assertEqual(Task.objects.filter(state=TASK_STATES["FREE"]).count(), 0)
+        self.assertEqual(len(tm.pid_dict), 4 + len(free))
+        self.assertEqual(sorted(tm.task_dict), sorted(tm.pid_dict))
+        # waiting task doesn't count to the load
+        self.assertEqual(tm.worker_info["current_load"], 3 + len(free))
+
+    def test_wait_cursor(self):
+        tm = self.create_task_manager()
+        self.run_cycle(tm, tm.heartbeat)
+        self.assertNotEqual(tm.wait_cursor, None)
+
+        # a task created after the heartbeat ends the wait right away
+        time.sleep(0.01)
+        Task.create_task("testuser", "label", "DummyTask")
+        start = time.time()
+        tm.wait_for_work()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(tm.hub.calls[-1], "wait_for_work")
+        self.assertEqual(tm.wait_cursor, None)
+
+    def test_wait_capped_by_hub(self):
+        tm = self.create_task_manager()
+        tm.conf["SLEEP_TIME"] = 20
+        with mock.patch("kobo.hub.xmlrpc.worker.MAX_WAIT_TIMEOUT", 0):
+            with mock.patch("time.sleep") as sleep:
+                tm.wait_for_work()
+        # the worker sleeps the rest instead of polling right away
+        self.assertEqual(tm.hub.calls, ["wait_for_work"])
+        self.assertTrue(19 < sleep.call_args[0][0] <= 20)
+
+    def test_old_hub(self):
+        tm = self.create_task_manager()
+        tm.hub.missing.add("heartbeat")
+        self.exited = set()
+        free = [ self.create_task() for i in range(2) ]
+
+        self.run_cycle(tm, tm.poll)
+        self.assertFalse(tm.use_heartbeat)
+        self.assertEqual(tm.hub.calls[0], "heartbeat")
+        self.assertTrue("claim_tasks" in tm.hub.calls)
+        self.assertEqual(sorted(tm.pid_dict), [ i.id for i in free ])
+
+        # heartbeat is not tried again
+        tm.hub.calls = []
+        self.run_cycle(tm, tm.poll)
+        self.assertFalse("heartbeat" in tm.hub.calls)
+
+    def test_hub_without_claim_tasks(self):
+        tm = self.create_task_manager()
+        tm.hub.missing.update(("heartbeat", "claim_tasks"))
+        self.exited = set()
+        free = [ self.create_task() for i in range(2) ]
+
+        self.run_cycle(tm, tm.poll)
+        self.assertFalse(tm.use_claim_tasks)
+        self.assertEqual(tm.hub.calls.count("open_task"), 2)
+        self.assertEqual(sorted(tm.pid_dict), [ i.id for i in free ])
+
+    def test_update_tasks(self):
+        rpc_counts = []
+        for count in (2, 20):
+            sid = transaction.savepoint()
+            tm = self.create_task_manager()
+            interrupted, free = self.create_tasks(tm)
+            finished = [ self.create_task(state=TASK_STATES["CLOSED"], worker=self.worker) for i in range(count) ]
+            for task in finished:
+                tm.pid_dict[task.id] = 10000 + task.id
+            self.exited.update(( i.id for i in finished ))
+
+            self.run_cycle(tm, tm.update_tasks)
+            rpc_counts.append(len(tm.hub.calls))
+            self.assertEqual(tm.hub.calls.count("system.multicall"), 2)
+            self.assertEqual(Task.objects.get(id=interrupted.id).state, TASK_STATES["INTERRUPTED"])
+            self.assertEqual(len(tm.pid_dict), 4)
+            transaction.savepoint_rollback(sid)
+
+        # round trips don't depend on the number of finished tasks
+        self.assertEqual(rpc_counts[0], rpc_counts[1])
+
+    def test_benchmark(self):
+        result = {}
+        for name in ("old", "heartbeat"):
+            sid = transaction.savepoint()
+            tm = self.create_task_manager()
+            self.create_tasks(tm)
+            if name == "old":
+                result[name] = self.run_cycle(tm, lambda: self.old_cycle(tm))
+            else:
+                result[name] = self.run_cycle(tm, tm.heartbeat)
+            self.assertEqual(len(tm.pid_dict), 9)
+            transaction.savepoint_rollback(sid)
+
+        for name in ("old", "heartbeat"):
+            sys.stderr.write("\n%-10s queries: %3d, RPCs: %2d" % ((name, ) + result[name]))
+        sys.stderr.write("\n")
+
+        self.assertEqual(result["heartbeat"][1], 1)
+        self.assertTrue(result["old"][1] >= 4)
+        self.assertTrue(result["heartbeat"][0] < result["old"][0])
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
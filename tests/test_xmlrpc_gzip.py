@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import xmlrpclib
+
+import django
+import django.conf
+import django.test
+from django.test.utils import get_runner, override_settings
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.xmlrpc import gzip_encode, gzip_decode
+
+
+def echo(request, value):
+    return value
+
+
+def big_listing(request, count):
+    return [ {"id": i, "method": "DummyTask", "args": {"number": i}} for i in range(count) ]
+
+
+with override_settings(XMLRPC_METHODS={"test": ((echo, "echo"), (big_listing, "big_listing"))}):
+    from kobo.django.xmlrpc import views
+
+
+class TestXMLRPCCompression(django.test.SimpleTestCase):
+    def call(self, method, params, gzip_request=False, **extra):
+        data = xmlrpclib.dumps(params, method)
+        if gzip_request:
+            data = gzip_encode(data)
+            extra["HTTP_CONTENT_ENCODING"] = "gzip"
+        request = django.test.RequestFactory().post("/xmlrpc/test/", data, content_type="text/xml", **extra)
+        return views.test_handler(request)
+
+    def load(self, response):
+        content = response.content
+        if response.get("Content-Encoding") == "gzip":
+            content = gzip_decode(content)
+        return xmlrpclib.loads(content)[0][0]
+
+    def test_compressed_response(self):
+        response = self.call("big_listing", (1000, ), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(self.load(response)[999]["args"], {"number": 999})
+
+        plain = self.call("big_listing", (1000, ))
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertTrue(len(response.content) * 5 < len(plain.content))
+
+    def test_small_response(self):
+        response = self.call("echo", ("value", ), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response["Accept-Encoding"], "gzip")
+        self.assertEqual(self.load(response), "value")
+
+    @override_settings(XMLRPC_GZIP_THRESHOLD=None)
+    def test_disabled(self):
+        response = self.call("big_listing", (1000, ), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_compressed_request(self):
+        response = self.call("echo", ("x" * 100000, ), gzip_request=True)
+        self.assertEqual(self.load(response), "x" * 100000)
+
+        request = django.test.RequestFactory().post("/xmlrpc/test/", "not gzip", content_type="text/xml", HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(views.test_handler(request).status_code, 400)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import unittest2 as unittest
+import run_tests # set sys.path
+
+import os
+import sys
+import threading
+import time
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+import mock
+
+from kobo.xmlrpc import CookieTransport, retry_request_decorator
+
+
+# Run with KOBO_TRANSPORT_BENCHMARK_CALLS=<count> to compare calls/sec with and without the connection pool.
+BENCHMARK_CALLS = int(os.environ.get("KOBO_TRANSPORT_BENCHMARK_CALLS", 0))
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # close idle keep-alive connections like a real server does
+    timeout = 0.2
+
+    def setup(self):
+        SimpleXMLRPCRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def decode_request_content(self, data):
+        self.server.content_encodings.append(self.headers.get("Content-Encoding"))
+        return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+
+    def end_headers(self):
+        if self.server.accept_gzip:
+            self.send_header("Accept-Encoding", "gzip")
+        SimpleXMLRPCRequestHandler.end_headers(self)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(self, ("127.0.0.1", 0), requestHandler=KeepAliveRequestHandler, logRequests=False, allow_none=True)
+        self.connections = []
+        self.content_encodings = []
+        self.accept_gzip = True
+        self.register_function(lambda value: value, "echo")
+        self.register_function(self.fail, "fail")
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+class TestCookieTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        # shutdown() waits for the next poll
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%s/" % self.server.server_address[1]
+        self.transports = []
+
+    def tearDown(self):
+        # let the handler threads finish
+        for transport in self.transports:
+            transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_proxy(self, **kwargs):
+        TransportClass = retry_request_decorator(CookieTransport)
+        self.transport = TransportClass(**kwargs)
+        self.transports.append(self.transport)
+        return xmlrpclib.ServerProxy(self.url, transport=self.transport, allow_none=True)
+
+    def test_reuse(self):
+        proxy = self.get_proxy()
+        for i in range(20):
+            self.assertEqual(proxy.echo(i), i)
+        self.assertEqual(len(self.server.connections), 1)
+
+        # faults are regular responses
+        self.assertRaises(xmlrpclib.Fault, proxy.fail)
+        self.assertEqual(proxy.echo("x"), "x")
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_no_pool(self):
+        proxy = self.get_proxy(pool_size=0)
+        for i in range(5):
+            proxy.echo(i)
+        self.assertEqual(len(self.server.connections), 5)
+
+    def test_keep_alive_timeout(self):
+        proxy = self.get_proxy(keep_alive_timeout=0)
+        for i in range(5):
+            proxy.echo(i)
+        self.assertEqual(len(self.server.connections), 5)
+
+    def test_closed_by_server(self):
+        proxy = self.get_proxy(keep_alive_timeout=60)
+        proxy.echo(1)
+        time.sleep(0.5)
+        self.assertEqual(proxy.echo(2), 2)
+        self.assertEqual(len(self.server.connections), 2)
+
+        time.sleep(0.5)
+        status, reason, headers, body = self.transport.raw_request(self.server.server_address[0] + ":%s" % self.server.server_address[1], "POST", "/", xmlrpclib.dumps((3, ), "echo"))
+        self.assertEqual(xmlrpclib.loads(body)[0], (3, ))
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_gzip(self):
+        proxy = self.get_proxy()
+        value = "x" * 20000
+        # the server announces gzip support in the first response
+        self.assertEqual(proxy.echo(value), value)
+        self.assertEqual(proxy.echo(value), value)
+        self.assertEqual(proxy.echo("small"), "small")
+        self.assertEqual(self.server.content_encodings, [None, "gzip", None])
+
+    def test_gzip_old_server(self):
+        self.server.accept_gzip = False
+        proxy = self.get_proxy()
+        value = "x" * 20000
+        self.assertEqual(proxy.echo(value), value)
+        self.assertEqual(proxy.echo(value), value)
+        self.assertEqual(self.server.content_encodings, [None, None])
+
+    def test_threads(self):
+        proxy = self.get_proxy()
+        errors = []
+
+        def run(thread_id):
+            try:
+                for i in range(20):
+                    value = "%s-%s" % (thread_id, i)
+                    if proxy.echo(value) != value:
+                        errors.append(value)
+            except Exception, ex:
+                errors.append(ex)
+
+        threads = [ threading.Thread(target=run, args=(i, )) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(self.server.connections) < 20 * 4)
+        self.assertTrue(sum(len(i) for i in self.transport._pool.values()) <= 2)
+
+    def test_fork(self):
+        proxy = self.get_proxy()
+        proxy.echo(1)
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            proxy.echo(2)
+        self.assertEqual(len(self.server.connections), 2)
+
+    @unittest.skipUnless(BENCHMARK_CALLS, "KOBO_TRANSPORT_BENCHMARK_CALLS not set")
+    def test_benchmark(self):
+        def calls_per_second(**kwargs):
+            proxy = self.get_proxy(**kwargs)
+            start = time.time()
+            for i in xrange(BENCHMARK_CALLS):
+                proxy.echo(i)
+            return BENCHMARK_CALLS / max(time.time() - start, 0.000001)
+
+        before = calls_per_second(pool_size=0)
+        after = calls_per_second()
+        print >> sys.stderr, "%s calls: %.0f calls/sec without pool, %.0f calls/sec with pool" % (BENCHMARK_CALLS, before, after)
+        self.assertEqual(len(self.server.connections), BENCHMARK_CALLS + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
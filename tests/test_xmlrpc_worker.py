@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import sys
+import threading
+import time
+
+import mock
+
+import django
+import django.conf
+import django.test
+from django.db import connection
+from django.test.utils import get_runner, CaptureQueriesContext
+
+# Only for Django >= 1.7
+if 'setup' in dir(django):
+    # This has to happen before below imports because they have a hard requirement
+    # on settings being loaded before import.
+    django.setup()
+
+from kobo.hub import wakeup
+from kobo.hub.models import Task, Arch, Channel, Worker, TASK_STATES
+from kobo.hub.xmlrpc import worker as worker_xmlrpc
+from django.contrib.auth.models import User
+
+
+class FakeUser(object):
+    username = "worker/test-worker"
+
+    def is_authenticated(self):
+        return True
+
+
+class FakeRequest(object):
+    def __init__(self, worker):
+        self.user = FakeUser()
+        self.worker = worker
+
+
+class TestGetTasksToAssign(django.test.TestCase):
+    def setUp(self):
+        super(TestGetTasksToAssign, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channels = [ Channel.objects.create(name="channel-%s" % i) for i in range(5) ]
+        self.worker = Worker.objects.create(name="test-worker", max_load=10)
+        self.worker.arches.add(self.arch)
+        self.other_worker = Worker.objects.create(name="other-worker")
+
+    def create_task(self, channel=None, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        return Task.objects.create(owner=self.user, arch=self.arch, channel=channel or self.channels[0], method="DummyTask", **kwargs)
+
+    def get_tasks_to_assign(self):
+        worker = Worker.objects.get(id=self.worker.id)
+        return worker_xmlrpc.get_tasks_to_assign(FakeRequest(worker))
+
+    def test_constant_query_count(self):
+        self.worker.channels.add(self.channels[0])
+        for channel in self.channels:
+            self.create_task(channel=channel)
+
+        with CaptureQueriesContext(connection) as one_channel:
+            self.assertEqual(len(self.get_tasks_to_assign()), 1)
+
+        self.worker.channels.add(*self.channels[1:])
+        with CaptureQueriesContext(connection) as all_channels:
+            self.assertEqual(len(self.get_tasks_to_assign()), len(self.channels))
+
+        self.assertEqual(len(one_channel), len(all_channels))
+
+    def test_group_order(self):
+        self.worker.channels.add(self.channels[0])
+        free = self.create_task(priority=30)
+        assigned = self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.worker, priority=5)
+        awaited = self.create_task(awaited=True, priority=1)
+        exclusive = self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.worker, exclusive=True)
+        self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.other_worker)
+        self.create_task(state=TASK_STATES["OPEN"], worker=self.worker)
+
+        task_list = self.get_tasks_to_assign()
+        self.assertEqual([ i["id"] for i in task_list ], [exclusive.id, awaited.id, assigned.id, free.id])
+
+    def test_priority_order(self):
+        self.worker.channels.add(*self.channels)
+        self.worker.min_priority = 5
+        self.worker.save()
+        low = self.create_task(channel=self.channels[1], priority=1)
+        tasks = [ self.create_task(channel=self.channels[i % 5], priority=10 + i) for i in range(12) ]
+
+        task_ids = [ i["id"] for i in self.get_tasks_to_assign() ]
+        self.assertEqual(task_ids, [ i.id for i in reversed(tasks) ][:10])
+        self.assertFalse(low.id in task_ids)
+
+    def test_exclusive_limit(self):
+        self.worker.channels.add(self.channels[0])
+        exclusive = [ self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.worker, exclusive=True) for i in range(10) ]
+        self.create_task(awaited=True)
+        self.create_task()
+
+        task_ids = [ i["id"] for i in self.get_tasks_to_assign() ]
+        self.assertEqual(task_ids, [ i.id for i in exclusive ])
+
+    def test_export_matches_task_export(self):
+        self.worker.channels.add(self.channels[0])
+        self.worker.channels.add(self.channels[1])
+        parent = self.create_task(state=TASK_STATES["OPEN"], worker=self.other_worker)
+        task = self.create_task(parent=parent, resubmitted_by=self.user)
+        self.create_task(parent=task, state=TASK_STATES["CLOSED"])
+
+        task_list = self.get_tasks_to_assign()
+        self.assertEqual(task_list, [Task.objects.get(id=task.id).export(flat=False)])
+        self.assertEqual(task_list[0]["parent"]["worker"], self.other_worker.id)
+
+
+class TestClaimTasks(django.test.TestCase):
+    def setUp(self):
+        super(TestClaimTasks, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.worker = Worker.objects.create(name="test-worker", max_load=10)
+        self.worker.channels.add(self.channel)
+        self.other_worker = Worker.objects.create(name="other-worker")
+        self.task_classes = {
+            "DummyTask": {"arches": ["noarch"], "channels": ["default"], "exclusive": False, "weight": 1},
+        }
+
+    def create_task(self, method="DummyTask", **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        kwargs.setdefault("arch", self.arch)
+        return Task.objects.create(owner=self.user, channel=self.channel, method=method, **kwargs)
+
+    def claim_tasks(self, max_load):
+        worker = Worker.objects.get(id=self.worker.id)
+        return worker_xmlrpc.claim_tasks(FakeRequest(worker), max_load, self.task_classes)
+
+    def test_claim_opens_tasks(self):
+        for i in range(3):
+            self.create_task()
+
+        task_list = self.claim_tasks(2)
+        self.assertEqual(len(task_list), 2)
+        for task_info in task_list:
+            self.assertEqual(task_info["state"], TASK_STATES["OPEN"])
+            self.assertEqual(task_info["worker"]["id"], self.worker.id)
+            self.assertTrue(task_info["dt_started"])
+        self.assertEqual(Task.objects.filter(state=TASK_STATES["FREE"]).count(), 1)
+
+    def test_claim_skips_unsupported(self):
+        self.create_task(method="UnknownTask")
+        self.create_task(arch=Arch.objects.create(name="x86_64", pretty_name="x86_64"))
+        supported = self.create_task()
+
+        self.assertEqual([ i["id"] for i in self.claim_tasks(10) ], [supported.id])
+
+    def test_claim_exclusive_ignores_arch(self):
+        self.task_classes["ShutdownWorker"] = {"arches": [], "channels": [], "exclusive": True, "weight": 0}
+        task = self.create_task(method="ShutdownWorker", state=TASK_STATES["ASSIGNED"], worker=self.worker, exclusive=True)
+
+        self.assertEqual([ i["id"] for i in self.claim_tasks(0) ], [])
+        self.assertEqual([ i["id"] for i in self.claim_tasks(1) ], [task.id])
+
+    def test_claim_skips_lost_race(self):
+        taken = self.create_task()
+        free = self.create_task()
+        Task.objects.filter(id=taken.id).update(state=TASK_STATES["OPEN"], worker=self.other_worker)
+
+        self.assertEqual(Task.objects.claim(self.worker.id, [taken.id, free.id]), [free.id])
+        self.assertEqual(Task.objects.get(id=taken.id).worker_id, self.other_worker.id)
+        self.assertEqual(Task.objects.get(id=free.id).state, TASK_STATES["OPEN"])
+
+
+class TestWaitForWork(django.test.TestCase):
+    def setUp(self):
+        super(TestWaitForWork, self).setUp()
+        self.user = User.objects.create(username="testuser")
+        self.arch = Arch.objects.create(name="noarch", pretty_name="noarch")
+        self.channel = Channel.objects.create(name="default")
+        self.other_channel = Channel.objects.create(name="other")
+        self.worker = Worker.objects.create(name="test-worker", max_load=10)
+        self.worker.channels.add(self.channel)
+        self.other_worker = Worker.objects.create(name="other-worker")
+
+    def create_task(self, **kwargs):
+        kwargs.setdefault("state", TASK_STATES["FREE"])
+        kwargs.setdefault("channel", self.channel)
+        return Task.objects.create(owner=self.user, arch=self.arch, method="DummyTask", **kwargs)
+
+    def has_work(self):
+        return worker_xmlrpc._has_work(Worker.objects.get(id=self.worker.id))
+
+    def test_has_work_free(self):
+        self.create_task(channel=self.other_channel)
+        self.create_task(state=TASK_STATES["OPEN"], worker=self.other_worker)
+        self.assertFalse(self.has_work())
+        self.create_task()
+        self.assertTrue(self.has_work())
+
+    def test_has_work_min_priority(self):
+        self.worker.min_priority = 10
+        self.worker.save()
+        self.create_task(priority=5)
+        self.assertFalse(self.has_work())
+        self.create_task(priority=10)
+        self.assertTrue(self.has_work())
+
+    def test_has_work_assigned(self):
+        self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.other_worker, channel=self.other_channel)
+        self.assertFalse(self.has_work())
+        self.create_task(state=TASK_STATES["ASSIGNED"], worker=self.worker, channel=self.other_channel)
+        self.assertTrue(self.has_work())
+
+    def test_has_work_finished(self):
+        # the worker notices its own finished tasks
+        self.create_task(state=TASK_STATES["CLOSED"], worker=self.worker, dt_finished=datetime.datetime.now())
+        self.assertFalse(self.has_work())
+
+    def test_has_work_awaited_subtask(self):
+        parent = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker, waiting=True)
+        self.create_task(state=TASK_STATES["OPEN"], worker=self.other_worker, parent=parent, awaited=True)
+        self.assertFalse(self.has_work())
+        self.create_task(state=TASK_STATES["CLOSED"], worker=self.other_worker, parent=parent, awaited=True)
+        self.assertTrue(self.has_work())
+
+    def test_notify_on_new_work(self):
+        with mock.patch("kobo.hub.wakeup._notify") as notify:
+            Task.create_task("testuser", "label", "DummyTask", state=TASK_STATES["OPEN"])
+            task = Task.objects.get(id=Task.create_task("testuser", "label", "DummyTask"))
+            self.assertEqual(notify.call_count, 1)
+
+            task.open_task(self.worker.id)
+            task.close_task()
+            self.assertEqual(notify.call_count, 1)
+
+            parent = self.create_task(state=TASK_STATES["OPEN"], worker=self.other_worker, waiting=True)
+            subtask = self.create_task(state=TASK_STATES["OPEN"], worker=self.worker, parent=parent, awaited=True)
+            subtask.close_task()
+            self.assertEqual(notify.call_count, 2)
+
+            self.create_task().assign_task(self.worker.id)
+            self.assertEqual(notify.call_count, 3)
+
+    def wait_for_work(self, timeout):
+        start = time.time()
+        result = worker_xmlrpc.wait_for_work(FakeRequest(Worker.objects.get(id=self.worker.id)), timeout)
+        return result, time.time() - start
+
+    def test_wait_timeout(self):
+        # existing work doesn't end the wait, only notifications do
+        self.create_task()
+        result, elapsed = self.wait_for_work(1)
+        self.assertFalse(result)
+        self.assertTrue(elapsed >= 1)
+
+    def test_wait_notified(self):
+        self.create_task()
+        timer = threading.Timer(0.2, wakeup.notify)
+        timer.start()
+        try:
+            result, elapsed = self.wait_for_work(10)
+        finally:
+            timer.cancel()
+        self.assertTrue(result)
+        self.assertTrue(elapsed < 5)
+
+    def test_wait_cursor(self):
+        # work created between a heartbeat and the wait isn't missed
+        cursor = wakeup.get_cursor()
+        time.sleep(0.01)
+        self.create_task()
+        wakeup.notify()
+        start = time.time()
+        result = worker_xmlrpc.wait_for_work(FakeRequest(Worker.objects.get(id=self.worker.id)), 10, cursor)
+        self.assertTrue(result)
+        self.assertTrue(time.time() - start < 5)
+
+        # nothing new since the cursor, existing work doesn't end the wait
+        start = time.time()
+        result = worker_xmlrpc.wait_for_work(FakeRequest(Worker.objects.get(id=self.worker.id)), 1, wakeup.get_cursor())
+        self.assertFalse(result)
+        self.assertTrue(time.time() - start >= 1)
+
+    def test_wait_ignores_unrelated(self):
+        self.create_task(channel=self.other_channel)
+        timer = threading.Timer(0.2, wakeup.notify)
+        timer.start()
+        try:
+            result, elapsed = self.wait_for_work(2)
+        finally:
+            timer.cancel()
+        self.assertFalse(result)
+
+
+if __name__ == '__main__':
+    TestRunner = get_runner(django.conf.settings)
+    test_runner = TestRunner()
+    failures = test_runner.run_tests([__name__])
+    sys.exit(bool(failures))